@@ -1,60 +1,126 @@
+import time # Import time for streaming render throttling and latency logging
+_script_started_at = time.perf_counter() # Start of this run, before any other imports
+
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import firebase_admin
 from firebase_admin import credentials, firestore
-import bcrypt
 import json
-import openai
 import uuid
 import base64 # Import base64 for decoding
 import os # Import os for environment variables
-from pypdf import PdfReader # Import PdfReader for reading PDF files
-from gtts import gTTS # Import gTTS for Text-to-Speech
-import io # Import io for handling in-memory audio files
-import requests # Import requests for making HTTP calls (though no longer directly used for DALL-E)
+from syllabus_corpus import load_syllabus, syllabus_version # Precompiled syllabus artifacts (run syllabus_corpus.py to build)
+from syllabus_retrieval import get_index # Local BM25 retrieval over syllabus sections
+from context_window import new_summary_state # Token-budgeted context with rolling summary
+import tutor_turn # Streamlit-free turn logic, shared with the offline benchmark
+import turn_router # Picks model, reply cap and syllabus context per kind of question
+from tutor_turn import request_summary, SUMMARY_MODEL
+from chat_store import start_session, append_messages, load_session, load_message_page # Append-only chat storage
+from prompt_store import make_prompt_ref, build_system_prompt, welcome_message, record_prompt_cache_usage # Shared, versioned system prompt templates
+from avatar_store import get_avatar_store, save_avatar, THUMBNAIL # Avatars outside the user document
+from user_profiles import get_password_hash, load_profile, load_volatile_fields, get_profile_cache, SCHEMA_VERSION # Field-projected user document access
+from session_auth import hash_password, check_password, issue_token, verify_token, revoke_token, PasswordPoolBusyError # Resume tokens; bcrypt on a bounded pool
+import token_ledger # Atomic token balance and per-feature usage entries
+import token_counter # Local token counts for preflight budget and context checks
+from write_buffer import WriteBuffer # Coalesces a run's Firestore writes into one commit
+from tts_cache import get_tts_cache # Content-addressed cache in front of gTTS
+from response_cache import get_response_cache # Shared answers to first questions, so repeats cost no tokens
+import image_jobs # Visual explanations generated in the background
+from image_jobs import ImageJobQueue
+import threading # Import threading for background cache warm-up
+import contextlib
+import telemetry # Timing spans for every hot-path stage
+import transcript # Windowed transcript with cached message markdown
+
+# openai and bcrypt are imported where they are first used, so pages that don't need them load faster
+_imports_done_at = time.perf_counter()
 
 # --- Firebase Initialization ---
-# Check if Firebase app is already initialized to prevent re-initialization errors
-# Use firebase_admin._apps to check if any app is already initialized
-if not firebase_admin._apps:
-    try:
-        # Attempt to get the Base64 encoded Firebase service account key from environment variables
-        firebase_service_account_key_b64 = os.environ.get("FIREBASE_SERVICE_ACCOUNT_KEY_B64")
+@st.cache_resource
+def init_firebase():
+    """Initializes Firebase once per process. Returns (db, avatar_store, error); db is None if it failed."""
+    # Check if Firebase app is already initialized to prevent re-initialization errors
+    if not firebase_admin._apps:
+        try:
+            # Attempt to get the Base64 encoded Firebase service account key from environment variables
+            firebase_service_account_key_b64 = os.environ.get("FIREBASE_SERVICE_ACCOUNT_KEY_B64")
+            if not firebase_service_account_key_b64:
+                return None, None, "Firebase service account key (FIREBASE_SERVICE_ACCOUNT_KEY_B64) not found in environment variables. Please set it securely."
 
-        if firebase_service_account_key_b64:
             # Decode the Base64 string back to JSON content
             firebase_service_account_key_str = base64.b64decode(firebase_service_account_key_b64).decode('utf-8')
-            
+
             # Initialize Firebase Admin SDK
             cred = credentials.Certificate(json.loads(firebase_service_account_key_str))
             firebase_admin.initialize_app(cred)
-            
-            st.session_state.firebase_initialized = True
-            st.success("Firebase initialized successfully!")
-            # No rerun needed here, as it's part of the initial load
-        else:
-            st.warning("Firebase service account key (FIREBASE_SERVICE_ACCOUNT_KEY_B64) not found in environment variables. Please set it securely.")
-            st.session_state.firebase_initialized = False
-    except Exception as e:
-        st.error(f"Error initializing Firebase from environment variable: {e}")
-        st.session_state.firebase_initialized = False
-else:
-    # If an app is already initialized, set the session state flag to True
-    st.session_state.firebase_initialized = True
-    # st.info("Firebase app already initialized.") # Optional: for debugging
-
-# Ensure db client is available if Firebase initialized
-if st.session_state.firebase_initialized:
+        except Exception as e:
+            return None, None, f"Error initializing Firebase from environment variable: {e}"
+
     db = firestore.client()
-else:
-    db = None # db will be None until Firebase is initialized
+    return db, get_avatar_store(db), None
+
+db, avatar_store, firebase_error = init_firebase()
+st.session_state.firebase_initialized = db is not None
+if firebase_error:
+    st.error(firebase_error)
 
 # --- OpenAI API Key Setup ---
-try:
-    openai_api_key = st.secrets["OPENAI_API_KEY"]
-    st.session_state.openai_initialized = True
-except KeyError:
+@st.cache_resource
+def get_openai_api_key():
+    """Reads the OpenAI API key from Streamlit secrets once per process; None if it isn't set."""
+    try:
+        return st.secrets["OPENAI_API_KEY"]
+    except KeyError:
+        return None
+
+openai_api_key = get_openai_api_key()
+st.session_state.openai_initialized = openai_api_key is not None
+if not openai_api_key:
     st.error("OpenAI API key not found in Streamlit secrets. Please add it.")
-    st.session_state.openai_initialized = False
+
+@st.cache_resource
+def get_openai_client():
+    """Returns the OpenAI client shared by every session, so connections are reused across turns."""
+    from openai_client import PooledOpenAI # Imported on first use; the login page never needs openai
+
+    return PooledOpenAI(api_key=openai_api_key)
+
+# --- Telemetry ---
+@st.cache_resource
+def start_telemetry():
+    """Sets up the telemetry sinks (JSON log, metrics endpoint) once per process. Returns per-process run state."""
+    telemetry.configure()
+    return {'cold_start': True}
+
+@contextlib.contextmanager
+def measure_payload(span):
+    """Records the size of everything sent to the browser while the block runs as span's payload_bytes.
+
+    Wraps the script run context's private enqueue function, so it quietly
+    measures nothing if a Streamlit release changes it.
+    """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        yield
+        return
+    ctx = get_script_run_ctx()
+    enqueue = getattr(ctx, '_enqueue', None)
+    if enqueue is None:
+        yield
+        return
+    span.set(payload_bytes=0, payload_messages=0)
+
+    def counting_enqueue(msg):
+        span.attributes['payload_bytes'] += msg.ByteSize()
+        span.attributes['payload_messages'] += 1
+        enqueue(msg)
+
+    ctx._enqueue = counting_enqueue
+    try:
+        yield
+    finally:
+        ctx._enqueue = enqueue
 
 # --- Session State Initialization ---
 if 'logged_in' not in st.session_state:
@@ -67,6 +133,18 @@ if 'user_data' not in st.session_state:
     st.session_state.user_data = None
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+if 'chat_session_id' not in st.session_state:
+    st.session_state.chat_session_id = None
+if 'persisted_message_count' not in st.session_state:
+    st.session_state.persisted_message_count = 0 # Sequence number the next saved message gets
+if 'history_base_seq' not in st.session_state:
+    st.session_state.history_base_seq = 0 # Sequence number of chat_history[0]
+if 'earlier_history' not in st.session_state:
+    st.session_state.earlier_history = [] # Older pages loaded on demand, for display only
+if 'transcript_window' not in st.session_state:
+    st.session_state.transcript_window = transcript.TRANSCRIPT_WINDOW # Newest messages rendered in the transcript
+if 'resumable_session' not in st.session_state:
+    st.session_state.resumable_session = None
 if 'current_study_subject' not in st.session_state:
     st.session_state.current_study_subject = None
 if 'subject_context_loaded' not in st.session_state:
@@ -75,19 +153,29 @@ if 'active_syllabus' not in st.session_state:
     st.session_state.active_syllabus = ""
 if 'active_subject_context' not in st.session_state:
     st.session_state.active_subject_context = ""
-if 'generating_image' not in st.session_state:
-    st.session_state.generating_image = False
+if 'active_syllabus_version' not in st.session_state:
+    st.session_state.active_syllabus_version = None
+if 'prompt_ref' not in st.session_state:
+    st.session_state.prompt_ref = None
+if 'last_retrieval_report' not in st.session_state:
+    st.session_state.last_retrieval_report = None
+if 'last_answer_cached' not in st.session_state:
+    st.session_state.last_answer_cached = False
+if 'context_summary' not in st.session_state:
+    st.session_state.context_summary = new_summary_state()
+if 'pending_audio' not in st.session_state:
+    st.session_state.pending_audio = None # Speech to play on the next run (st.rerun() would discard it otherwise)
+if 'image_job_id' not in st.session_state:
+    st.session_state.image_job_id = None # Background visual explanation job being polled
+if 'image_job_error' not in st.session_state:
+    st.session_state.image_job_error = None
+if 'write_buffer' not in st.session_state:
+    st.session_state.write_buffer = None # Firestore writes waiting for the end of the run (see flush_writes)
 
 
 # --- Helper Functions ---
 
-def hash_password(password):
-    """Hashes a password using bcrypt."""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-
-def check_password(password, hashed_password):
-    """Checks if a password matches a hashed password."""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+SESSION_QUERY_PARAM = 'session' # URL query parameter holding the resume token
 
 def get_user_doc_ref(username):
     """Returns the Firestore document reference for a given username."""
@@ -98,50 +186,238 @@ def get_user_doc_ref(username):
         return None # Or raise an error, depending on desired behavior
 
 def load_user_data(username):
-    """Loads user data from Firestore."""
-    doc_ref = get_user_doc_ref(username)
-    if doc_ref: # Check if doc_ref is valid
-        user_doc = doc_ref.get()
-        if user_doc.exists:
-            st.session_state.user_data = user_doc.to_dict()
-            st.session_state.chat_history = st.session_state.user_data.get('chat_history', [])
+    """Loads a user's profile fields from Firestore (chat history is paged in later, when needed)."""
+    if db: # Ensure db is initialized
+        user_data = load_profile(db, username, avatar_store)
+        if user_data:
+            get_profile_cache().put(username, user_data) # Lets a reconnecting browser resume without this read
+            st.session_state.user_data = user_data
+            reset_chat_session(user_data.get('current_session_id'))
             return True
     return False
 
-def update_user_data(data):
-    """Updates user data in Firestore."""
+def log_in(username):
+    """Marks the session as logged in as username and keeps a resume token in the URL for reconnects."""
+    st.session_state.logged_in = True
+    st.session_state.username = username
+    st.query_params[SESSION_QUERY_PARAM] = issue_token(username)
+
+def resume_login():
+    """Logs a refreshed or reconnected browser back in from its resume token, without bcrypt.
+
+    The profile comes from the process's profile cache when it is there; only
+    the token balance and current session are re-read.
+    """
+    token = st.query_params.get(SESSION_QUERY_PARAM)
+    if st.session_state.logged_in or not token or db is None:
+        return
+    username = verify_token(token)
+    if username is None:
+        del st.query_params[SESSION_QUERY_PARAM] # Expired or revoked; the student logs in again
+        return
+
+    profile = get_profile_cache().get(username)
+    volatile = load_volatile_fields(db, username) if profile is not None else None
+    if volatile is not None:
+        profile.update(volatile) # Another tab or process may have charged tokens or started a session
+        get_profile_cache().put(username, profile)
+        st.session_state.username = username
+        st.session_state.user_data = profile
+        reset_chat_session(profile.get('current_session_id'))
+    else:
+        st.session_state.username = username
+        if not load_user_data(username):
+            st.session_state.username = None
+            del st.query_params[SESSION_QUERY_PARAM] # The account no longer exists
+            return
+    st.session_state.logged_in = True
+    if st.session_state.current_page in ('login', 'register'):
+        st.session_state.current_page = 'tutor'
+
+def log_out():
+    """Logs out, revoking the resume token so a refresh doesn't log back in."""
+    flush_writes() # Before the session state they belong to is cleared
+    token = st.query_params.get(SESSION_QUERY_PARAM)
+    if token:
+        revoke_token(token)
+        del st.query_params[SESSION_QUERY_PARAM]
+    if st.session_state.username:
+        get_profile_cache().drop(st.session_state.username)
+    st.session_state.logged_in = False
+    st.session_state.username = None
+    st.session_state.user_data = None
+    reset_chat_session()
+    st.session_state.current_page = 'login'
+
+def reset_chat_session(session_id=None):
+    """Points the chat state at a stored session (or none) without loading any of its messages."""
+    flush_writes() # Buffered messages belong to the session being left
+    st.session_state.chat_session_id = session_id
+    st.session_state.chat_history = []
+    st.session_state.earlier_history = []
+    st.session_state.transcript_window = transcript.TRANSCRIPT_WINDOW
+    st.session_state.history_base_seq = 0
+    st.session_state.persisted_message_count = 0
+    st.session_state.resumable_session = None
+    st.session_state.context_summary = new_summary_state()
+    st.session_state.image_job_id = None # A visual still generating belongs to the previous session
+
+def stored_message(page_message):
+    """Returns a loaded message as the chat history holds it: role, content and its stored token count, if any."""
+    return {k: page_message[k] for k in ('role', 'content', 'tokens') if k in page_message}
+
+def resume_chat_session(session):
+    """Loads the newest page of a stored session's messages; older pages load as the transcript asks for them."""
+    page = load_message_page(db, st.session_state.username, st.session_state.chat_session_id)
+    st.session_state.chat_history = [stored_message(m) for m in page]
+    st.session_state.history_base_seq = page[0]['seq'] if page else 0
+    st.session_state.persisted_message_count = session.get('message_count', 0)
+    st.session_state.earlier_history = []
+
+def load_earlier_history():
+    """Loads the page of messages just before the oldest one on screen."""
+    oldest_seq = st.session_state.history_base_seq - len(st.session_state.earlier_history)
+    page = load_message_page(db, st.session_state.username, st.session_state.chat_session_id, before_seq=oldest_seq)
+    st.session_state.earlier_history = [stored_message(m) for m in page] + st.session_state.earlier_history
+
+def show_earlier_messages():
+    """Widens the transcript window by a page, fetching older messages from Firestore once memory runs out."""
+    loaded = len(st.session_state.earlier_history) + len(st.session_state.chat_history)
+    st.session_state.transcript_window += transcript.TRANSCRIPT_PAGE
+    if st.session_state.transcript_window > loaded and unloaded_message_count() > 0:
+        load_earlier_history()
+
+def unloaded_message_count():
+    """Returns how many of the session's older messages haven't been fetched from Firestore yet."""
+    return st.session_state.history_base_seq - len(st.session_state.earlier_history)
+
+# Fields other code owns; the session's copies of them can be stale, so profile forms never write them back
+NOT_PROFILE_FORM_FIELDS = (
+    'tokens', # The token ledger; writing our copy back would undo other tabs' charges
+    'current_session_id', # chat_store.start_session; writing our copy back would orphan a newer session
+)
+
+def update_user_data(fields):
+    """Writes the profile fields a form changed to Firestore, and into the session's profile and the profile cache."""
     if st.session_state.username and st.session_state.user_data and db: # Ensure db is initialized
         doc_ref = get_user_doc_ref(st.session_state.username)
         if doc_ref: # Check if doc_ref is valid
-            doc_ref.set(data, merge=True) # Use merge=True to update specific fields
-            st.session_state.user_data = data # Update session state immediately
+            profile_fields = {k: v for k, v in fields.items() if k not in NOT_PROFILE_FORM_FIELDS}
+            with telemetry.span("firestore.update_profile", fields=len(profile_fields)):
+                doc_ref.set(profile_fields, merge=True) # Use merge=True to update specific fields
+            st.session_state.user_data.update(profile_fields) # Update session state immediately
+            get_profile_cache().put(st.session_state.username, st.session_state.user_data)
             return True
     return False
 
+def begin_chat_session(prompt_ref):
+    """Starts a new stored study session and makes it current here, in the profile cache and in Firestore."""
+    session_id = start_session(db, st.session_state.username, prompt_ref)
+    st.session_state.user_data['current_session_id'] = session_id
+    get_profile_cache().put(st.session_state.username, st.session_state.user_data)
+    reset_chat_session(session_id)
+
+def get_write_buffer():
+    """Returns this session's buffer of Firestore writes, committed by flush_writes() at the end of the run."""
+    if st.session_state.write_buffer is None:
+        st.session_state.write_buffer = WriteBuffer(db)
+    return st.session_state.write_buffer
+
+def flush_writes():
+    """Commits the session's buffered Firestore writes in one batch. A failed commit keeps them for the next flush."""
+    buffer = st.session_state.write_buffer
+    if buffer is None or not len(buffer):
+        return
+    try:
+        buffer.flush()
+    except Exception as e:
+        print(f"WARNING: Could not save {len(buffer)} buffered Firestore writes; retrying after the next run: {e}")
+
+def spend_tokens(amount, feature, model=None, usage=None, reserved=0):
+    """Charges the logged-in user through the token ledger and updates the displayed balance.
+
+    reserved is what reserve_tokens() held back for this call; the charge settles it.
+    A settlement is committed at once, like the reservation it settles: if it
+    sat in the write buffer, a failed flush and a closed tab would keep the
+    held tokens for good. Unreserved charges are committed with the turn's
+    messages when the run ends.
+    """
+    user_data = st.session_state.user_data
+    token_ledger.charge(
+        db, st.session_state.username, amount, feature, model=model,
+        prompt_tokens=usage.prompt_tokens if usage else 0,
+        completion_tokens=usage.completion_tokens if usage else 0,
+        cached_tokens=getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0,
+        batch=None if reserved else get_write_buffer(),
+        reserved=reserved,
+    )
+    user_data['tokens'] = max(0, user_data.get('tokens', 0) - (amount - reserved)) # Local copy for display only; show_token_meter() shows it
+
+def reserve_tokens(amount):
+    """Holds amount tokens back for a call about to be made. Returns False, holding nothing, if the balance can't cover it."""
+    try:
+        st.session_state.user_data['tokens'] = token_ledger.reserve(db, st.session_state.username, amount)
+    except token_ledger.InsufficientTokensError as e:
+        st.session_state.user_data['tokens'] = e.balance
+        return False
+    return True
+
+def release_tokens(amount):
+    """Hands back a reservation whose call failed or reported no usage (committed at once, never buffered)."""
+    token_ledger.release(db, st.session_state.username, amount)
+    st.session_state.user_data['tokens'] = st.session_state.user_data.get('tokens', 0) + amount
+
+def refresh_token_balance(required=1):
+    """Re-reads the balance transactionally; returns it, or None (after showing an error) if it is below required."""
+    try:
+        balance = token_ledger.check_balance(db, st.session_state.username, required)
+    except token_ledger.InsufficientTokensError as e:
+        balance = e.balance
+        balance_ok = False
+    else:
+        balance_ok = True
+    st.session_state.user_data['tokens'] = balance
+    return balance if balance_ok else None
+
 def save_chat_history():
-    """Saves the current chat history to Firestore."""
-    if st.session_state.username and st.session_state.user_data and db: # Ensure db is initialized
-        doc_ref = get_user_doc_ref(st.session_state.username)
-        if doc_ref: # Check if doc_ref is valid
-            doc_ref.update({'chat_history': st.session_state.chat_history})
+    """Queues chat messages added since the last save for the session's messages subcollection (committed when the run ends)."""
+    if st.session_state.username and st.session_state.user_data and st.session_state.chat_session_id and db: # Ensure db is initialized
+        saved_in_memory = st.session_state.persisted_message_count - st.session_state.history_base_seq
+        new_messages = st.session_state.chat_history[saved_in_memory:]
+        if new_messages:
+            st.session_state.persisted_message_count = append_messages(
+                db, st.session_state.username, st.session_state.chat_session_id,
+                new_messages, st.session_state.persisted_message_count,
+                batch=get_write_buffer(), # Committed by flush_writes() when the run ends
+            )
 
-# Function to read text from a PDF file
-def read_pdf_text(file_path):
-    """Reads text content from a PDF file."""
-    text_content = ""
-    print(f"DEBUG: Attempting to read PDF: {file_path}") # Debug print
+@st.cache_data(max_entries=256)
+def load_avatar_thumbnail(avatar_hash):
+    """Loads an avatar thumbnail; avatars are content-addressed, so cached bytes never go stale."""
+    return avatar_store.get(avatar_hash, THUMBNAIL)
+
+@st.cache_data(max_entries=64)
+def load_generated_image(image_ref):
+    """Returns displayable image data for a transcript image entry (an image hash, or a legacy DALL-E URL).
+
+    Images are content-addressed, so the bytes are read from disk once, not on every rerun.
+    """
+    if image_ref.startswith(("http://", "https://")):
+        return image_ref # Stored before images were cached; these URLs have usually expired
+    return get_image_jobs().cache.get(image_ref)
+
+# Function to load a precompiled syllabus
+def load_syllabus_text(subject):
+    """Loads the precompiled syllabus text for a subject (see syllabus_corpus.py)."""
     try:
-        reader = PdfReader(file_path)
-        for page in reader.pages:
-            text_content += page.extract_text() + "\n"
-        print(f"DEBUG: Successfully read PDF: {file_path}, content length: {len(text_content)}") # Debug print
+        text_content = load_syllabus(subject) # Timed by its own syllabus.load span
     except FileNotFoundError:
-        print(f"ERROR: PDF file not found: {file_path}") # Debug print
-        st.error(f"PDF file not found: {file_path}")
+        print(f"ERROR: Syllabus not found for subject: {subject}") # Debug print
+        st.error(f"Syllabus not found for subject: {subject}")
         return None
     except Exception as e:
-        print(f"ERROR: Error reading PDF file {file_path}: {e}") # Debug print
-        st.error(f"Error reading PDF file {file_path}: {e}")
+        print(f"ERROR: Error loading syllabus for {subject}: {e}") # Debug print
+        st.error(f"Error loading syllabus for {subject}: {e}")
         return None
     return text_content
 
@@ -149,11 +425,11 @@ def read_pdf_text(file_path):
 def read_text_file(file_path):
     """Reads text content from a plain text file."""
     text_content = ""
-    print(f"DEBUG: Attempting to read TXT: {file_path}") # Debug print
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            text_content = f.read()
-        print(f"DEBUG: Successfully read TXT: {file_path}, content length: {len(text_content)}") # Debug print
+        with telemetry.span("context.load_txt", path=file_path) as span:
+            with open(file_path, "r", encoding="utf-8") as f:
+                text_content = f.read()
+            span.set(bytes=telemetry.text_bytes(text_content))
     except FileNotFoundError:
         print(f"ERROR: Text file not found: {file_path}") # Debug print
         st.error(f"Text file not found: {file_path}")
@@ -164,63 +440,349 @@ def read_text_file(file_path):
         return None
     return text_content
 
+# Function to load a subject's syllabus and context for a study session
+def activate_subject(subject):
+    """Loads the syllabus and context for a subject into the session. Returns False (after showing an error) on failure."""
+    syllabus_content = load_syllabus_text(subject) # Compiled syllabus text, read once per process and shared (no PDF parsing)
+    if syllabus_content is None: # load_syllabus_text returns None on error
+        return False
+
+    context_file_path = os.path.join("subject_context", f"con_{subject}.txt")
+    context_content = read_text_file(context_file_path)
+    if context_content is None: # read_text_file returns None on error
+        return False
+
+    st.session_state.current_study_subject = subject
+    st.session_state.active_syllabus = syllabus_content
+    st.session_state.active_subject_context = context_content
+    st.session_state.active_syllabus_version = syllabus_version(subject)
+    st.session_state.last_retrieval_report = None
+    st.session_state.last_answer_cached = False
+    # Build (or reuse) the section index now so the first question doesn't pay for it
+    get_index(subject, st.session_state.active_syllabus_version, syllabus_content)
+    return True
+
+# Function to fold old chat turns into the rolling session summary
+def summarize_turns(previous_summary, messages, token_budget):
+    """Updates the rolling summary of a study session with turns that left the context window."""
+    summary, usage = request_summary(get_openai_client(), previous_summary, messages, token_budget, requester=st.session_state.username)
+
+    # Summaries are part of the session's cost, so they come out of the same token balance
+    if usage:
+        spend_tokens(usage.total_tokens, token_ledger.SESSION_SUMMARY, model=SUMMARY_MODEL, usage=usage)
+    return summary
+
+# Function to stream a tutor response into the transcript
+def stream_tutor_response(messages, placeholder, route, max_tokens):
+    """Streams the tutor's reply, as route says, into a transcript placeholder as chunks arrive.
+
+    Returns (response_text, usage, truncated), where truncated means the reply hit max_tokens.
+    """
+    def render(text, done):
+        placeholder.markdown(transcript.message_markdown("assistant", text) if done else f"**Tutor:** {text}▌")
+
+    def show_queue_position(position):
+        placeholder.markdown(f"**Tutor:** _Lots of students are asking right now. You're number {position} in line..._")
+
+    with turn_router.route_span(route, max_tokens) as span: # Per-route latency and tokens, for tuning the policy
+        response_text, usage, timings = tutor_turn.stream_tutor_response(
+            get_openai_client(), messages, render, requester=st.session_state.username, on_queue=show_queue_position,
+            model=route.model, max_tokens=max_tokens, temperature=route.temperature)
+        span.set(truncated=timings['truncated'], **telemetry.usage_attributes(usage))
+    return response_text, usage, timings['truncated']
+
 # Function for Text-to-Speech
 def text_to_speech(text):
-    """Converts text to speech and returns audio bytes."""
+    """Converts text to speech and returns audio bytes (cached, so repeated text is never re-synthesized)."""
     try:
-        tts = gTTS(text=text, lang='en', slow=False)
-        fp = io.BytesIO()
-        tts.save(fp)
-        fp.seek(0)
-        return fp.read()
+        return get_tts_cache().get(text, lang='en', slow=False)
     except Exception as e:
         st.error(f"Error converting text to speech: {e}")
         return None
 
-# Function to generate image using DALL-E API
-def generate_image(prompt):
-    """Generates an image using the OpenAI DALL-E 3 API."""
-    st.session_state.generating_image = True
-    print(f"DEBUG: Starting DALL-E image generation for prompt: {prompt}")
-    
-    # Create a placeholder for status messages during image generation
-    status_placeholder = st.empty()
-    status_placeholder.info("Starting DALL-E image generation...")
+@st.cache_resource
+def start_tts_warmup(subjects):
+    """Pre-synthesizes every subject's welcome message once per process, in the background."""
+    thread = threading.Thread(
+        target=get_tts_cache().warm,
+        args=([welcome_message(subject) for subject in subjects],),
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+@st.cache_resource
+def get_image_jobs():
+    """Returns the background image job queue shared by every session."""
+    return ImageJobQueue(get_openai_client())
+
+# Function to poll the running visual explanation job
+@st.fragment(run_every=1.5)
+def image_job_status():
+    """Shows progress of the session's image job and adds the visual to the transcript once it finishes."""
+    job_id = st.session_state.image_job_id
+    if not job_id:
+        return
+    job = get_image_jobs().get(job_id)
+    if job is None:
+        st.session_state.image_job_id = None
+        st.rerun()
+    if job.status == image_jobs.PENDING:
+        if job.queue_position:
+            st.info(f"Waiting to generate your visual: you're number {job.queue_position} in line. You can keep asking questions meanwhile.")
+        else:
+            st.info("Generating a visual explanation... you can keep asking questions meanwhile.")
+        return
+
+    st.session_state.image_job_id = None
+    if job.charged_to == st.session_state.username:
+        # The job charged the ledger and settled this session's reservation itself; show the resulting balance
+        st.session_state.user_data['tokens'] = token_ledger.get_balance(db, st.session_state.username)
+    if job.status == image_jobs.DONE:
+        if job.prompt:
+            st.session_state.chat_history.append({"role": "assistant", "content": f"Here is a visual for: '{job.prompt}'"})
+        st.session_state.chat_history.append({"role": "image", "content": job.image_hash})
+        save_chat_history()
+    else:
+        st.session_state.image_job_error = job.error
+    st.rerun() # Rerun the whole page to show the image and the new balance
 
+
+# --- Chat Panel ---
+
+def show_token_meter(meter):
+    """Shows the token balance in the meter placeholder (an st.empty() in the sidebar)."""
+    meter.metric("Tokens Remaining", st.session_state.user_data.get('tokens', 0))
+
+def rerun_chat_panel():
+    """Reruns only the chat panel during its own fragment runs, and the whole page during a full run.
+
+    st.rerun(scope="fragment") raises StreamlitAPIException unless a fragment
+    rerun is in progress, and the panel also renders (and may handle a click)
+    as part of full runs.
+    """
     try:
-        client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"]) # Use the already initialized OpenAI client
-
-        status_placeholder.info("Sending request to DALL-E API...")
-        response = client.images.generate(
-            model="dall-e-3",  # Specify DALL-E 3 model
-            prompt=prompt,
-            size="1024x1024", # Standard size
-            quality="standard", # Standard quality for cost efficiency
-            n=1 # Generate one image
-        )
-        
-        # DALL-E API returns a list of image objects, each with a URL
-        if response.data and len(response.data) > 0 and response.data[0].url:
-            image_url = response.data[0].url
-            print(f"DEBUG: Successfully generated DALL-E image. Image URL: {image_url}")
-            status_placeholder.success("Image generated successfully!")
-            return image_url
-        else:
-            # Add more specific logging for when URL is not found
-            print(f"ERROR: DALL-E image generation failed: No image URL found in response. Full response data: {response.data}")
-            status_placeholder.error("DALL-E image generation failed: No image data returned. Check Streamlit Cloud logs for full response details.")
-            return None
-    except openai.APIError as e:
-        print(f"ERROR: OpenAI DALL-E API error: {e}")
-        status_placeholder.error(f"OpenAI DALL-E API error: {e}. Please check your API key, permissions, and DALL-E quota. See Streamlit Cloud logs for more details.")
-        return None
-    except Exception as e:
-        print(f"ERROR: An unexpected error occurred during DALL-E image generation: {e}")
-        status_placeholder.error(f"An unexpected error occurred during DALL-E image generation: {e}. Check Streamlit Cloud logs for details.")
-        return None
-    finally:
-        st.session_state.generating_image = False
-        print("DEBUG: Finished DALL-E image generation attempt.")
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def chat_panel(meter):
+    """The chat input and transcript. Its widgets and turns rerun only this fragment, not the whole page.
+
+    The sidebar's token meter lives outside the fragment, so each run redraws
+    it through its placeholder instead of the meter polling for changes.
+    """
+    with telemetry.span("ui.chat_panel") as span, measure_payload(span):
+        try:
+            render_chat_panel()
+        finally:
+            flush_writes() # A fragment run never reaches the end of the script, so the turn's writes are committed here
+            show_token_meter(meter)
+
+# CHAT_PANEL_FRAGMENT=0 renders the panel as part of the page, so every turn reruns the whole page (for benchmarks/rerun_report.py)
+if os.environ.get("CHAT_PANEL_FRAGMENT", "1") != "0":
+    chat_panel = st.fragment(chat_panel)
+
+def render_chat_panel():
+    """Renders the chat input and transcript and runs a turn when the student sends a question."""
+    user_data = st.session_state.user_data
+
+    # --- Chat Interface ---
+    col1, col2 = st.columns([1, 2]) # Input on left, output/history on right
+
+    with col1:
+        st.subheader("Your Input")
+        user_input = st.text_area("Type your question here:", height=150, key="user_input_area")
+        send_button = st.button("Send to Tutor")
+
+        # Show how much prompt the syllabus retrieval saved on the last turn
+        report = st.session_state.last_retrieval_report
+        if st.session_state.last_answer_cached:
+            st.caption("Answered from the shared answer cache (0 tokens)")
+        elif report:
+            st.caption(f"Syllabus context: {report['sections']} sections, ~{report['injected_tokens']:,} tokens (saved ~{report['tokens_saved']:,} vs. full syllabus)")
+
+        # Play the latest tutor speech once
+        if st.session_state.pending_audio:
+            st.audio(st.session_state.pending_audio, format='audio/mp3', start_time=0, autoplay=True)
+            st.session_state.pending_audio = None
+
+        # New: Generate Visual Explanation button
+        generate_visual_button = st.button("Generate Visual Explanation", disabled=bool(st.session_state.image_job_id)) # Disable while generating
+
+    with col2:
+        st.subheader("Session Transcript") # Changed from "Chat History"
+        chat_display_area = st.container(height=400, border=True)
+
+        # Only the newest messages are rendered; older ones (and older stored pages) are shown on request
+        all_messages = st.session_state.earlier_history + st.session_state.chat_history
+        if transcript.has_hidden_messages(all_messages, st.session_state.transcript_window, unloaded_message_count()):
+            if chat_display_area.button("Load earlier messages"):
+                show_earlier_messages()
+                rerun_chat_panel()
+
+        for chat_message in transcript.visible_messages(all_messages, st.session_state.transcript_window):
+            if chat_message["role"] in ("user", "assistant"):
+                # Streamlit's markdown parser will automatically render LaTeX within $$...$$ or $...$
+                chat_display_area.markdown(transcript.message_markdown(chat_message["role"], chat_message["content"]))
+            elif chat_message["role"] == "image": # Display generated images
+                image = load_generated_image(chat_message['content'])
+                if image:
+                    chat_display_area.image(image, caption="AI Generated Visual")
+                else:
+                    chat_display_area.caption("(This visual is no longer available.)")
+
+        # Scroll to bottom
+        st.markdown("<script>window.scrollTo(0, document.body.scrollHeight);</script>", unsafe_allow_html=True)
+
+    if send_button and user_input:
+        # The first question of a session has no conversation behind it, so its answer can be shared
+        is_first_question = st.session_state.history_base_seq == 0 and not any(m["role"] == "user" for m in st.session_state.chat_history)
+        cache_key_args = (st.session_state.current_study_subject, st.session_state.active_syllabus_version, st.session_state.prompt_ref['grade'], user_input)
+        cached_answer = get_response_cache().lookup(*cache_key_args) if is_first_question else None
+        st.session_state.last_answer_cached = cached_answer is not None
+        if cached_answer:
+            telemetry.current_span().set(response_cache_hit=True)
+            st.session_state.chat_history.append({"role": "user", "content": user_input})
+            st.session_state.chat_history.append({"role": "assistant", "content": cached_answer})
+            st.session_state.pending_audio = text_to_speech(cached_answer)
+            save_chat_history()
+            rerun_chat_panel()
+
+        balance = refresh_token_balance()
+        if balance is None:
+            st.error("You have no tokens left! Please contact support for more.")
+            return
+
+        # Pick the model, reply cap and whether syllabus sections are needed from the kind of question
+        route = turn_router.route_question(user_input, has_previous_answer=turn_router.has_previous_answer(st.session_state.chat_history))
+        telemetry.current_span().set(route=route.name)
+
+        # Add user message to history; it is saved once the request has passed its preflight check
+        st.session_state.chat_history.append({"role": "user", "content": user_input})
+
+        # Retrieve only the syllabus sections relevant to this question (greetings and follow-ups need none)
+        retrieved_context_message = None
+        sections = None # Drops retrieved sections, lowest-ranked first, if the prompt doesn't fit the balance
+        st.session_state.last_retrieval_report = None
+        if route.syllabus_context:
+            syllabus_index = get_index(st.session_state.current_study_subject, st.session_state.active_syllabus_version, st.session_state.active_syllabus)
+            retrieved_context_message, retrieval_report = tutor_turn.retrieval_message(st.session_state.current_study_subject, syllabus_index, user_input, st.session_state.active_syllabus)
+            sections = tutor_turn.SectionTrimmer(st.session_state.current_study_subject, syllabus_index, user_input, st.session_state.active_syllabus, retrieved_context_message, retrieval_report)
+
+        import openai # Only for its error types; get_openai_client() has loaded it already
+
+        reserved = 0 # Tokens held back for the reply until its real usage is charged
+        try:
+            # Show the question and the tutor's reply in the transcript straight away
+            chat_display_area.markdown(transcript.message_markdown("user", user_input))
+            response_placeholder = chat_display_area.empty()
+            response_placeholder.markdown("**Tutor:** _thinking..._")
+
+            # Construct AI prompt context for this turn: system prompt, rolling summary, recent turns,
+            # and the retrieved sections just before the question
+            system_prompt = build_system_prompt(st.session_state.prompt_ref, st.session_state.active_subject_context)
+            turn_args = (system_prompt, st.session_state.chat_history, st.session_state.context_summary)
+
+            # Count the request locally; one that can't fit the context or the balance is trimmed (retrieved
+            # sections first) or never sent. A draft without a new summary is checked first, so a rejected
+            # question costs no summary either.
+            try:
+                token_counter.preflight(tutor_turn.build_turn_messages(*turn_args, None, retrieved_context_message), route.model, route.max_tokens, balance, trim=sections)
+                messages = tutor_turn.build_turn_messages(*turn_args, summarize_turns, sections.message if sections else None)
+                messages, prompt_tokens, max_tokens = token_counter.preflight(messages, route.model, route.max_tokens, st.session_state.user_data.get('tokens', 0), trim=sections)
+            except token_counter.PreflightError as e:
+                st.session_state.chat_history.pop()
+                response_placeholder.empty()
+                st.error(f"Your question wasn't sent: {e} Try a shorter question, or ask support for more tokens.")
+                return
+            st.session_state.last_retrieval_report = sections.report if sections else None # What was actually sent
+
+            # Hold back the most this turn can cost, so another tab can't spend the same tokens meanwhile
+            if not reserve_tokens(prompt_tokens + max_tokens):
+                st.session_state.chat_history.pop()
+                response_placeholder.empty()
+                st.error(f"Your question wasn't sent: it needs up to {prompt_tokens + max_tokens} tokens, but you have {st.session_state.user_data['tokens']}.")
+                return
+            reserved = prompt_tokens + max_tokens
+            save_chat_history() # Save the question to Firestore
+
+            # The route's model streams the reply token-by-token
+            tutor_response, usage, truncated = stream_tutor_response(messages, response_placeholder, route, max_tokens)
+
+            # Settle the reservation against the actual tokens used once the stream has finished
+            if usage:
+                spend_tokens(usage.total_tokens, token_ledger.TUTOR_CHAT, model=route.model, usage=usage, reserved=reserved)
+                record_prompt_cache_usage(st.session_state.current_study_subject, usage)
+            else:
+                print("WARNING: OpenAI API stream did not contain usage information.")
+                release_tokens(reserved)
+            reserved = 0
+
+
+            # Add tutor response to history
+            st.session_state.chat_history.append({"role": "assistant", "content": tutor_response})
+            if is_first_question and max_tokens == route.max_tokens and not truncated and not (sections and sections.dropped):
+                # Only complete answers are shared; one cut short (or given fewer sections) for this student's balance isn't
+                get_response_cache().store(*cache_key_args, tutor_response)
+
+            # New: Play AI response as speech (rendered after the rerun below)
+            st.session_state.pending_audio = text_to_speech(tutor_response)
+
+            save_chat_history() # Save updated history to Firestore
+            rerun_chat_panel() # Rerun the chat panel to update the transcript; the rerun also redraws the token meter
+
+        except openai.APIError as e:
+            st.error(f"OpenAI API error: {e}")
+            if reserved:
+                release_tokens(reserved) # The reply was never paid for, so its reservation goes back
+        except Exception as e:
+            st.error(f"An unexpected error occurred: {e}")
+            if reserved:
+                release_tokens(reserved)
+
+    elif generate_visual_button:
+        last_tutor_message = ""
+        for msg in reversed(st.session_state.chat_history):
+            if msg["role"] == "assistant":
+                last_tutor_message = msg["content"]
+                break
+
+        if not last_tutor_message:
+            st.warning("No recent tutor message to generate a visual from. Please ask a question first.")
+            return
+
+        # Check if user has enough tokens for both prompt generation and image credit
+        estimated_prompt_tokens = token_counter.count_messages(image_jobs.image_prompt_messages(last_tutor_message)) + image_jobs.PROMPT_MAX_TOKENS
+        total_estimated_cost = estimated_prompt_tokens + image_jobs.IMAGE_GENERATION_CREDIT_COST
+
+        if not reserve_tokens(total_estimated_cost):
+            st.error(f"You need at least {total_estimated_cost} tokens to generate a visual (including prompt generation). You have {user_data['tokens']} tokens.")
+            return
+
+        # Prompt crafting and DALL-E run in the background; image_job_status() polls for the result.
+        # Its charges are taken out of the reservation, and whatever is left of it is handed back when the job ends.
+        username = st.session_state.username
+        held = {'tokens': total_estimated_cost}
+        def charge(amount, feature, model, usage):
+            covered = min(amount, held['tokens'])
+            held['tokens'] -= covered
+            token_ledger.charge(
+                db, username, amount, feature, model=model,
+                prompt_tokens=usage.prompt_tokens if usage else 0,
+                completion_tokens=usage.completion_tokens if usage else 0,
+                reserved=covered,
+            )
+        def settle():
+            if held['tokens']:
+                token_ledger.release(db, username, held['tokens'])
+                held['tokens'] = 0
+        st.session_state.image_job_id = get_image_jobs().submit(last_tutor_message, charge, requester=username, settle=settle)
+        job = get_image_jobs().get(st.session_state.image_job_id)
+        if job is not None and job.charged_to != username:
+            # Joined another student's job: it costs nothing, and settle() has already handed the reservation back
+            st.session_state.user_data['tokens'] += total_estimated_cost
+        st.rerun() # Whole page, so image_job_status() starts polling for this job
 
 
 # --- Pages ---
@@ -245,20 +807,22 @@ def login_page():
                 st.error("Firebase is not initialized. Cannot log in.")
                 return
 
-            user_doc_ref = get_user_doc_ref(username)
-            if user_doc_ref is None:
+            if db is None:
                 st.error("Firebase is not properly configured. Cannot access user data.")
                 return
 
-            user_doc = user_doc_ref.get()
-
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                if check_password(password, user_data['password_hash']):
-                    st.session_state.logged_in = True
-                    st.session_state.username = username
-                    st.session_state.user_data = user_data
-                    st.session_state.chat_history = user_data.get('chat_history', [])
+            # Only the password hash is fetched to authenticate; the profile is loaded after
+            password_hash = get_password_hash(db, username)
+
+            if password_hash is not None:
+                try:
+                    password_ok = check_password(password, password_hash)
+                except PasswordPoolBusyError:
+                    st.error("Too many students are logging in right now. Please try again in a moment.")
+                    return
+                if password_ok:
+                    log_in(username)
+                    load_user_data(username)
                     st.session_state.current_page = 'tutor' # Redirect to tutor page after login
                     st.rerun()
                 else:
@@ -314,10 +878,14 @@ def register_page():
             elif not username or not password or not first_name or not last_name or not email:
                 st.error("All fields are required.")
             else:
-                if user_doc_ref.get().exists:
+                if get_password_hash(db, username) is not None:
                     st.error("Username already exists. Please choose a different one.")
                 else:
-                    hashed_pass = hash_password(password)
+                    try:
+                        hashed_pass = hash_password(password)
+                    except PasswordPoolBusyError:
+                        st.error("Too many students are registering right now. Please try again in a moment.")
+                        return
                     initial_tokens = 1000
                     user_data = {
                         'first_name': first_name,
@@ -332,9 +900,10 @@ def register_page():
                             'difficulty': 'beginner'
                         },
                         'subjects': [],
-                        'chat_history': []
+                        'schema_version': SCHEMA_VERSION
                     }
-                    user_doc_ref.set(user_data)
+                    with telemetry.span("firestore.create_user"):
+                        user_doc_ref.set(user_data)
                     st.success("Registration successful! You can now log in.")
                     st.session_state.current_page = 'login'
                     st.rerun()
@@ -373,11 +942,22 @@ def profile_page():
     st.write(f"**Email:** {user_data.get('email', 'N/A')}")
     st.write(f"**Tokens Remaining:** {user_data.get('tokens', 'N/A')}")
 
+    # --- Token Usage Section ---
+    st.header("Token Usage")
+    spend = token_ledger.spend_by_feature(db, st.session_state.username)
+    if spend:
+        st.table([
+            {"Feature": feature.replace('_', ' ').title(), "Requests": totals['requests'], "Tokens": totals['tokens']}
+            for feature, totals in sorted(spend.items(), key=lambda item: -item[1]['tokens'])
+        ])
+    else:
+        st.info("No tokens spent yet.")
+
     # --- Avatar Upload Section ---
     st.header("Profile Avatar")
-    current_avatar_b64 = user_data.get('avatar_b64')
-    if current_avatar_b64:
-        st.image(base64.b64decode(current_avatar_b64), caption="Your Current Avatar", width=150)
+    current_avatar_hash = user_data.get('avatar_hash')
+    if current_avatar_hash:
+        st.image(load_avatar_thumbnail(current_avatar_hash), caption="Your Current Avatar", width=150)
     else:
         st.info("No avatar uploaded yet.")
 
@@ -389,12 +969,15 @@ def profile_page():
             if uploaded_file.size > 1 * 1024 * 1024: # 1 MB limit
                 st.error("File size exceeds 1MB. Please upload a smaller image.")
             else:
-                # Read image as bytes and encode to Base64
+                # Store the image (and its thumbnail) in the avatar store; the user document only keeps its hash and URLs
                 image_bytes = uploaded_file.read()
-                image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-                
-                user_data['avatar_b64'] = image_b64
-                if update_user_data(user_data):
+                try:
+                    avatar_fields = save_avatar(avatar_store, image_bytes)
+                except Exception as e:
+                    st.error(f"Could not process the uploaded image: {e}")
+                    st.stop()
+
+                if update_user_data(avatar_fields):
                     st.success("Avatar uploaded successfully!")
                     st.rerun() # Rerun to display the new avatar
                 else:
@@ -449,12 +1032,12 @@ def profile_page():
         update_pref_button = st.form_submit_button("Update Preferences")
 
         if update_pref_button:
-            user_data['learning_preferences'] = {
+            learning_preferences = {
                 'style': learning_style,
                 'pace': learning_pace,
                 'difficulty': difficulty_level
             }
-            if update_user_data(user_data):
+            if update_user_data({'learning_preferences': learning_preferences}):
                 st.success("Learning preferences updated successfully!")
             else:
                 st.error("Failed to update learning preferences.")
@@ -489,8 +1072,7 @@ def profile_page():
             if len(selected_subjects) > 5:
                 st.error("You can select a maximum of 5 subjects.")
             else:
-                user_data['subjects'] = selected_subjects
-                if update_user_data(user_data):
+                if update_user_data({'subjects': selected_subjects}):
                     st.success("Subjects updated successfully!")
                 else:
                     st.error("Failed to update subjects.")
@@ -519,8 +1101,8 @@ def tutor_page():
         return
 
     user_data = st.session_state.user_data
-    current_tokens = user_data.get('tokens', 0)
-    st.sidebar.metric("Tokens Remaining", current_tokens)
+    meter = st.sidebar.empty()
+    show_token_meter(meter)
 
     st.sidebar.header("Your Settings")
     st.sidebar.write(f"**Username:** {user_data.get('username', 'N/A')}")
@@ -538,10 +1120,24 @@ def tutor_page():
         "Agricultural Science", "Chemistry", "Human and Social Biology",
         "Physics", "Social Studies", "Principles of Business", "Geography"
     ]
+    start_tts_warmup(tuple(available_study_subjects)) # No-op after the first call in this process
 
     # --- Subject Selection for Today's Study Session ---
     # Only show this block if a subject hasn't been selected or context not loaded
     if not st.session_state.current_study_subject or not st.session_state.subject_context_loaded:
+        # Offer to continue the last stored session (metadata only; its messages are paged in on resume)
+        if st.session_state.chat_session_id and st.session_state.resumable_session is None:
+            st.session_state.resumable_session = load_session(db, st.session_state.username, st.session_state.chat_session_id) or {}
+        resumable = st.session_state.resumable_session
+        if resumable and resumable.get('subject') in available_study_subjects:
+            if st.button(f"Continue your {resumable['subject']} session"):
+                if not activate_subject(resumable['subject']):
+                    st.stop() # Stop execution to show error
+                st.session_state.prompt_ref = {k: resumable.get(k) for k in ('subject', 'syllabus_version', 'grade', 'prompt_version')}
+                resume_chat_session(resumable)
+                st.session_state.subject_context_loaded = True
+                st.rerun()
+
         st.subheader("Which subject do you want to study today?")
         with st.form("study_subject_form"):
             selected_subject_for_session = st.selectbox(
@@ -552,264 +1148,45 @@ def tutor_page():
             start_session_button = st.form_submit_button("Start Study Session")
 
             if start_session_button: # Check if button is clicked
-                print(f"DEBUG: 'Start Study Session' button clicked.") # Debug print
                 if selected_subject_for_session == "-- Select a Subject --":
                     st.warning("Please select a valid subject to start your study session.")
-                    print("DEBUG: Invalid subject selected.") # Debug print
                     st.stop() # Stop execution to show warning
                 
-                print(f"DEBUG: Selected subject: {selected_subject_for_session}") # Debug print
-                st.session_state.current_study_subject = selected_subject_for_session
-                
-                # Construct file paths for PDF syllabus and TXT context files
-                # Replace spaces and slashes for safe file names
-                subject_file_name = selected_subject_for_session.replace(" ", "_").replace("/", "-") 
-                syllabus_file_path = os.path.join("subject_context", f"syl_{subject_file_name}.pdf")
-                context_file_path = os.path.join("subject_context", f"con_{subject_file_name}.txt") # Changed to .txt
-
-                syllabus_content = ""
-                context_content = ""
-
-                # Load syllabus file (PDF)
-                syllabus_content = read_pdf_text(syllabus_file_path)
-                if syllabus_content is None: # read_pdf_text returns None on error
-                    print(f"DEBUG: Syllabus content is None. Stopping.") # Debug print
-                    st.stop() # Stop execution to show error
-                    
-                # Load context file (TXT)
-                context_content = read_text_file(context_file_path) # Changed to read_text_file
-                if context_content is None: # read_text_file returns None on error
-                    print(f"DEBUG: Context content is None. Stopping.") # Debug print
+                if not activate_subject(selected_subject_for_session):
                     st.stop() # Stop execution to show error
 
-                st.session_state.active_syllabus = syllabus_content
-                st.session_state.active_subject_context = context_content
-                st.session_state.subject_context_loaded = True
-                print(f"DEBUG: Subject context loaded successfully. current_study_subject: {st.session_state.current_study_subject}, subject_context_loaded: {st.session_state.subject_context_loaded}") # Debug print
-                
+                # The session keeps a reference to its prompt; the full text is rebuilt per request
+                st.session_state.prompt_ref = make_prompt_ref(selected_subject_for_session, syllabus_version(selected_subject_for_session), student_grade)
+
                 # Clear chat history for new subject session
-                st.session_state.chat_history = []
-                
-                # Construct the initial system prompt with all context
-                preferences_str = ", ".join([f"{k}: {v}" for k, v in user_data.get('learning_preferences', {}).items()])
-                
-                initial_system_prompt = f"""
-                You are an AI tutor specializing in {st.session_state.current_study_subject}.
-                Your responses should be tailored to the student's preferences and selected subject.
-                Student's Grade Level: {student_grade}
-                
-                **IMPORTANT INSTRUCTION FOR EQUATIONS:**
-                Whenever you present a chemical equation, mathematical formula, or any scientific notation, please format it using LaTeX.
-                Use `$$...$$` for block equations (on their own line) and `$...$` for inline equations within text.
-                For chemical symbols within LaTeX, use `\text{{Symbol}}` to ensure they are rendered as plain text (e.g., `$\text{{H}}_2\text{{O}}$` for H2O).
-                Example: The balanced equation for water formation is $$\text{{2H}}_2 + \text{{O}}_2 \rightarrow \text{{2H}}_2\text{{O}}$$
-                ---
-                Syllabus for {st.session_state.current_study_subject}:
-                {st.session_state.active_syllabus}
-                ---
-                Additional Context for {st.session_state.current_study_subject}:
-                {st.session_state.active_subject_context}
-                ---
-                Be helpful, patient, and provide clear explanations. Ensure your answers are strictly within the scope of the provided syllabus and context.
-                """
-
-                # Add the system prompt as the very first message
-                st.session_state.chat_history.append({"role": "system", "content": initial_system_prompt})
+                begin_chat_session(st.session_state.prompt_ref)
+                st.session_state.subject_context_loaded = True
 
                 # Add an initial message from the tutor to start the conversation
-                initial_tutor_message = f"Hello! Welcome to your {st.session_state.current_study_subject} study session. I'm ready to help you with any questions you have based on the syllabus and context provided. How can I assist you today?"
+                initial_tutor_message = welcome_message(st.session_state.current_study_subject)
                 st.session_state.chat_history.append({"role": "assistant", "content": initial_tutor_message})
+                st.session_state.pending_audio = text_to_speech(initial_tutor_message) # Pre-synthesized, so a cache hit
                 save_chat_history() # Save initial messages to Firestore
-                print(f"DEBUG: Initial chat history and system prompt set. Rerunning.") # Debug print
                 st.rerun() # Rerun to display chat interface
             # No else for start_session_button here, as the outer 'if' handles the display flow
     else: # Subject is selected and context loaded, so show the chat interface
-        print(f"DEBUG: Subject already selected ({st.session_state.current_study_subject}). Displaying chat interface.") # Debug print
         # --- Display Current Study Subject and Option to Change ---
         st.info(f"You are currently studying: **{st.session_state.current_study_subject}**")
         if st.button("Change Study Subject"):
-            print("DEBUG: Change Study Subject button clicked. Resetting state.") # Debug print
             st.session_state.current_study_subject = None # Reset to prompt for new selection
             st.session_state.subject_context_loaded = False
-            st.session_state.chat_history = [] # Clear history when changing subject
+            reset_chat_session() # Clear history when changing subject
             st.rerun()
             return # Return here to immediately show the subject selection form
 
-        # The student_grade selectbox is now defined at the top of tutor_page
-        # so it's always available.
-
-        # --- Chat Interface ---
-        col1, col2 = st.columns([1, 2]) # Input on left, output/history on right
-
-        with col1:
-            st.subheader("Your Input")
-            user_input = st.text_area("Type your question here:", height=150, key="user_input_area")
-            send_button = st.button("Send to Tutor")
-            
-            # New: Generate Visual Explanation button
-            generate_visual_button = st.button("Generate Visual Explanation", disabled=st.session_state.generating_image) # Disable while generating
-
-        with col2:
-            st.subheader("Session Transcript") # Changed from "Chat History"
-            chat_display_area = st.container(height=400, border=True)
-
-            # Iterate through chat history, skipping the initial system message for display
-            for chat_message in st.session_state.chat_history:
-                if chat_message["role"] == "user":
-                    chat_display_area.markdown(f"**You:** {chat_message['content']}")
-                elif chat_message["role"] == "assistant": # Only display assistant messages
-                    # Streamlit's markdown parser will automatically render LaTeX within $$...$$ or $...$
-                    chat_display_area.markdown(f"**Tutor:** {chat_message['content']}")
-                elif chat_message["role"] == "image": # Display generated images
-                    chat_display_area.image(chat_message['content'], caption="AI Generated Visual")
-            
-            # Scroll to bottom
-            st.markdown("<script>window.scrollTo(0, document.body.scrollHeight);</script>", unsafe_allow_html=True)
-
-        if send_button and user_input:
-            if current_tokens <= 0:
-                st.error("You have no tokens left! Please contact support for more.")
-                return
-
-            # Add user message to history
-            st.session_state.chat_history.append({"role": "user", "content": user_input})
-            save_chat_history() # Save history to Firestore
-
-            # Construct AI prompt context for this turn (re-using the system message already in history)
-            messages = st.session_state.chat_history
+        # Chat input, transcript and turns rerun on their own; the rest of the page only on full reruns
+        chat_panel(meter)
+        if st.session_state.image_job_id: # Polls only while a job is pending; it reruns the page when the job ends
+            image_job_status()
+        if st.session_state.image_job_error:
+            st.error(f"Failed to generate visual explanation: {st.session_state.image_job_error}")
+            st.session_state.image_job_error = None
 
-            try:
-                with st.spinner("Tutor is thinking..."):
-                    client = openai.OpenAI(api_key=openai_api_key)
-                    # Using gpt-4.1-nano for text responses
-                    response = client.chat.completions.create(
-                        model="gpt-4.1-nano", 
-                        messages=messages,
-                        max_tokens=1000, # Increased max_tokens to allow for longer responses
-                        temperature=0.7,
-                    )
-                    tutor_response = response.choices[0].message.content
-                    
-                    # Deduct actual tokens used from user's balance
-                    if response.usage:
-                        tokens_to_deduct = response.usage.total_tokens
-                        user_data['tokens'] = max(0, user_data['tokens'] - tokens_to_deduct) # Ensure tokens don't go below 0
-                        update_user_data(user_data) # Save updated tokens to Firestore
-                        st.sidebar.metric("Tokens Remaining", user_data['tokens']) # Update sidebar immediately
-                        print(f"DEBUG: Deducted {tokens_to_deduct} tokens for text response. Remaining: {user_data['tokens']}")
-                    else:
-                        print("WARNING: OpenAI API response did not contain usage information.")
-
-
-                # Add tutor response to history
-                st.session_state.chat_history.append({"role": "assistant", "content": tutor_response})
-                
-                # New: Play AI response as speech
-                audio_bytes = text_to_speech(tutor_response)
-                if audio_bytes:
-                    st.audio(audio_bytes, format='audio/mp3', start_time=0)
-
-                save_chat_history() # Save updated history to Firestore
-                st.rerun() # Rerun to update chat display and token count
-
-            except openai.APIError as e:
-                st.error(f"OpenAI API error: {e}")
-                # No token re-addition here, as the deduction only happens on successful usage retrieval
-            except Exception as e:
-                st.error(f"An unexpected error occurred: {e}")
-                # No token re-addition here, as the deduction only happens on successful usage retrieval
-
-        elif generate_visual_button:
-            # Cost for image generation (e.g., 50 tokens per image)
-            # Note: DALL-E 3 pricing is per image ($0.04 for 1024x1024 standard), not token-based by OpenAI.
-            # The 'tokens' here represent an abstract cost in the app's internal token system.
-            IMAGE_GENERATION_CREDIT_COST = 50 
-
-            # First, generate the image prompt using GPT-4.1-nano
-            last_tutor_message = ""
-            for msg in reversed(st.session_state.chat_history):
-                if msg["role"] == "assistant":
-                    last_tutor_message = msg["content"]
-                    break
-            
-            if not last_tutor_message:
-                st.warning("No recent tutor message to generate a visual from. Please ask a question first.")
-                return
-
-            # Check if user has enough tokens for both prompt generation and image credit
-            # Estimate prompt token cost (e.g., 50 tokens for prompt generation)
-            estimated_prompt_tokens = 50 
-            total_estimated_cost = estimated_prompt_tokens + IMAGE_GENERATION_CREDIT_COST
-
-            if current_tokens < total_estimated_cost:
-                st.error(f"You need at least {total_estimated_cost} tokens to generate a visual (including prompt generation). You have {current_tokens} tokens.")
-                return
-
-            image_gen_prompt = ""
-            try:
-                with st.spinner("Crafting image prompt..."):
-                    client = openai.OpenAI(api_key=openai_api_key)
-                    prompt_response = client.chat.completions.create(
-                        model="gpt-4.1-nano", # Using gpt-4.1-nano for prompt generation
-                        messages=[
-                            {"role": "system", "content": "You are an assistant that generates concise, descriptive image prompts based on provided text, suitable for a visual learner. Focus on key concepts. Max 50 words."},
-                            {"role": "user", "content": f"Generate an image prompt based on this: {last_tutor_message}"}
-                        ],
-                        max_tokens=50,
-                        temperature=0.7
-                    )
-                    image_gen_prompt = prompt_response.choices[0].message.content
-
-                    # Deduct tokens for prompt generation
-                    if prompt_response.usage:
-                        prompt_tokens_deducted = prompt_response.usage.total_tokens
-                        user_data['tokens'] = max(0, user_data['tokens'] - prompt_tokens_deducted)
-                        update_user_data(user_data)
-                        st.sidebar.metric("Tokens Remaining", user_data['tokens'])
-                        print(f"DEBUG: Deducted {prompt_tokens_deducted} tokens for image prompt generation. Remaining: {user_data['tokens']}")
-                    else:
-                        print("WARNING: OpenAI API response for image prompt generation did not contain usage information.")
-
-            except openai.APIError as e:
-                st.error(f"Error generating image prompt: {e}")
-                # No token re-addition here, as the deduction only happens on successful usage retrieval
-                return
-            except Exception as e:
-                st.error(f"An unexpected error occurred while crafting image prompt: {e}")
-                # No token re-addition here, as the deduction only happens on successful usage retrieval
-                return
-
-            if image_gen_prompt:
-                # Add a temporary message to the chat history indicating image generation is starting
-                st.session_state.chat_history.append({"role": "assistant", "content": f"Generating a visual for: '{image_gen_prompt}'"})
-                save_chat_history()
-                st.rerun() # Rerun to show the "Generating visual" message
-
-                # Call the DALL-E API via the generate_image function
-                generated_image_url = generate_image(image_gen_prompt) 
-
-                if generated_image_url:
-                    st.session_state.chat_history.append({"role": "image", "content": generated_image_url})
-                    
-                    # Deduct the fixed credit cost for the DALL-E image itself
-                    user_data['tokens'] = max(0, user_data['tokens'] - IMAGE_GENERATION_CREDIT_COST)
-                    update_user_data(user_data)
-                    st.sidebar.metric("Tokens Remaining", user_data['tokens'])
-                    print(f"DEBUG: Deducted {IMAGE_GENERATION_CREDIT_COST} credits for DALL-E image. Remaining: {user_data['tokens']}")
-
-                    save_chat_history()
-                    st.rerun() # Rerun to display the image
-                else:
-                    st.error("Failed to generate visual explanation.")
-                    # If image generation fails, consider refunding the IMAGE_GENERATION_CREDIT_COST
-                    # Note: Prompt generation tokens are already deducted.
-                    user_data['tokens'] += IMAGE_GENERATION_CREDIT_COST # Refund image credit cost
-                    update_user_data(user_data)
-                    st.sidebar.metric("Tokens Remaining", user_data['tokens'])
-                    print(f"DEBUG: Refunded {IMAGE_GENERATION_CREDIT_COST} credits due to DALL-E image generation failure. Remaining: {user_data['tokens']}")
-            else:
-                st.warning("Could not generate a suitable image prompt.")
-            
         st.markdown("---")
         if st.button("Back to Profile"):
             st.session_state.current_page = 'profile'
@@ -823,6 +1200,8 @@ def main():
     # Add the logo at the top of the sidebar
     st.sidebar.image("logo.png", use_column_width=True)
 
+    resume_login() # A refresh or reconnect starts a new session; its URL still carries the resume token
+
     if st.session_state.logged_in:
         if st.sidebar.button("Profile"):
             st.session_state.current_page = 'profile'
@@ -831,11 +1210,7 @@ def main():
             st.session_state.current_page = 'tutor'
             st.rerun()
         if st.sidebar.button("Logout"):
-            st.session_state.logged_in = False
-            st.session_state.username = None
-            st.session_state.user_data = None
-            st.session_state.chat_history = []
-            st.session_state.current_page = 'login'
+            log_out()
             st.rerun()
     else:
         if st.sidebar.button("Login"):
@@ -855,4 +1230,13 @@ def main():
         tutor_page()
 
 if __name__ == "__main__":
-    main()
+    run_state = start_telemetry()
+    # The span starts before the imports; it also ends (with status ok) when st.rerun() or st.stop() cut the run short
+    with telemetry.span("app.rerun", started_at=_script_started_at, page=st.session_state.current_page,
+                        subject=st.session_state.current_study_subject) as rerun_span, measure_payload(rerun_span):
+        if run_state.pop('cold_start', False):
+            rerun_span.set(cold_start=True, imports_ms=round((_imports_done_at - _script_started_at) * 1000, 3))
+        try:
+            main()
+        finally:
+            flush_writes() # Also when st.rerun() or st.stop() cut the run short
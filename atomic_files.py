@@ -0,0 +1,26 @@
+"""Atomic file writes for the on-disk caches and compiled artifacts.
+
+Readers of a cache file (or of a compiled syllabus) must never see it half
+written, so every write goes to a temporary file in the same directory that
+is then renamed over the target. Temporary names are unique per write, so
+sessions in one process (which share a pid) and other processes can write the
+same target at once; the last rename wins and each result is complete.
+"""
+import os
+import tempfile
+
+
+def write_atomic(file_path, data):
+    """Writes bytes to a file via a uniquely named temporary file, so readers never see partial data."""
+    directory = os.path.dirname(file_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=directory, prefix=f"{os.path.basename(file_path)}.", suffix=".tmp", delete=False)
+    try:
+        with f:
+            f.write(data)
+        os.chmod(f.name, 0o644) # NamedTemporaryFile creates it owner-only; the app may run as another user
+        os.replace(f.name, file_path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+        raise
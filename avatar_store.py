@@ -0,0 +1,168 @@
+"""Avatar storage kept out of the user document.
+
+Uploaded avatars are stored once, content-addressed by their SHA-256, behind a
+small backend interface (a Firestore side collection or the local disk). A
+thumbnail is generated at upload time; the user document only holds the
+avatar's hash and URLs, so token deductions and preference changes no longer
+rewrite image bytes and logins no longer download them.
+"""
+import base64
+import hashlib
+import io
+import os
+from abc import ABC, abstractmethod
+
+from firebase_admin import firestore
+
+from atomic_files import write_atomic
+
+THUMBNAIL_SIZE = (128, 128)
+
+# Firestore documents are capped at 1 MiB, so originals are split into parts
+FIRESTORE_PART_BYTES = 900 * 1024
+
+ORIGINAL = "original"
+THUMBNAIL = "thumb"
+
+
+def content_hash(data):
+    """Returns the hex SHA-256 used to address an avatar."""
+    return hashlib.sha256(data).hexdigest()
+
+def create_thumbnail(data):
+    """Returns a small PNG thumbnail of an uploaded image."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGBA")
+        image.thumbnail(THUMBNAIL_SIZE)
+        out = io.BytesIO()
+        image.save(out, format="PNG", optimize=True)
+        return out.getvalue()
+
+
+# --- Backends ---
+
+class AvatarStore(ABC):
+    """Interface for avatar backends. Variants are ORIGINAL and THUMBNAIL."""
+
+    @abstractmethod
+    def exists(self, avatar_hash):
+        """Returns whether an avatar is fully stored."""
+
+    @abstractmethod
+    def put(self, avatar_hash, original, thumbnail):
+        """Stores both variants of an avatar."""
+
+    @abstractmethod
+    def get(self, avatar_hash, variant=THUMBNAIL):
+        """Returns the bytes of an avatar variant, or None if it isn't stored."""
+
+    @abstractmethod
+    def url(self, avatar_hash, variant=THUMBNAIL):
+        """Returns a URL for an avatar variant."""
+
+
+class FirestoreAvatarStore(AvatarStore):
+    """Stores avatars in an `avatars` side collection, one document per hash."""
+
+    def __init__(self, db, collection='avatars'):
+        self.db = db
+        self.collection = collection
+
+    def _ref(self, avatar_hash):
+        return self.db.collection(self.collection).document(avatar_hash)
+
+    def exists(self, avatar_hash):
+        return self._ref(avatar_hash).get(field_paths=['parts']).exists
+
+    def put(self, avatar_hash, original, thumbnail):
+        ref = self._ref(avatar_hash)
+        parts = [original[i:i + FIRESTORE_PART_BYTES] for i in range(0, len(original), FIRESTORE_PART_BYTES)]
+        batch = self.db.batch()
+        for i, part in enumerate(parts):
+            batch.set(ref.collection('parts').document(str(i)), {'data': part})
+        # The parent document is written last so exists() never sees a partial avatar
+        batch.set(ref, {
+            'thumbnail': thumbnail,
+            'parts': len(parts),
+            'size': len(original),
+            'created_at': firestore.SERVER_TIMESTAMP,
+        })
+        batch.commit()
+
+    def get(self, avatar_hash, variant=THUMBNAIL):
+        ref = self._ref(avatar_hash)
+        if variant == THUMBNAIL:
+            doc = ref.get(field_paths=['thumbnail'])
+            return doc.get('thumbnail') if doc.exists else None
+        doc = ref.get(field_paths=['parts'])
+        if not doc.exists:
+            return None
+        return b"".join(ref.collection('parts').document(str(i)).get().get('data') for i in range(doc.get('parts')))
+
+    def url(self, avatar_hash, variant=THUMBNAIL):
+        return f"firestore://{self.collection}/{avatar_hash}/{variant}"
+
+
+class LocalAvatarStore(AvatarStore):
+    """Stores avatars as files on local disk (or a mounted object-store bucket)."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, avatar_hash, variant):
+        return os.path.join(self.root, avatar_hash[:2], f"{avatar_hash}.{variant}")
+
+    def exists(self, avatar_hash):
+        return os.path.exists(self._path(avatar_hash, THUMBNAIL))
+
+    def put(self, avatar_hash, original, thumbnail):
+        # Thumbnail last, since exists() checks for it
+        for variant, data in ((ORIGINAL, original), (THUMBNAIL, thumbnail)):
+            write_atomic(self._path(avatar_hash, variant), data)
+
+    def get(self, avatar_hash, variant=THUMBNAIL):
+        try:
+            with open(self._path(avatar_hash, variant), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def url(self, avatar_hash, variant=THUMBNAIL):
+        return f"file://{os.path.abspath(self._path(avatar_hash, variant))}"
+
+
+def get_avatar_store(db):
+    """Returns the configured avatar backend (AVATAR_STORE=firestore|local, default firestore)."""
+    backend = os.environ.get("AVATAR_STORE", "firestore")
+    if backend == "local":
+        return LocalAvatarStore(os.environ.get("AVATAR_STORE_DIR", "avatars"))
+    return FirestoreAvatarStore(db)
+
+
+# --- Uploads ---
+
+def save_avatar(store, data):
+    """Stores an uploaded avatar (once per distinct image) and returns the user document fields for it."""
+    avatar_hash = content_hash(data)
+    if not store.exists(avatar_hash):
+        store.put(avatar_hash, data, create_thumbnail(data))
+    return {
+        'avatar_hash': avatar_hash,
+        'avatar_url': store.url(avatar_hash, ORIGINAL),
+        'avatar_thumb_url': store.url(avatar_hash, THUMBNAIL),
+    }
+
+def migrate_legacy_avatar(store, user_ref, user_data):
+    """Moves a legacy inline avatar_b64 field into the avatar store.
+
+    user_data is updated in place. Returns True if there was an avatar to move.
+    """
+    avatar_b64 = user_data.pop('avatar_b64', None)
+    if avatar_b64 is None:
+        return False
+    avatar_fields = save_avatar(store, base64.b64decode(avatar_b64))
+    user_data.update(avatar_fields)
+    user_ref.update({**avatar_fields, 'avatar_b64': firestore.DELETE_FIELD})
+    return True
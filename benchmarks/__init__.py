@@ -0,0 +1 @@
+"""Offline benchmarks; see turn_benchmark.py."""
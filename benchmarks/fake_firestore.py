@@ -0,0 +1,214 @@
+"""In-memory stand-in for the Firestore client, for offline benchmarks.
+
+Covers the calls the chat store and token ledger make: document and
+subcollection references, get (with field projection), set (with merge),
+update, write batches, transactions (run through ``firestore.transactional``,
+as the token ledger's reserve and balance checks are), and the Increment /
+SERVER_TIMESTAMP / DELETE_FIELD sentinels. Every operation can be given an artificial latency. Operations and
+the bytes each write sends are counted.
+
+Write sizes follow Firestore's storage size rules (field names and strings
+count their UTF-8 length plus one byte, numbers and timestamps 8 bytes,
+booleans and nulls 1 byte), so the totals track what a real database would
+store and bill.
+"""
+import copy
+import threading
+import time
+import uuid
+
+from firebase_admin import firestore
+
+
+def value_size(value):
+    """Returns the Firestore storage size of a field value."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)) or value is firestore.SERVER_TIMESTAMP:
+        return 8
+    if isinstance(value, firestore.Increment):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(k.encode("utf-8")) + 1 + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(v) for v in value)
+    return 8
+
+def document_size(path, data):
+    """Returns the Firestore storage size of a document: its name, its fields and 32 bytes of overhead."""
+    name_size = sum(len(segment.encode("utf-8")) + 1 for segment in path.split("/")) + 16
+    return name_size + value_size(data) + 32
+
+
+class FakeSnapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        return copy.deepcopy(value)
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._db._operation("get")
+        data = self._db._docs.get(self.path)
+        if data is not None and field_paths is not None:
+            data = {k: v for k, v in data.items() if k in field_paths}
+        return FakeSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data, merge=False):
+        self._db._operation("set")
+        self._db._write(self.path, data, merge)
+
+    def update(self, data):
+        self._db._operation("update")
+        if self.path not in self._db._docs:
+            raise KeyError(f"No document to update: {self.path}")
+        self._db._write(self.path, data, merge=True)
+
+
+class FakeCollection:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+
+    def document(self, document_id=None):
+        return FakeDocument(self._db, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def stream(self):
+        self._db._operation("query")
+        prefix = f"{self.path}/"
+        for path in sorted(self._db._docs):
+            if path.startswith(prefix) and "/" not in path[len(prefix):]:
+                yield FakeSnapshot(FakeDocument(self._db, path), copy.deepcopy(self._db._docs[path]))
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref.path, data, merge))
+
+    def update(self, ref, data):
+        self._writes.append((ref.path, data, True))
+
+    def commit(self):
+        self._db._operation("batch_commit")
+        for path, data, merge in self._writes:
+            self._db._write(path, data, merge)
+
+
+class FakeTransaction(FakeBatch):
+    """A transaction for ``firestore.transactional``, which calls its _begin/_commit/_rollback/_clean_up hooks.
+
+    Transactions on one database run one at a time, so a transaction's reads
+    stay valid until its writes are applied on commit; it never has to retry.
+    """
+    _max_attempts = 1
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _begin(self, retry_id=None):
+        self._db._transaction_lock.acquire()
+        self._id = uuid.uuid4().hex.encode("ascii")
+        self._writes = []
+
+    def _end(self):
+        self._writes = []
+        if self._id is not None:
+            self._id = None
+            self._db._transaction_lock.release()
+
+    def _commit(self):
+        self._db._operation("transaction_commit")
+        for path, data, merge in self._writes:
+            self._db._write(path, data, merge)
+        self._end()
+        return []
+
+    def _rollback(self):
+        self._end()
+
+    def _clean_up(self):
+        self._end()
+
+
+class FakeFirestore:
+    """In-memory Firestore client with per-operation latency and write accounting."""
+
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.Lock()
+        self.counters = {"get": 0, "set": 0, "update": 0, "batch_commit": 0, "transaction_commit": 0, "query": 0,
+                         "documents_written": 0, "bytes_written": 0}
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def _operation(self, kind):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            self.counters[kind] += 1
+
+    def _write(self, path, data, merge):
+        with self._lock:
+            self.counters["documents_written"] += 1
+            self.counters["bytes_written"] += document_size(path, data)
+            current = self._docs.get(path) if merge else None
+            document = copy.deepcopy(current) if current else {}
+            for key, value in data.items():
+                if value is firestore.DELETE_FIELD:
+                    document.pop(key, None)
+                elif value is firestore.SERVER_TIMESTAMP:
+                    document[key] = time.time()
+                elif isinstance(value, firestore.Increment):
+                    document[key] = (document.get(key) or 0) + value.value
+                else:
+                    document[key] = copy.deepcopy(value)
+            self._docs[path] = document
+
+    def snapshot_counters(self):
+        """Returns a copy of the operation and write counters."""
+        with self._lock:
+            return dict(self.counters)
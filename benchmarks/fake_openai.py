@@ -0,0 +1,197 @@
+"""Local stand-in for the OpenAI chat and image APIs and for speech synthesis.
+
+Point the app's OpenAI client at it with ``base_url=server.base_url``. Chat
+completions (streamed or not) answer with generated text after a configurable
+time to first token and per-chunk delay, and report usage counted with
+token_counter, as the app's preflight counts it. A reply is cut off at
+max_tokens; its last chunk carries ``finish_reason`` "length" then, and
+"stop" otherwise. Image generations return a tiny PNG, and ``GET /tts``
+returns fake MP3 bytes.
+
+Chat and image responses carry the ``x-ratelimit-*`` headers of a per-minute
+request and token limit (``rpm``/``tpm``), counted the way the provider counts
+them (prompt plus max_tokens). A request over either limit gets a 429 with the
+same headers, so the app's scheduler and retries see what they would in
+production.
+"""
+import base64
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import token_counter
+from rate_limiter import estimate_request_tokens
+
+# 1x1 transparent PNG
+TINY_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=")
+
+FILLER_WORDS = "the cell membrane controls what enters and leaves while the nucleus holds genetic material".split()
+
+RATE_LIMIT_WINDOW_S = 60.0
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP server imitating the OpenAI endpoints the app calls."""
+
+    def __init__(self, first_token_s=0.2, chunk_s=0.005, reply_words=120, image_s=1.0, tts_s=0.3,
+                 rpm=1_000_000, tpm=1_000_000_000, host="127.0.0.1", port=0):
+        self.first_token_s = first_token_s
+        self.chunk_s = chunk_s
+        self.reply_words = reply_words
+        self.image_s = image_s
+        self.tts_s = tts_s
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = 0
+        self.rate_limited = 0
+        self._admitted = deque() # (monotonic time, tokens) of requests admitted in the last minute
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_request(self):
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    def admit(self, tokens):
+        """Counts a request against the per-minute limits. Returns (admitted, rate-limit headers)."""
+        with self._lock:
+            now = time.monotonic()
+            while self._admitted and now - self._admitted[0][0] >= RATE_LIMIT_WINDOW_S:
+                self._admitted.popleft()
+            used_tokens = sum(t for _, t in self._admitted)
+            admitted = len(self._admitted) < self.rpm and used_tokens + tokens <= self.tpm
+            if admitted:
+                self._admitted.append((now, tokens))
+                used_tokens += tokens
+            else:
+                self.rate_limited += 1
+            reset_s = RATE_LIMIT_WINDOW_S - (now - self._admitted[0][0]) if self._admitted else 0.0
+            headers = {
+                "x-ratelimit-limit-requests": str(self.rpm),
+                "x-ratelimit-remaining-requests": str(max(0, self.rpm - len(self._admitted))),
+                "x-ratelimit-reset-requests": f"{reset_s:.3f}s",
+                "x-ratelimit-limit-tokens": str(self.tpm),
+                "x-ratelimit-remaining-tokens": str(max(0, self.tpm - used_tokens)),
+                "x-ratelimit-reset-tokens": f"{reset_s:.3f}s",
+            }
+        return admitted, headers
+
+    def reply_text(self, number, max_tokens):
+        """Returns (text, finish_reason): a deterministic reply that differs per request, cut off at max_tokens like the real API.
+
+        Replies differ per request so downstream caches behave realistically.
+        """
+        words = [FILLER_WORDS[(number + i) % len(FILLER_WORDS)] for i in range(self.reply_words)]
+        text = f"Answer {number}: " + " ".join(words) + "."
+        if not max_tokens or token_counter.count_text(text) <= max_tokens:
+            return text, "stop"
+        while words and token_counter.count_text(f"Answer {number}: " + " ".join(words)) > max_tokens:
+            words.pop()
+        return f"Answer {number}: " + " ".join(words), "length"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json", headers=None):
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/tts":
+                    return self._send(404, b'{"error": {"message": "not found"}}')
+                text = parse_qs(url.query).get("text", [""])[0]
+                time.sleep(server.tts_s)
+                self._send(200, b"ID3" + text.encode("utf-8")[:64] + b"\0" * 1024, "audio/mpeg")
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["content-length"])) or b"{}")
+                if self.path.endswith("/chat/completions"):
+                    tokens = estimate_request_tokens(payload.get("messages", []), payload.get("max_tokens"))
+                elif self.path.endswith("/images/generations"):
+                    tokens = 0
+                else:
+                    return self._send(404, b'{"error": {"message": "not found"}}')
+                admitted, headers = server.admit(tokens)
+                if not admitted:
+                    body = {"error": {"message": "Rate limit reached (fake server).", "type": "requests", "code": "rate_limit_exceeded"}}
+                    return self._send(429, json.dumps(body).encode("utf-8"), headers=headers)
+                if self.path.endswith("/chat/completions"):
+                    self._chat(payload, headers)
+                else:
+                    time.sleep(server.image_s)
+                    body = {"created": int(time.time()), "data": [{"b64_json": base64.b64encode(TINY_PNG).decode("ascii")}]}
+                    self._send(200, json.dumps(body).encode("utf-8"), headers=headers)
+
+            def _chat(self, payload, headers):
+                number = server._next_request()
+                prompt_tokens = token_counter.count_messages(payload.get("messages", []))
+                text, finish_reason = server.reply_text(number, payload.get("max_tokens"))
+                completion_tokens = token_counter.count_text(text)
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                         "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": 0}}
+                base = {"id": f"chatcmpl-{number}", "created": int(time.time()), "model": payload.get("model", "fake")}
+                time.sleep(server.first_token_s)
+
+                if not payload.get("stream"):
+                    body = {**base, "object": "chat.completion", "usage": usage, "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}]}
+                    return self._send(200, json.dumps(body).encode("utf-8"), headers=headers)
+
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("transfer-encoding", "chunked")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                words = text.split(" ")
+                for i, word in enumerate(words):
+                    delta = {"content": word if i == 0 else " " + word}
+                    self._event({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                    time.sleep(server.chunk_s)
+                # Like the real API, the last choice chunk has an empty delta and says why the reply ended
+                self._event({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    self._event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _event(self, data):
+                self._chunk(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,67 @@
+"""Compares tutor page reruns recorded in telemetry logs.
+
+Run the app once with the chat panel rendered as part of the page and once as
+a fragment, doing the same things in the browser (for example: log in, ask
+five questions, load earlier messages), and log both runs' spans:
+
+    CHAT_PANEL_FRAGMENT=0 TELEMETRY_LOG=full.jsonl streamlit run app.py
+    TELEMETRY_LOG=fragment.jsonl streamlit run app.py
+    python -m benchmarks.rerun_report full.jsonl fragment.jsonl
+
+Every browser interaction on the tutor page is one rerun: either a whole page
+run (an ``app.rerun`` span with page "tutor") or a chat panel fragment run (a
+``ui.chat_panel`` span with no parent). For each log the report gives the
+count, wall time (p50/p95/total) and bytes sent to the browser
+(``payload_bytes``, mean/total) of both kinds and of all reruns together.
+"""
+import argparse
+import json
+
+from telemetry import percentile
+
+
+def rerun_kind(record, page):
+    """Returns "full", "fragment" or None for a span record."""
+    if record["name"] == "app.rerun" and record["attributes"].get("page") == page:
+        return "full"
+    if record["name"] == "ui.chat_panel" and record["parent_id"] is None:
+        return "fragment"
+    return None
+
+def summarize(records):
+    """Returns count, wall time and payload statistics for a list of rerun span records."""
+    durations = sorted(record["duration_ms"] for record in records)
+    payloads = [record["attributes"].get("payload_bytes", 0) for record in records]
+    return {
+        "count": len(records),
+        "p50_ms": percentile(durations, 0.5),
+        "p95_ms": percentile(durations, 0.95),
+        "total_ms": round(sum(durations), 3),
+        "payload_bytes_mean": round(sum(payloads) / len(payloads), 1) if payloads else 0.0,
+        "payload_bytes_total": sum(payloads),
+    }
+
+def report(path, page="tutor"):
+    """Returns {"full": ..., "fragment": ..., "all": ...} rerun statistics for one telemetry log."""
+    reruns = {"full": [], "fragment": []}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            kind = rerun_kind(record, page)
+            if kind:
+                reruns[kind].append(record)
+    result = {kind: summarize(records) for kind, records in reruns.items()}
+    result["all"] = summarize(reruns["full"] + reruns["fragment"])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare page and fragment reruns across telemetry logs.")
+    parser.add_argument("logs", nargs="+", help="TELEMETRY_LOG files, e.g. one without and one with the chat panel fragment")
+    parser.add_argument("--page", default="tutor", help="Only count whole page runs of this page")
+    args = parser.parse_args()
+
+    print(json.dumps({path: report(path, args.page) for path in args.logs}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Offline benchmark of tutor turns as a session grows.
+
+Drives the same turn logic tutor_page runs (chat_store, token_ledger,
+tutor_turn, the TTS cache) against an in-memory Firestore and a local fake of
+the OpenAI and speech APIs, so it needs no credentials or network. For every
+turn it records per-stage latency, Firestore bytes written and prompt tokens,
+and writes them as JSON:
+
+    python -m benchmarks.turn_benchmark --turns 200 --output bench.json
+    python -m benchmarks.turn_benchmark --baseline bench.json    # exit 1 on regression
+
+Stages, in the app's order: balance_check, retrieval, build_context
+(including any summary call), preflight (local token count, trimming
+retrieved sections if the prompt doesn't fit), reserve, save_question,
+first_token, chat_stream, settle, tts, save_answer, flush and turn. As in the
+app, the reservation and its settlement are committed at once, while the saves
+and summary charges only fill the session's write buffer; flush is the single
+commit that ends the turn.
+"""
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.fake_openai import FakeOpenAIServer
+from chat_store import append_messages, start_session
+from context_window import new_summary_state
+from openai_client import PooledOpenAI
+from prompt_store import build_system_prompt, make_prompt_ref
+from rate_limiter import RateLimitScheduler
+from syllabus_corpus import load_syllabus, syllabus_version
+from syllabus_retrieval import get_index
+from tts_cache import TTSCache
+from write_buffer import WriteBuffer
+import telemetry
+import token_counter
+import token_ledger
+import turn_router
+import tutor_turn
+
+USERNAME = "benchmark-student"
+STARTING_TOKENS = 10_000_000
+CHECKPOINTS = (1, 10, 25, 50, 100, 200)
+STAGES = ("balance_check", "retrieval", "build_context", "preflight", "reserve", "save_question", "first_token",
+          "chat_stream", "settle", "tts", "save_answer", "flush", "turn")
+
+# Metrics compared against a baseline, and whether they are latencies (noisier) or counts
+LATENCY_METRICS = ("p50_ms", "p95_ms")
+COUNT_METRICS = ("firestore_bytes_written", "prompt_tokens")
+# Latency changes smaller than this are timer noise, whatever the relative change
+LATENCY_SLACK_MS = 1.0
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+def make_questions(index, count):
+    """Returns count questions built from the syllabus's own section headings, cycling if needed."""
+    headings = [heading for heading, _ in index.sections] or ["this subject"]
+    return [f"Can you explain {headings[i % len(headings)].lower()}?" for i in range(count)]
+
+def make_synthesize(server):
+    """Returns a TTS synthesize function that fetches audio from the fake server."""
+    def synthesize(text, lang="en", slow=False):
+        query = urllib.parse.urlencode({"text": text, "lang": lang})
+        with urllib.request.urlopen(f"{server.base_url.rsplit('/v1', 1)[0]}/tts?{query}") as response:
+            return response.read()
+    return synthesize
+
+
+def run_session(args):
+    """Runs one session of args.turns turns and returns the per-turn measurements."""
+    server = FakeOpenAIServer(first_token_s=args.first_token_ms / 1000, chunk_s=args.chunk_ms / 1000,
+                              reply_words=args.reply_words, tts_s=args.tts_ms / 1000, rpm=args.rpm, tpm=args.tpm).start()
+    try:
+        db = FakeFirestore(latency_s=args.firestore_ms / 1000)
+        client = PooledOpenAI(api_key="benchmark", base_url=server.base_url, scheduler=RateLimitScheduler(rpm=args.rpm, tpm=args.tpm))
+        tts = TTSCache(cache_dir=tempfile.mkdtemp(prefix="tts-bench-"), synthesize_fn=make_synthesize(server))
+
+        syllabus = load_syllabus(args.subject)
+        version = syllabus_version(args.subject)
+        index = get_index(args.subject, version, syllabus)
+        prompt_ref = make_prompt_ref(args.subject, version, args.grade)
+        system_prompt = build_system_prompt(prompt_ref, args.subject_context)
+
+        db.collection('users').document(USERNAME).set({'username': USERNAME, 'tokens': STARTING_TOKENS})
+        session_id = start_session(db, USERNAME, prompt_ref)
+        chat_history = []
+        next_seq = 0
+        summary_state = new_summary_state()
+        summary_prompt_tokens = []
+        writes = WriteBuffer(db)
+
+        def summarize(previous_summary, messages, token_budget):
+            summary, usage = tutor_turn.request_summary(client, previous_summary, messages, token_budget)
+            if usage:
+                summary_prompt_tokens.append(usage.prompt_tokens)
+                token_ledger.charge(db, USERNAME, usage.total_tokens, token_ledger.SESSION_SUMMARY, model=tutor_turn.SUMMARY_MODEL,
+                                    prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, batch=writes)
+            return summary
+
+        turns = []
+        for number, question in enumerate(make_questions(index, args.turns), start=1):
+            before = db.snapshot_counters()
+            summary_prompt_tokens.clear()
+            stages = {}
+            turn_started = time.perf_counter()
+
+            def timed(stage, fn, *fn_args):
+                started = time.perf_counter()
+                result = fn(*fn_args)
+                stages[stage] = (time.perf_counter() - started) * 1000
+                return result
+
+            balance = timed("balance_check", token_ledger.check_balance, db, USERNAME)
+            route = turn_router.route_question(question, has_previous_answer=turn_router.has_previous_answer(chat_history))
+            chat_history.append({"role": "user", "content": question})
+            sections = None
+            if route.syllabus_context:
+                retrieved, report = timed("retrieval", tutor_turn.retrieval_message, args.subject, index, question, syllabus)
+                sections = tutor_turn.SectionTrimmer(args.subject, index, question, syllabus, retrieved, report)
+            else:
+                stages["retrieval"] = 0.0
+            messages = timed("build_context", tutor_turn.build_turn_messages, system_prompt, chat_history, summary_state, summarize,
+                             sections.message if sections else None)
+            messages, prompt_tokens, max_tokens = timed("preflight", token_counter.preflight, messages, route.model, route.max_tokens,
+                                                        balance, sections)
+            reserved = prompt_tokens + max_tokens
+            timed("reserve", token_ledger.reserve, db, USERNAME, reserved)
+            next_seq = timed("save_question", append_messages, db, USERNAME, session_id, chat_history[-1:], next_seq, writes)
+            with turn_router.route_span(route, max_tokens) as route_span:
+                reply, usage, stream_timings = timed("chat_stream", tutor_turn.stream_tutor_response, client, messages, None, None, None,
+                                                     route.model, max_tokens, route.temperature)
+                route_span.set(truncated=stream_timings["truncated"], **telemetry.usage_attributes(usage))
+            stages["first_token"] = stream_timings["first_token_s"] * 1000
+            timed("settle", token_ledger.charge, db, USERNAME, usage.total_tokens, token_ledger.TUTOR_CHAT, route.model,
+                  usage.prompt_tokens, usage.completion_tokens, 0, None, reserved)
+            chat_history.append({"role": "assistant", "content": reply})
+            timed("tts", tts.get, reply)
+            next_seq = timed("save_answer", append_messages, db, USERNAME, session_id, chat_history[-1:], next_seq, writes)
+            timed("flush", writes.flush)
+            stages["turn"] = (time.perf_counter() - turn_started) * 1000
+
+            after = db.snapshot_counters()
+            turns.append({
+                "turn": number,
+                "route": route.name,
+                "stages_ms": {stage: round(stages[stage], 3) for stage in STAGES},
+                "firestore_bytes_written": after["bytes_written"] - before["bytes_written"],
+                "firestore_documents_written": after["documents_written"] - before["documents_written"],
+                "firestore_operations": sum(after[k] - before[k] for k in ("get", "set", "update", "batch_commit", "transaction_commit", "query")),
+                "prompt_tokens": usage.prompt_tokens,
+                "preflight_prompt_tokens": prompt_tokens,
+                "truncated": stream_timings["truncated"],
+                "summary_prompt_tokens": sum(summary_prompt_tokens),
+                "context_messages": len(messages),
+            })
+        return turns
+    finally:
+        server.stop()
+
+def summarize_run(turns):
+    """Returns per-stage p50/p95 over all turns and the measurements at each checkpoint turn."""
+    stages = {
+        stage: {
+            "p50_ms": round(percentile([t["stages_ms"][stage] for t in turns], 0.5), 3),
+            "p95_ms": round(percentile([t["stages_ms"][stage] for t in turns], 0.95), 3),
+        }
+        for stage in STAGES
+    }
+    checkpoints = {
+        str(t["turn"]): {key: t[key] for key in ("firestore_bytes_written", "prompt_tokens", "summary_prompt_tokens", "context_messages")}
+        for t in turns if t["turn"] in CHECKPOINTS or t["turn"] == len(turns)
+    }
+    return {"stages": stages, "checkpoints": checkpoints}
+
+def compare(result, baseline, latency_tolerance, count_tolerance):
+    """Returns a list of human-readable regressions of result against baseline."""
+    regressions = []
+    for stage, metrics in baseline["summary"]["stages"].items():
+        for metric in LATENCY_METRICS:
+            old = metrics.get(metric)
+            new = result["summary"]["stages"].get(stage, {}).get(metric)
+            if old is not None and new is not None and new > old * (1 + latency_tolerance) + LATENCY_SLACK_MS:
+                regressions.append(f"{stage} {metric}: {old:.2f}ms -> {new:.2f}ms")
+    for turn, metrics in baseline["summary"]["checkpoints"].items():
+        for metric in COUNT_METRICS:
+            old = metrics.get(metric)
+            new = result["summary"]["checkpoints"].get(turn, {}).get(metric)
+            if old and new is not None and new > old * (1 + count_tolerance):
+                regressions.append(f"turn {turn} {metric}: {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline per-turn benchmark of the tutor.")
+    parser.add_argument("--turns", type=int, default=200, help="Turns in the benchmarked session")
+    parser.add_argument("--subject", default="Biology")
+    parser.add_argument("--grade", default="Form 4")
+    parser.add_argument("--subject-context", default="", help="Additional subject context put in the system prompt")
+    parser.add_argument("--first-token-ms", type=float, default=200, help="Fake chat API time to first token")
+    parser.add_argument("--chunk-ms", type=float, default=5, help="Fake chat API delay between streamed chunks")
+    parser.add_argument("--reply-words", type=int, default=120, help="Words per fake tutor reply")
+    parser.add_argument("--tts-ms", type=float, default=300, help="Fake speech synthesis latency")
+    parser.add_argument("--rpm", type=int, default=1_000_000, help="Requests per minute the rate limiter allows (default: effectively unlimited)")
+    parser.add_argument("--tpm", type=int, default=1_000_000_000, help="Tokens per minute the rate limiter allows (default: effectively unlimited)")
+    parser.add_argument("--firestore-ms", type=float, default=0, help="Latency added to every fake Firestore operation")
+    parser.add_argument("--output", help="Write the JSON result here instead of stdout")
+    parser.add_argument("--baseline", help="Compare against a previous JSON result and exit 1 on regression")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25, help="Allowed relative latency increase")
+    parser.add_argument("--count-tolerance", type=float, default=0.05, help="Allowed relative increase in bytes and tokens")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr): # Keep the app's WARNING lines out of the JSON on stdout
+        turns = run_session(args)
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "summary": summarize_run(turns),
+        "turns": turns,
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.latency_tolerance, args.count_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
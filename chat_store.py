@@ -0,0 +1,167 @@
+"""Append-only chat message storage in Firestore.
+
+Messages live in a per-user, per-session subcollection:
+
+    users/{username}/sessions/{session_id}/messages/{seq}
+
+Each message is its own document whose ID is its zero-padded sequence number,
+so a turn only writes the messages it added and the user document stays small.
+Each message document also stores its token count (see token_counter.py), so
+the count is never recomputed after the message is read back.
+The user document points at the active session through ``current_session_id``.
+
+Messages are read back a page at a time, newest first, as the transcript
+needs them. Legacy ``users/{username}.chat_history`` arrays are moved into the
+subcollection by ``migrate_legacy_chat_history`` (see user_profiles.py).
+"""
+import uuid
+
+from firebase_admin import firestore
+
+import telemetry
+import token_counter
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_WRITES = 500
+
+# Messages loaded per transcript page
+DEFAULT_PAGE_SIZE = 30
+
+
+# --- References ---
+
+def session_ref(db, username, session_id):
+    """Returns the document reference of a study session."""
+    return db.collection('users').document(username).collection('sessions').document(session_id)
+
+def message_id(seq):
+    """Returns the document ID for a message sequence number (sorts in sequence order)."""
+    return f"{seq:08d}"
+
+
+# --- Sessions and messages ---
+
+def start_session(db, username, prompt_ref):
+    """Creates a new study session for a user and makes it their current one.
+
+    prompt_ref is the session's prompt reference (see prompt_store.make_prompt_ref);
+    it is stored on the session instead of the full system prompt.
+    """
+    session_id = uuid.uuid4().hex
+    with telemetry.span("firestore.start_session", documents=2):
+        batch = db.batch()
+        batch.set(session_ref(db, username, session_id), {
+            **prompt_ref,
+            'message_count': 0,
+            'started_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        batch.set(db.collection('users').document(username), {'current_session_id': session_id}, merge=True)
+        batch.commit()
+    return session_id
+
+def _add_messages(batch, ref, messages, seq):
+    """Adds message documents numbered from seq, and the session's counter bump, to a batch. Returns the next seq."""
+    for message in messages:
+        document = {
+            'seq': seq,
+            'role': message['role'],
+            'content': message['content'],
+            'created_at': firestore.SERVER_TIMESTAMP,
+        }
+        if message['role'] != 'image': # Images are content hashes, never sent to the model
+            token_counter.annotate(message)
+            document['tokens'] = message['tokens']
+        batch.set(ref.collection('messages').document(message_id(seq)), document)
+        seq += 1
+    batch.set(ref, {
+        'message_count': firestore.Increment(len(messages)),
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    return seq
+
+def append_messages(db, username, session_id, messages, start_seq, batch=None):
+    """Appends messages to a session, numbering them from start_seq.
+
+    Only new message documents are written (plus a counter bump on the session),
+    never the existing history. Returns the next free sequence number. With a
+    batch (such as a write_buffer.WriteBuffer) the writes are only added to it,
+    and the caller commits them.
+    """
+    ref = session_ref(db, username, session_id)
+    if batch is not None:
+        return _add_messages(batch, ref, messages, start_seq)
+    seq = start_seq
+    with telemetry.span("firestore.append_messages", documents=len(messages),
+                        bytes=telemetry.text_bytes(*(m['content'] for m in messages))):
+        for offset in range(0, len(messages), MAX_BATCH_WRITES - 1):
+            batch = db.batch()
+            seq = _add_messages(batch, ref, messages[offset:offset + MAX_BATCH_WRITES - 1], seq)
+            batch.commit()
+    return seq
+
+def load_session(db, username, session_id):
+    """Loads a study session's metadata (its prompt reference and message count), or None."""
+    with telemetry.span("firestore.load_session"):
+        doc = session_ref(db, username, session_id).get(
+            field_paths=['subject', 'syllabus_version', 'grade', 'prompt_version', 'message_count']
+        )
+    return doc.to_dict() if doc.exists else None
+
+def load_message_page(db, username, session_id, before_seq=None, page_size=DEFAULT_PAGE_SIZE):
+    """Loads up to page_size messages that come before before_seq (default: the newest ones).
+
+    Messages are returned oldest first, each with its 'seq' (and its stored
+    token count, for messages saved with one).
+    """
+    query = session_ref(db, username, session_id).collection('messages').order_by('seq', direction=firestore.Query.DESCENDING)
+    if before_seq is not None:
+        query = query.start_after({'seq': before_seq})
+    with telemetry.span("firestore.load_message_page") as span:
+        docs = list(query.limit(page_size).stream())
+        page = []
+        for doc in reversed(docs):
+            data = doc.to_dict()
+            message = {'seq': data.get('seq'), 'role': data.get('role'), 'content': data.get('content')}
+            if data.get('tokens'):
+                message['tokens'] = data['tokens']
+            page.append(message)
+        span.set(documents=len(page), bytes=telemetry.text_bytes(*(m['content'] for m in page)))
+    return page
+
+
+# --- Migration ---
+
+def migrate_legacy_chat_history(db, username, user_data):
+    """Moves a legacy users/{username}.chat_history array into a session subcollection.
+
+    user_data is the user's document as a dict; it is updated in place so that
+    later merge-writes of it don't bring the array back. Returns the session ID
+    the history was moved to, or None if there was nothing to migrate.
+    """
+    if 'chat_history' not in user_data:
+        return None
+
+    # Legacy histories start with a full copy of the system prompt; sessions now
+    # rebuild it from a prompt reference, so only the conversation is kept
+    legacy_history = [m for m in (user_data.pop('chat_history') or []) if m['role'] != 'system']
+    user_ref = db.collection('users').document(username)
+    session_id = None
+    if legacy_history:
+        session_id = uuid.uuid4().hex
+        session_ref(db, username, session_id).set({
+            'subject': None, # Legacy histories never recorded their subject
+            'message_count': 0,
+            'migrated': True,
+            'started_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        append_messages(db, username, session_id, legacy_history, 0)
+        user_data['current_session_id'] = session_id
+        user_ref.update({'chat_history': firestore.DELETE_FIELD, 'current_session_id': session_id})
+    else:
+        user_ref.update({'chat_history': firestore.DELETE_FIELD})
+    span = telemetry.current_span()
+    if span:
+        span.set(migrated_messages=len(legacy_history))
+    return session_id
@@ -0,0 +1,101 @@
+"""Token-budgeted context window for tutor turns.
+
+The model sees the system prompt, a rolling summary of older turns and the
+most recent turns verbatim. The summary is updated incrementally: only turns
+that have just fallen out of the verbatim window are folded into it.
+"""
+import telemetry
+import token_counter
+
+# Number of recent user turns (question plus replies) sent verbatim
+DEFAULT_KEEP_TURNS = 6
+# Extra turns allowed to pile up before they are folded into the summary together
+DEFAULT_FOLD_BATCH_TURNS = 3
+# Upper bound on the rolling summary's length
+DEFAULT_SUMMARY_TOKEN_BUDGET = 300
+# Upper bound on everything sent per turn; the verbatim window shrinks to fit
+DEFAULT_CONTEXT_TOKEN_BUDGET = 8000
+
+# Roles the chat API understands; image entries only exist for the transcript
+MODEL_ROLES = ("system", "user", "assistant")
+
+
+def new_summary_state():
+    """Returns an empty rolling summary (nothing folded in yet)."""
+    return {"covered": 0, "text": ""}
+
+def _turn_starts(history, start):
+    """Returns the indices of user messages from position start onwards."""
+    return [i for i in range(start, len(history)) if history[i]["role"] == "user"]
+
+def _message_tokens(messages):
+    """Counts the tokens taken by a list of messages (stored per-message counts are reused)."""
+    return token_counter.count_messages(messages)
+
+def _model_message(message):
+    """Returns a message's role and content, and its stored token count so counting it again is free.
+
+    Other fields kept only for storage are dropped; the OpenAI client drops
+    the count too just before sending (see api_messages in openai_client.py).
+    """
+    return {k: message[k] for k in ("role", "content", "tokens") if k in message}
+
+def _summary_message(text):
+    """Wraps the rolling summary as a system message."""
+    return {"role": "system", "content": f"Summary of the earlier part of this study session:\n{text}"}
+
+def build_context(history, summary_state, summarize,
+                  keep_turns=DEFAULT_KEEP_TURNS,
+                  fold_batch_turns=DEFAULT_FOLD_BATCH_TURNS,
+                  summary_token_budget=DEFAULT_SUMMARY_TOKEN_BUDGET,
+                  context_token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """Builds the messages to send for the current turn.
+
+    history is the full chat history (leading system messages first).
+    summary_state is the cached rolling summary from new_summary_state(); it is
+    updated in place. summarize(previous_summary, messages, token_budget) is
+    only called when turns drop out of the verbatim window (at most every
+    fold_batch_turns turns unless the token budget forces it) and must return
+    the new summary text.
+
+    With summarize=None a draft is built instead: turns leaving the window are
+    left out without being summarized, and summary_state is not touched. The
+    app preflights the draft before it pays for a summary.
+    """
+    first = 0
+    while first < len(history) and history[first]["role"] == "system":
+        first += 1
+    system_messages = history[:first]
+
+    # Fold in batches so the summary is recomputed every few turns, not on every turn
+    base = max(summary_state["covered"], first)
+    pending_starts = _turn_starts(history, base)
+    if len(pending_starts) >= keep_turns + fold_batch_turns:
+        cut = pending_starts[-keep_turns]
+    else:
+        cut = base
+
+    # Shrink the verbatim window further if it doesn't fit the context budget
+    window_starts = [i for i in pending_starts if i >= cut]
+    fixed_tokens = _message_tokens(system_messages) + summary_token_budget
+    while len(window_starts) > 1:
+        verbatim = [m for m in history[cut:] if m["role"] in MODEL_ROLES]
+        if fixed_tokens + _message_tokens(verbatim) <= context_token_budget:
+            break
+        window_starts.pop(0)
+        cut = window_starts[0]
+
+    if cut > base and summarize is not None:
+        dropped = [m for m in history[base:cut] if m["role"] in MODEL_ROLES]
+        if dropped:
+            span = telemetry.current_span()
+            if span:
+                span.set(folded_messages=len(dropped))
+            summary_state["text"] = summarize(summary_state["text"], dropped, summary_token_budget)
+        summary_state["covered"] = cut
+
+    messages = [_model_message(m) for m in system_messages]
+    if summary_state["text"]:
+        messages.append(_summary_message(summary_state["text"]))
+    messages.extend(_model_message(m) for m in history[cut:] if m["role"] in MODEL_ROLES)
+    return messages
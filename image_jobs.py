@@ -0,0 +1,224 @@
+"""Background generation of visual explanations.
+
+Turning a tutor answer into an image takes two model calls (crafting an image
+prompt, then DALL-E), which is far too slow to run inside a Streamlit rerun.
+``ImageJobQueue`` runs them on a thread pool and hands back a job ID the page
+polls. Finished images are downloaded as bytes into a content-addressed
+``ImageCache`` (DALL-E URLs expire after an hour), and the cache also
+remembers which image was made from which tutor answer and which prompt, so
+asking for the same visual again reuses the stored image instead of paying
+for a new one.
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+from atomic_files import write_atomic
+from token_ledger import IMAGE_GENERATION, IMAGE_PROMPT
+
+PROMPT_MODEL = "gpt-4.1-nano"
+IMAGE_MODEL = "dall-e-3"
+PROMPT_MAX_TOKENS = 50
+
+# Abstract app-token price of one DALL-E image (DALL-E is billed per image, not per token)
+IMAGE_GENERATION_CREDIT_COST = 50
+
+DEFAULT_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(".cache", "images"))
+DEFAULT_WORKERS = 4
+FINISHED_JOB_TTL = 3600 # Seconds a finished job stays pollable
+
+# Job states
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+# Kinds of text the cache indexes images by
+SOURCE = "source"
+PROMPT = "prompt"
+
+
+def text_key(kind, text):
+    """Returns the index key for a piece of text images are looked up by."""
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(f"{kind}\0{normalized}".encode("utf-8")).hexdigest()
+
+def image_prompt_messages(source_text):
+    """Returns the chat messages that ask for an image prompt describing source_text."""
+    return [
+        {"role": "system", "content": "You are an assistant that generates concise, descriptive image prompts based on provided text, suitable for a visual learner. Focus on key concepts. Max 50 words."},
+        {"role": "user", "content": f"Generate an image prompt based on this: {source_text}"}
+    ]
+
+def craft_image_prompt(client, source_text, requester=None):
+    """Asks the chat model for a short image prompt describing source_text. Returns (prompt, usage)."""
+    response = client.chat(
+        model=PROMPT_MODEL,
+        messages=image_prompt_messages(source_text),
+        max_tokens=PROMPT_MAX_TOKENS,
+        temperature=0.7,
+        requester=requester,
+    )
+    return response.choices[0].message.content, response.usage
+
+def generate_image(client, prompt, requester=None, on_queue=None):
+    """Generates an image with DALL-E 3 and returns its PNG bytes."""
+    response = client.generate_image(
+        requester=requester,
+        on_queue=on_queue,
+        model=IMAGE_MODEL,
+        prompt=prompt,
+        size="1024x1024", # Standard size
+        quality="standard", # Standard quality for cost efficiency
+        n=1, # Generate one image
+        response_format="b64_json", # The bytes themselves, since returned URLs expire
+    )
+    if not response.data or not response.data[0].b64_json:
+        raise ValueError(f"DALL-E returned no image data: {response.data}")
+    return base64.b64decode(response.data[0].b64_json)
+
+
+class ImageCache:
+    """Content-addressed store of generated images, indexed by the text they were made from."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+
+    def path(self, image_hash):
+        return os.path.join(self.cache_dir, f"{image_hash}.png")
+
+    def put(self, data):
+        """Stores image bytes and returns their hash."""
+        image_hash = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.path(image_hash)):
+            write_atomic(self.path(image_hash), data)
+        return image_hash
+
+    def get(self, image_hash):
+        """Returns stored image bytes, or None if the image isn't cached."""
+        try:
+            with open(self.path(image_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def lookup(self, kind, text):
+        """Returns the hash of a cached image made from text, or None."""
+        try:
+            with open(os.path.join(self.cache_dir, "index", text_key(kind, text)), "r", encoding="utf-8") as f:
+                image_hash = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return image_hash if os.path.exists(self.path(image_hash)) else None
+
+    def remember(self, kind, text, image_hash):
+        """Records that image_hash was made from text."""
+        write_atomic(os.path.join(self.cache_dir, "index", text_key(kind, text)), image_hash.encode("utf-8"))
+
+
+class ImageJob:
+    """State of one visual explanation request, as seen by the page polling it."""
+
+    def __init__(self, job_id, charged_to=None):
+        self.id = job_id
+        self.charged_to = charged_to # Requester whose charge() pays for the job; students who join it pay nothing
+        self.status = PENDING
+        self.prompt = None
+        self.image_hash = None
+        self.reused = False # True when an existing image was reused instead of generating one
+        self.tokens_charged = 0
+        self.queue_position = None # Place in the rate limiter's line while DALL-E is waiting for quota
+        self.error = None
+        self.finished_at = None
+
+
+class ImageJobQueue:
+    """Runs visual explanation jobs on a thread pool."""
+
+    def __init__(self, client, cache=None, max_workers=DEFAULT_WORKERS):
+        self.client = client
+        self.cache = cache or ImageCache()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self._jobs = {}
+        self._inflight = {} # Source text key -> ID of the job already working on it
+        self._lock = threading.Lock()
+
+    def submit(self, source_text, charge, requester=None, settle=None):
+        """Queues a visual for source_text and returns its job ID.
+
+        charge(amount, feature, model, usage) is called from the worker thread
+        for each billable step, and settle() (if given) once there will be no
+        more, before the job is marked finished. requester identifies the
+        student to the OpenAI rate limit scheduler. A request for text that is
+        already being visualized joins the running job instead of starting
+        another; its charge is never called, and its settle is called at once.
+        """
+        key = text_key(SOURCE, source_text)
+        with self._lock:
+            self._prune()
+            job_id = self._inflight.get(key)
+            if job_id is not None:
+                if settle:
+                    settle()
+                return job_id
+            job = ImageJob(uuid.uuid4().hex, charged_to=requester)
+            self._jobs[job.id] = job
+            self._inflight[key] = job.id
+        self._pool.submit(self._run, job, key, source_text, charge, requester, settle)
+        return job.id
+
+    def get(self, job_id):
+        """Returns a job by ID, or None if it is unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        """Forgets finished jobs nobody polled within FINISHED_JOB_TTL."""
+        cutoff = time.time() - FINISHED_JOB_TTL
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def _run(self, job, key, source_text, charge, requester, settle):
+        status = FAILED
+        try:
+            with telemetry.span("image.job") as span:
+                job.image_hash = self.cache.lookup(SOURCE, source_text)
+                if job.image_hash is None:
+                    job.prompt, usage = craft_image_prompt(self.client, source_text, requester)
+                    if usage:
+                        charge(usage.total_tokens, IMAGE_PROMPT, PROMPT_MODEL, usage)
+                        job.tokens_charged += usage.total_tokens
+                    job.image_hash = self.cache.lookup(PROMPT, job.prompt)
+                    if job.image_hash is None:
+                        on_queue = lambda position: setattr(job, "queue_position", position)
+                        job.image_hash = self.cache.put(generate_image(self.client, job.prompt, requester, on_queue))
+                        job.queue_position = None
+                        # The image credit is only charged once DALL-E has actually produced an image
+                        charge(IMAGE_GENERATION_CREDIT_COST, IMAGE_GENERATION, IMAGE_MODEL, None)
+                        job.tokens_charged += IMAGE_GENERATION_CREDIT_COST
+                        self.cache.remember(PROMPT, job.prompt, job.image_hash)
+                    else:
+                        job.reused = True
+                    self.cache.remember(SOURCE, source_text, job.image_hash)
+                else:
+                    job.reused = True
+                span.set(reused=job.reused, tokens=job.tokens_charged)
+            status = DONE
+        except Exception as e:
+            job.error = str(e)
+            print(f"ERROR: Image job {job.id} failed: {e}")
+        finally:
+            if settle:
+                try:
+                    settle()
+                except Exception as e:
+                    print(f"ERROR: Could not settle the charges of image job {job.id}: {e}")
+            job.status = status # Only now, so the page polling the job sees the settled balance
+            job.finished_at = time.time()
+            with self._lock:
+                self._inflight.pop(key, None)
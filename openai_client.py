@@ -0,0 +1,196 @@
+"""Process-wide OpenAI client with connection pooling, rate limiting, deadlines, retries and hedging.
+
+One ``PooledOpenAI`` is shared by every session in the process, so its
+keep-alive connections (and their TLS sessions) are reused across turns.
+Every call waits for the process-wide rate limit scheduler (rate_limiter.py)
+to admit it, and gets a deadline; 429s, 5xx responses, timeouts and connection
+errors are retried with jittered exponential backoff until it runs out.
+Idempotent non-streaming calls can be hedged: if the first attempt hasn't
+answered after ``hedge_after`` seconds a second identical request is sent and
+whichever finishes first wins.
+
+Set OPENAI_BASE_URL (or pass base_url) to point the client at a local mock
+server for testing, and OPENAI_HEDGE_AFTER (seconds) to turn hedging on.
+"""
+import contextvars
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import openai
+
+from rate_limiter import RateLimitScheduler, estimate_request_tokens, pause_seconds
+import telemetry
+
+# Connection pool limits
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 120.0 # Seconds an idle connection is kept open
+CONNECT_TIMEOUT = 5.0
+
+# Per-call deadlines (seconds), covering every retry
+CHAT_DEADLINE = 60.0
+IMAGE_DEADLINE = 120.0
+
+# Seconds before an idempotent call is hedged with a second request; unset disables hedging
+HEDGE_AFTER = float(os.environ.get("OPENAI_HEDGE_AFTER", 0)) or None
+
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+
+def create_http_client():
+    """Returns the tuned, keep-alive httpx client the OpenAI SDK sends requests through."""
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(CHAT_DEADLINE, connect=CONNECT_TIMEOUT),
+    )
+
+def api_messages(messages):
+    """Returns chat messages as the API takes them: the stored token counts the rate limiter reads are dropped."""
+    if messages is None:
+        return None
+    return [{k: v for k, v in m.items() if k != "tokens"} for m in messages]
+
+def is_retryable(error):
+    """Checks whether an OpenAI error is worth retrying (rate limits, server errors, timeouts)."""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def backoff_delay(attempt, error=None):
+    """Returns how long to wait before retry number attempt (full jitter, honouring Retry-After)."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a call could not complete before its deadline."""
+
+
+class PooledOpenAI:
+    """A shared OpenAI client that adds rate-limit scheduling, deadlines, retries and optional hedging to each call.
+
+    Every call can name its requester (the student it is made for) and pass
+    on_queue(position), which is called while the call waits for rate-limit
+    quota; see rate_limiter.py.
+    """
+
+    def __init__(self, api_key, base_url=None, hedge_workers=8, scheduler=None):
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url or os.environ.get("OPENAI_BASE_URL"),
+            http_client=create_http_client(),
+            max_retries=0, # Retries are handled here, against the call's deadline
+        )
+        self.scheduler = scheduler or RateLimitScheduler()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="openai-hedge")
+
+    def call(self, request, deadline, tokens=0, requester=None, on_queue=None):
+        """Runs request(timeout) with retries until it succeeds or deadline seconds have passed.
+
+        request must return a raw response (``with_raw_response``), whose
+        rate-limit headers are fed to the scheduler; the parsed response is
+        returned. Every attempt first waits for the scheduler to admit a
+        request costing tokens. Retries are recorded on the current span
+        (retries, retry_wait_ms and the last_retry_error).
+        """
+        give_up_at = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceededError(f"OpenAI call did not complete within {deadline:.0f}s")
+            ticket = self.scheduler.acquire(requester, tokens, remaining, on_queue)
+            if ticket is None:
+                raise DeadlineExceededError(f"OpenAI call was not admitted by the rate limiter within {deadline:.0f}s")
+            span = telemetry.current_span()
+            if span and ticket.waited_s:
+                span.set(queued_ms=round(ticket.waited_s * 1000, 3))
+            try:
+                raw = request(give_up_at - time.monotonic())
+                self.scheduler.observe_headers(raw.headers)
+                return raw.parse()
+            except openai.APIError as e:
+                response = getattr(e, "response", None)
+                headers = response.headers if response is not None else None
+                self.scheduler.observe_headers(headers)
+                if isinstance(e, openai.RateLimitError):
+                    # Hold every session's calls, not just this one, until the provider's window resets
+                    self.scheduler.pause(pause_seconds(headers) or backoff_delay(attempt + 1))
+                attempt += 1
+                if not is_retryable(e) or attempt >= MAX_ATTEMPTS:
+                    raise
+                delay = backoff_delay(attempt, e)
+                if time.monotonic() + delay >= give_up_at:
+                    raise
+                span = telemetry.current_span()
+                if span:
+                    span.set(retries=span.attributes.get("retries", 0) + 1,
+                             retry_wait_ms=round(span.attributes.get("retry_wait_ms", 0) + delay * 1000, 3),
+                             last_retry_error=f"{type(e).__name__}: {e}")
+                time.sleep(delay)
+
+    def hedged_call(self, request, deadline, hedge_after, tokens=0, requester=None):
+        """Like call(), but sends a second identical request if the first is slower than hedge_after seconds."""
+        # Attempts run in the caller's context, so their queueing and retries are recorded on the caller's span
+        primary = self._hedge_pool.submit(contextvars.copy_context().run, self.call, request, deadline, tokens, requester)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        if telemetry.current_span():
+            telemetry.current_span().set(hedged=True)
+        backup = self._hedge_pool.submit(contextvars.copy_context().run, self.call, request, max(deadline - hedge_after, 0.1), tokens, requester)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result() # The other attempt finishes in the background and is ignored
+                error = future.exception()
+        raise error
+
+    def chat(self, hedge_after=HEDGE_AFTER, deadline=CHAT_DEADLINE, requester=None, on_queue=None, **kwargs):
+        """Creates a (non-streaming) chat completion, hedged after hedge_after seconds if set.
+
+        on_queue is only used when the call isn't hedged (hedged attempts wait on worker threads).
+        """
+        tokens = estimate_request_tokens(kwargs.get("messages"), kwargs.get("max_tokens"))
+        kwargs["messages"] = api_messages(kwargs.get("messages"))
+        request = lambda timeout: self.client.chat.completions.with_raw_response.create(timeout=timeout, **kwargs)
+        with telemetry.span("openai.chat", model=kwargs.get("model")) as span:
+            if hedge_after:
+                response = self.hedged_call(request, deadline, hedge_after, tokens, requester)
+            else:
+                response = self.call(request, deadline, tokens, requester, on_queue)
+            span.set(**telemetry.usage_attributes(response.usage))
+        return response
+
+    def chat_stream(self, deadline=CHAT_DEADLINE, requester=None, on_queue=None, **kwargs):
+        """Opens a streaming chat completion; only opening the stream is retried, not a stream cut off midway."""
+        tokens = estimate_request_tokens(kwargs.get("messages"), kwargs.get("max_tokens"))
+        kwargs["messages"] = api_messages(kwargs.get("messages"))
+        with telemetry.span("openai.chat_stream_open", model=kwargs.get("model")):
+            return self.call(lambda timeout: self.client.chat.completions.with_raw_response.create(stream=True, timeout=timeout, **kwargs),
+                             deadline, tokens, requester, on_queue)
+
+    def generate_image(self, deadline=IMAGE_DEADLINE, requester=None, on_queue=None, **kwargs):
+        """Generates an image (never hedged, since every image is billed). Images use request quota, not tokens."""
+        with telemetry.span("openai.generate_image", model=kwargs.get("model")):
+            return self.call(lambda timeout: self.client.images.with_raw_response.generate(timeout=timeout, **kwargs),
+                             deadline, 0, requester, on_queue)
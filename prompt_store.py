@@ -0,0 +1,121 @@
+"""Versioned, shared system prompt templates.
+
+Sessions don't store their system prompt. They store a small reference,
+``{subject, syllabus_version, grade, prompt_version}``, and the prompt is
+rebuilt in memory from the shared template whenever a request needs it.
+Bump PROMPT_TEMPLATE_VERSION (and add a new template) instead of editing a
+template in place, so existing sessions keep rebuilding the prompt they
+started with.
+
+The provider caches prompt prefixes it has seen recently, but only for
+byte-identical prefixes. From version 2 the template starts with instructions
+shared by every subject, then the subject's context, and only then the
+per-student grade, so every student in a subject sends the same prefix. Each
+reply's ``cached_tokens`` is recorded with ``record_prompt_cache_usage`` to
+show how often that prefix is actually served from the cache. The per-subject
+totals are reported as ``stats.prompt_cache`` on the telemetry /metrics
+endpoint.
+"""
+import threading
+
+import telemetry
+
+PROMPT_TEMPLATE_VERSION = 2
+
+PROMPT_TEMPLATES = {
+    1: """You are an AI tutor specializing in {subject}.
+Your responses should be tailored to the student's preferences and selected subject.
+Student's Grade Level: {grade}
+
+**IMPORTANT INSTRUCTION FOR EQUATIONS:**
+Whenever you present a chemical equation, mathematical formula, or any scientific notation, please format it using LaTeX.
+Use `$$...$$` for block equations (on their own line) and `$...$` for inline equations within text.
+For chemical symbols within LaTeX, use `\\text{{Symbol}}` to ensure they are rendered as plain text (e.g., `$\\text{{H}}_2\\text{{O}}$` for H2O).
+Example: The balanced equation for water formation is $$\\text{{2H}}_2 + \\text{{O}}_2 \\rightarrow \\text{{2H}}_2\\text{{O}}$$
+---
+With each question you will receive the most relevant sections of the {subject} syllabus as a separate system message.
+---
+Additional Context for {subject}:
+{subject_context}
+---
+Be helpful, patient, and provide clear explanations. Ensure your answers are strictly within the scope of the provided syllabus and context.
+""",
+    # Static instructions first, then the subject, then the student: the longest possible shared prefix
+    2: """You are an AI tutor. Be helpful, patient, and provide clear explanations. Ensure your answers are strictly within the scope of the provided syllabus and context.
+
+**IMPORTANT INSTRUCTION FOR EQUATIONS:**
+Whenever you present a chemical equation, mathematical formula, or any scientific notation, please format it using LaTeX.
+Use `$$...$$` for block equations (on their own line) and `$...$` for inline equations within text.
+For chemical symbols within LaTeX, use `\\text{{Symbol}}` to ensure they are rendered as plain text (e.g., `$\\text{{H}}_2\\text{{O}}$` for H2O).
+Example: The balanced equation for water formation is $$\\text{{2H}}_2 + \\text{{O}}_2 \\rightarrow \\text{{2H}}_2\\text{{O}}$$
+---
+With each question you will receive the most relevant sections of the syllabus as a separate system message.
+---
+Subject: {subject}
+Additional Context for {subject}:
+{subject_context}
+---
+Student's Grade Level: {grade}
+Tailor your responses to the student's grade level.
+""",
+}
+
+# Rebuilt prompts
+_built_prompts = {}
+
+# Provider prompt cache usage per subject since the process started
+_prompt_cache_usage = {}
+_prompt_cache_lock = threading.Lock()
+
+
+def welcome_message(subject):
+    """Returns the tutor's fixed opening line for a study session (its speech is pre-synthesized)."""
+    return f"Hello! Welcome to your {subject} study session. I'm ready to help you with any questions you have based on the syllabus and context provided. How can I assist you today?"
+
+def make_prompt_ref(subject, syllabus_version, grade):
+    """Returns the reference a session stores instead of its full system prompt."""
+    return {
+        'subject': subject,
+        'syllabus_version': syllabus_version,
+        'grade': grade,
+        'prompt_version': PROMPT_TEMPLATE_VERSION,
+    }
+
+def canonical_text(text):
+    """Normalizes line endings and trailing whitespace, so the same content always yields the same bytes."""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+def build_system_prompt(prompt_ref, subject_context):
+    """Rebuilds the full system prompt for a session from its reference."""
+    key = (prompt_ref['prompt_version'], prompt_ref['subject'], prompt_ref['syllabus_version'], prompt_ref['grade'], subject_context)
+    prompt = _built_prompts.get(key)
+    if prompt is None:
+        prompt = PROMPT_TEMPLATES[prompt_ref['prompt_version']].format(
+            subject=prompt_ref['subject'],
+            grade=prompt_ref['grade'],
+            subject_context=canonical_text(subject_context),
+        )
+        _built_prompts[key] = prompt
+    return prompt
+
+def record_prompt_cache_usage(subject, usage):
+    """Adds one reply's prompt and cached prompt token counts to the subject's running totals."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    with _prompt_cache_lock:
+        totals = _prompt_cache_usage.setdefault(subject, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        totals["requests"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+    return cached_tokens
+
+def prompt_cache_stats():
+    """Returns {subject: {requests, prompt_tokens, cached_tokens, hit_rate}}; hit_rate is the share of prompt tokens served from cache."""
+    with _prompt_cache_lock:
+        stats = {subject: dict(totals) for subject, totals in _prompt_cache_usage.items()}
+    for totals in stats.values():
+        totals["hit_rate"] = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+    return stats
+
+telemetry.register_stats("prompt_cache", prompt_cache_stats)
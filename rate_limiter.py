@@ -0,0 +1,190 @@
+"""Process-wide scheduler that keeps OpenAI calls inside the account's rate limits.
+
+Every call first takes a ticket from the ``RateLimitScheduler`` shared by all
+sessions in the process. A ticket is admitted once both token buckets can
+cover it: one for requests per minute and one for tokens per minute. A
+ticket's token cost is counted before the call from its messages (with the
+local tokenizer, see token_counter.py) plus max_tokens, the same way the
+provider counts it. The buckets start from
+OPENAI_RPM / OPENAI_TPM. After each response they follow the provider's
+``x-ratelimit-*`` headers, so they track the account's real limits and what
+other processes have used. A 429 pauses admissions until the provider's reset
+(see ``pause_seconds``).
+
+Waiting tickets are admitted round-robin across requesters, so one student
+sending many requests can't starve the rest of the class. While a ticket waits,
+its ``on_queue(position)`` callback is told where it stands in line.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import token_counter
+
+DEFAULT_RPM = int(os.environ.get("OPENAI_RPM", 500))
+DEFAULT_TPM = int(os.environ.get("OPENAI_TPM", 200_000))
+
+QUEUE_POLL_INTERVAL = 0.5 # Seconds between queue position updates for a waiting ticket
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value):
+    """Parses a rate-limit reset duration such as '1s', '6m0s' or '20ms' into seconds (None if unparseable)."""
+    parts = _DURATION_PART.findall(value or "")
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+def pause_seconds(headers):
+    """Returns how long a 429's headers say to wait: Retry-After, else the later of the two resets (None if unknown)."""
+    if headers is None:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    resets = [parse_reset(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    resets = [r for r in resets if r]
+    return max(resets) if resets else None
+
+def estimate_request_tokens(messages=None, max_tokens=0):
+    """Returns the tokens a chat request counts against the per-minute limit: its prompt plus max_tokens."""
+    return token_counter.count_messages(messages) + (max_tokens or 0)
+
+
+class TokenBucket:
+    """A bucket of capacity units that refills at capacity per period seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.period = period
+        self.level = float(capacity)
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / self.period)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Returns how many seconds until amount units are available (0 if they are now)."""
+        self.refill(now)
+        amount = min(amount, self.capacity) # A request larger than the whole bucket still runs once it is full
+        return max(0.0, (amount - self.level) * self.period / self.capacity)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def observe(self, limit, remaining, now):
+        """Follows the provider's view: its limit, and whatever it says is left if that is lower than ours."""
+        self.refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class Ticket:
+    """A request waiting for (or holding) admission."""
+
+    def __init__(self, requester, tokens):
+        self.requester = requester
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.waited_s = 0.0
+
+
+class RateLimitScheduler:
+    """Admits OpenAI requests fairly across requesters, within requests- and tokens-per-minute budgets."""
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._queues = OrderedDict() # requester -> deque of tickets; key order is the round-robin order
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _admission_order(self):
+        """Returns waiting tickets in the order they will be admitted (round-robin across requesters)."""
+        order = []
+        queues = [list(q) for q in self._queues.values()]
+        depth = 0
+        while True:
+            layer = [q[depth] for q in queues if len(q) > depth]
+            if not layer:
+                return order
+            order.extend(layer)
+            depth += 1
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.requester)
+        if queue is not None:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.requester]
+        self._cond.notify_all()
+
+    def acquire(self, requester, tokens, timeout, on_queue=None):
+        """Waits until a request costing tokens may be sent. Returns the admitted Ticket, or None after timeout seconds.
+
+        on_queue(position) is called (from this thread, without the scheduler
+        locked) whenever the request has to wait and its place in line changes.
+        """
+        ticket = Ticket(requester, tokens)
+        give_up_at = ticket.enqueued_at + timeout
+        last_position = None
+        with self._cond:
+            self._queues.setdefault(requester, deque()).append(ticket)
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                order = self._admission_order()
+                position = order.index(ticket) + 1
+                if position == 1:
+                    wait_s = max(self._paused_until - now,
+                                 self.requests.wait_time(1, now),
+                                 self.tokens.wait_time(tokens, now))
+                    if wait_s <= 0:
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self._remove(ticket)
+                        if requester in self._queues:
+                            self._queues.move_to_end(requester) # This requester's next ticket waits its turn
+                        ticket.waited_s = now - ticket.enqueued_at
+                        return ticket
+                else:
+                    wait_s = QUEUE_POLL_INTERVAL
+                if now >= give_up_at:
+                    self._remove(ticket)
+                    return None
+                if position == last_position or on_queue is None:
+                    self._cond.wait(min(wait_s, QUEUE_POLL_INTERVAL, give_up_at - now))
+                    continue
+            last_position = position
+            on_queue(position)
+
+    def observe_headers(self, headers):
+        """Updates both buckets from a response's x-ratelimit-* headers (missing headers are ignored)."""
+        if headers is None:
+            return
+
+        def number(name):
+            try:
+                return int(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        with self._cond:
+            now = time.monotonic()
+            self.requests.observe(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"), now)
+            self.tokens.observe(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"), now)
+
+    def pause(self, seconds):
+        """Holds every admission for seconds (after a 429, until the provider's limit resets)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def queue_length(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
@@ -0,0 +1,235 @@
+"""Shared cache of tutor answers to context-free questions.
+
+The first question of a session has no conversation behind it, so its answer
+only depends on the subject, syllabus version, grade and the question itself.
+Answers are cached under that key, with the question normalized only as far
+as it can be without changing its meaning. Case, spacing and punctuation are
+ignored; every word and number is kept. A hit is answered without calling the
+model, so it costs no tokens.
+
+A question that misses exactly can still be a near-duplicate of a cached one:
+"What are the stages of photosynthesis?" and "stages of photosynthsis". Two
+questions are near-duplicates when:
+
+- their numbers, operators, question words (what, why, how...) and negations
+  are identical, in the same order ("Solve x + 3 = 7" never matches "Solve
+  x + 5 = 9", and "Why ..." never matches "How ..."), and
+- their other words, once filler words ("the", "please", "explain") are
+  dropped, pair up in order with each pair spelled within
+  ``SPELLING_SIMILARITY`` of each other after folding plurals. Plurals and
+  typos match; different terms ("mitosis" and "meiosis") don't.
+
+Entries expire after a TTL and the least recently used are evicted past
+``max_entries``. A recompiled syllabus gets a new version and so never sees
+old answers; to drop answers for other reasons, every app process can be
+told to invalidate them with:
+
+    python response_cache.py invalidate            # every subject
+    python response_cache.py invalidate Biology    # one subject
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+from atomic_files import write_atomic
+from singletons import ProcessSingleton
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 2000))
+DEFAULT_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 3600)) # Seconds
+
+# Invalidation requests ({subject or "*": unix time}), shared by every app process
+INVALIDATION_PATH = os.environ.get("RESPONSE_CACHE_INVALIDATION_PATH", os.path.join(".cache", "response_cache_invalidations.json"))
+ALL_SUBJECTS = "*"
+
+# Two words are the same term if their plural-folded spellings are at least this similar (difflib ratio)
+SPELLING_SIMILARITY = 0.88
+# Words that must match exactly, in order, for two questions to share an answer
+QUESTION_WORDS = frozenset("what why how when where which who whom whose".split())
+NEGATIONS = frozenset("not no never nor none cannot t".split()) # "t" is what's left of "don't" and "isn't"
+_OPERATOR = re.compile(r"[-+*/=^<>%×÷]")
+# Words that don't change what is asked
+FILLER_WORDS = frozenset("""
+a an the please can could would will you me i us tell explain describe give about of is are was were do does did
+""".split())
+
+
+
+def question_key(question):
+    """Returns the normalized question an answer is cached under: casefolded words, numbers and operators, single-spaced."""
+    return " ".join(re.findall(r"\w+|[-+*/=^<>%×÷]", question.casefold()))
+
+def question_shape(key):
+    """Splits a question key into (exact words, terms).
+
+    The exact words are its numbers, operators, question words and negations,
+    which a near-duplicate must repeat exactly. The terms are its other
+    non-filler words, plural-folded, which only have to be spelled alike.
+    """
+    exact, terms = [], []
+    for word in key.split():
+        if any(c.isdigit() for c in word) or _OPERATOR.fullmatch(word) or word in QUESTION_WORDS or word in NEGATIONS:
+            exact.append(word)
+        elif word not in FILLER_WORDS:
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            terms.append(word)
+    return tuple(exact), tuple(terms)
+
+def term_similarity(terms, other_terms):
+    """Returns the lowest spelling similarity of two equally long term sequences, paired in order."""
+    lowest = 1.0
+    for term, other in zip(terms, other_terms):
+        if term != other:
+            lowest = min(lowest, SequenceMatcher(None, term, other).ratio() if min(len(term), len(other)) > 3 else 0.0)
+    return lowest
+
+def read_invalidations(path=INVALIDATION_PATH):
+    """Returns {subject or ALL_SUBJECTS: unix time} of the invalidations requested so far."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def request_invalidation(subject=None, path=INVALIDATION_PATH):
+    """Tells every app process to drop cached answers for a subject (or all subjects) stored before now."""
+    invalidations = read_invalidations(path)
+    invalidations[subject or ALL_SUBJECTS] = time.time()
+    write_atomic(path, json.dumps(invalidations).encode("utf-8"))
+
+
+class ResponseCache:
+    """In-memory LRU/TTL cache of answers, keyed by the normalized question, with near-duplicate lookups."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, invalidation_path=INVALIDATION_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.invalidation_path = invalidation_path
+        self._entries = OrderedDict() # (subject, version, grade, question key) -> (answer, stored_at)
+        # (subject, version, grade, exact words, number of terms) -> {entry key: terms}; near-duplicates share a bucket
+        self._buckets = {}
+        self._invalidation_mtime = None
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "invalidated": 0}
+
+    @staticmethod
+    def _bucket(key):
+        """Returns (bucket, terms) for an entry key."""
+        exact, terms = question_shape(key[3])
+        return key[:3] + (exact, len(terms)), terms
+
+    def _drop(self, key):
+        del self._entries[key]
+        bucket, _ = self._bucket(key)
+        members = self._buckets[bucket]
+        del members[key]
+        if not members:
+            del self._buckets[bucket]
+
+    def _near_duplicate(self, key, now):
+        """Returns the key of the most similar live near-duplicate of key, or None."""
+        bucket, terms = self._bucket(key)
+        best, best_similarity = None, SPELLING_SIMILARITY
+        for other, other_terms in self._buckets.get(bucket, {}).items():
+            similarity = term_similarity(terms, other_terms)
+            if similarity >= best_similarity and now - self._entries[other][1] <= self.ttl:
+                best, best_similarity = other, similarity
+        return best
+
+    def _apply_invalidations(self):
+        """Drops entries older than any invalidation requested since the last check (one stat per call)."""
+        try:
+            mtime = os.stat(self.invalidation_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._invalidation_mtime:
+            return
+        self._invalidation_mtime = mtime
+        invalidations = read_invalidations(self.invalidation_path)
+        for key, (_, stored_at) in list(self._entries.items()):
+            cutoff = max(invalidations.get(key[0], 0), invalidations.get(ALL_SUBJECTS, 0))
+            if stored_at < cutoff:
+                self._drop(key)
+                self.counters["invalidated"] += 1
+
+    def lookup(self, subject, syllabus_version, grade, question):
+        """Returns a cached answer to question, or None."""
+        question = question_key(question)
+        if not question:
+            return None
+        key = (subject, syllabus_version, grade, question)
+        now = time.time()
+        with self._lock:
+            self._apply_invalidations()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                near = self._near_duplicate(key, now)
+                if near is None:
+                    self.counters["misses"] += 1
+                    return None
+                key, entry = near, self._entries[near]
+                self.counters["near_hits"] += 1
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def store(self, subject, syllabus_version, grade, question, answer):
+        """Caches the answer to a context-free question."""
+        question = question_key(question)
+        if not question or not answer:
+            return
+        key = (subject, syllabus_version, grade, question)
+        with self._lock:
+            self._entries[key] = (answer, time.time())
+            self._entries.move_to_end(key)
+            bucket, terms = self._bucket(key)
+            self._buckets.setdefault(bucket, {})[key] = terms
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def invalidate(self, subject=None):
+        """Drops this process's cached answers for a subject (or all subjects). Returns how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if subject is None or key[0] == subject]
+            for key in keys:
+                self._drop(key)
+            self.counters["invalidated"] += len(keys)
+        return len(keys)
+
+    def stats(self):
+        """Returns hit/miss/eviction counters (hits include near_hits), the hit rate and the number of cached answers."""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+_default_cache = ProcessSingleton(ResponseCache)
+
+def get_response_cache():
+    """Returns the process-wide response cache."""
+    return _default_cache.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tutor response cache maintenance.")
+    parser.add_argument("command", choices=["invalidate"], help="invalidate: make every app process drop its cached answers")
+    parser.add_argument("subject", nargs="?", help="Only invalidate answers for this subject")
+    args = parser.parse_args()
+
+    request_invalidation(args.subject)
+    print(f"Invalidated cached answers for {args.subject or 'every subject'}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Signed session-resume tokens and bounded password hashing.
+
+A refresh or websocket reconnect gives the browser a fresh Streamlit session.
+Rather than sending the student back through bcrypt, a successful login issues
+a resume token kept in the page URL (``?session=...``):
+
+    base64url({"u": username, "exp": unix time, "jti": token id}) . base64url(HMAC-SHA256)
+
+Checking a token is one HMAC over a few dozen bytes, done locally with no
+Firestore read. Tokens expire after SESSION_TOKEN_TTL seconds (default 12
+hours), and logging out revokes the token in this process.
+
+Tokens are signed with SESSION_TOKEN_SECRET. Set it to the same value on every
+app process. Without it each process signs with its own random secret, so
+tokens stop working after a restart.
+
+bcrypt is deliberately slow. Hashing and checking passwords go through a small
+shared thread pool (PASSWORD_WORKERS threads, default 2), so a burst of logins
+queues there instead of taking every core away from other sessions' reruns.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import telemetry
+
+TOKEN_TTL = float(os.environ.get("SESSION_TOKEN_TTL", 12 * 3600)) # Seconds
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", 2))
+PASSWORD_CHECK_TIMEOUT = 30.0 # Seconds a login waits for a free worker and the check itself
+
+_secret = None
+_secret_lock = threading.Lock()
+
+# Token IDs revoked by logout in this process, with their expiry time
+_revoked = {}
+_revoked_lock = threading.Lock()
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+
+class PasswordPoolBusyError(Exception):
+    """Raised when a password could not be hashed or checked in time because the pool is backed up."""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def get_secret():
+    """Returns the key tokens are signed with (SESSION_TOKEN_SECRET, or a random per-process key)."""
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            configured = os.environ.get("SESSION_TOKEN_SECRET")
+            if configured:
+                _secret = configured.encode("utf-8")
+            else:
+                print("WARNING: SESSION_TOKEN_SECRET is not set; resume tokens will not survive a restart.")
+                _secret = secrets.token_bytes(32)
+        return _secret
+
+def _sign(payload):
+    return hmac.new(get_secret(), payload.encode("ascii"), hashlib.sha256).digest()
+
+
+# --- Resume tokens ---
+
+def issue_token(username, ttl=TOKEN_TTL):
+    """Returns a signed token that resumes username's login until it expires."""
+    payload = _b64encode(json.dumps({
+        "u": username,
+        "exp": int(time.time() + ttl),
+        "jti": secrets.token_hex(8),
+    }, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_b64encode(_sign(payload))}"
+
+def _decode(token):
+    """Returns a token's claims if its signature is valid, otherwise None (expiry is not checked)."""
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(_b64decode(signature), _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, UnicodeError):
+        return None
+    return claims if isinstance(claims, dict) else None
+
+def verify_token(token):
+    """Returns the username a token was issued to, or None if it is malformed, forged, expired or revoked."""
+    with telemetry.span("auth.verify_token") as span:
+        claims = _decode(token or "")
+        if claims is None or claims.get("exp", 0) < time.time():
+            span.set(valid=False)
+            return None
+        with _revoked_lock:
+            revoked = claims.get("jti") in _revoked
+        span.set(valid=not revoked)
+        return None if revoked else claims.get("u")
+
+def revoke_token(token):
+    """Stops a token from resuming a login in this process (other processes honour it until it expires)."""
+    claims = _decode(token or "")
+    if claims is None:
+        return
+    now = time.time()
+    with _revoked_lock:
+        for jti in [jti for jti, exp in _revoked.items() if exp < now]:
+            del _revoked[jti] # Expired tokens are rejected anyway
+        _revoked[claims.get("jti")] = claims.get("exp", 0)
+
+
+# --- Passwords ---
+
+def get_password_pool():
+    """Returns the process-wide pool bcrypt runs on."""
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+        return _password_pool
+
+def _hashpw(password):
+    import bcrypt
+
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def _checkpw(password, hashed_password):
+    import bcrypt
+
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def _run_bounded(fn, *args, timeout):
+    """Runs fn on the password pool and waits for it; a call still queued at the timeout is dropped."""
+    future = get_password_pool().submit(fn, *args)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordPoolBusyError(f"No password worker answered within {timeout:.0f}s") from None
+
+def hash_password(password, timeout=PASSWORD_CHECK_TIMEOUT):
+    """Hashes a password with bcrypt on the password pool."""
+    with telemetry.span("auth.hash_password"):
+        return _run_bounded(_hashpw, password, timeout=timeout)
+
+def check_password(password, hashed_password, timeout=PASSWORD_CHECK_TIMEOUT):
+    """Checks a password against its bcrypt hash on the password pool.
+
+    Raises PasswordPoolBusyError if the pool is too backed up to answer within
+    timeout seconds.
+    """
+    with telemetry.span("auth.check_password"):
+        return _run_bounded(_checkpw, password, hashed_password, timeout=timeout)
@@ -0,0 +1,28 @@
+"""Objects shared by every session in the process.
+
+Streamlit runs each browser session's script in its own thread of one
+process, so caches, pools and queues that should outlive a session are kept
+at module level and created on first use. ``ProcessSingleton`` does that
+once, under a lock, however many sessions ask at the same time:
+
+    _default_cache = ProcessSingleton(TTSCache)
+
+    def get_tts_cache():
+        return _default_cache.get()
+"""
+import threading
+
+
+class ProcessSingleton:
+    """Creates an object with factory() on first use and returns that same object to every caller."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._instance is None:
+                self._instance = self._factory()
+            return self._instance
@@ -0,0 +1,431 @@
+"""Precompiled syllabus corpus.
+
+Run ``python syllabus_corpus.py`` once per deploy (or whenever a syllabus PDF
+changes) to extract every ``subject_context/syl_*.pdf`` into normalized text
+artifacts. The app then loads those artifacts through ``load_syllabus`` and
+never has to touch pypdf while a student is waiting.
+
+Each normalized artifact also gets a compressed copy, which is what
+``load_syllabus`` returns. It has the PDF furniture stripped: the running
+headers, footers and page numbers repeated on every page, copyright lines,
+dot and underscore leaders, icon-font glyphs, runs of spaces, and lines broken
+mid-sentence or mid-word. The rules only look at the text itself, so the same
+artifact always compresses to the same bytes and cached prompts stay stable.
+``--report`` prints the characters and tokens each subject saves.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from atomic_files import write_atomic
+import telemetry
+import token_counter
+
+logger = logging.getLogger(__name__) # Compile progress is shown by the CLI (or if the app configures logging); warnings always reach stderr
+
+SUBJECT_CONTEXT_DIR = "subject_context"
+COMPILED_DIR = os.path.join(SUBJECT_CONTEXT_DIR, "compiled")
+PAGE_CACHE_DIR = os.path.join(COMPILED_DIR, "pages")
+MANIFEST_PATH = os.path.join(COMPILED_DIR, "manifest.json")
+
+# Bump whenever normalize_text changes so artifacts are rebuilt from the page cache
+NORMALIZER_VERSION = 1
+# Bump whenever compress_text changes so compressed artifacts are rebuilt from the normalized ones
+COMPRESSOR_VERSION = 1
+
+# A line repeated this often (and on at least this share of pages) is page furniture, not content
+BOILERPLATE_MIN_REPEATS = 5
+BOILERPLATE_PAGE_SHARE = 0.1
+
+_COPYRIGHT_LINE = re.compile(r"^(copyright\b|©|all rights reserved)", re.IGNORECASE)
+_LEADER_ONLY_LINE = re.compile(r"^[\s._\-–—]*$")
+
+# PDFs with more pages than this are split across several workers
+PAGE_PARALLEL_THRESHOLD = 64
+PAGES_PER_TASK = 32
+
+# Decoded artifact text, keyed by artifact path.
+# Artifact names carry their source hash and versions, so an entry never goes stale.
+_artifact_texts = {}
+_artifact_texts_lock = threading.Lock()
+
+
+# --- Helpers ---
+
+def syllabus_pdf_path(subject):
+    """Returns the path of the source syllabus PDF for a subject."""
+    return os.path.join(SUBJECT_CONTEXT_DIR, f"syl_{subject}.pdf")
+
+def discover_subjects():
+    """Lists every subject that has a syllabus PDF in subject_context."""
+    subjects = []
+    for file_name in sorted(os.listdir(SUBJECT_CONTEXT_DIR)):
+        if file_name.startswith("syl_") and file_name.endswith(".pdf"):
+            subjects.append(file_name[len("syl_"):-len(".pdf")])
+    return subjects
+
+def file_sha256(file_path):
+    """Returns the hex SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def normalize_text(text):
+    """Normalizes extracted PDF text so artifacts are stable across runs."""
+    text = unicodedata.normalize("NFKC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip() + "\n"
+
+def _line_key(line):
+    """Returns a line with whitespace collapsed and case folded, for spotting repeats."""
+    return " ".join(line.split()).casefold()
+
+def _masked_key(key):
+    """Returns a line key with every number replaced by '#', so page numbers compare equal."""
+    return re.sub(r"\d+", "#", key)
+
+def _furniture_keys(lines, pages):
+    """Returns the keys of lines that repeat across pages: running titles, headers, footers and page numbers.
+
+    A line without digits is furniture if it repeats verbatim. A line with digits
+    is matched with its digits masked, and only counts as furniture if the
+    digits change almost every time, like a page number does; a repeated
+    "(2 marks)" is content.
+    """
+    threshold = max(BOILERPLATE_MIN_REPEATS, int(pages * BOILERPLATE_PAGE_SHARE))
+    exact = Counter(_line_key(line) for line in lines if line.strip())
+    masked = Counter()
+    variants = {}
+    for key in exact:
+        if any(c.isdigit() for c in key):
+            masked_key = _masked_key(key)
+            masked[masked_key] += exact[key]
+            variants[masked_key] = variants.get(masked_key, 0) + 1
+    furniture = {key for key, count in exact.items() if count >= threshold and not any(c.isdigit() for c in key)}
+    furniture.update(key for key, count in masked.items() if count >= threshold and variants[key] * 2 >= count)
+    return furniture
+
+def _joins_next(line, next_line):
+    """Checks whether next_line continues line (a sentence or word broken by the PDF's line wrapping)."""
+    return bool(line and next_line and next_line[0].islower() and re.search(r"[a-z,]$|[A-Za-z]-$", line))
+
+def compress_text(text, pages):
+    """Strips PDF furniture from normalized syllabus text. Deterministic: the same input always gives the same output."""
+    lines = text.split("\n")
+    furniture = _furniture_keys(lines, pages)
+    kept = []
+    for line in lines:
+        key = _line_key(line)
+        if key and (key in furniture or _masked_key(key) in furniture
+                    or _COPYRIGHT_LINE.match(key) or _LEADER_ONLY_LINE.match(key)):
+            continue
+        line = re.sub(r"\.{5,}", "....", line) # Dot leaders; four dots still mark a contents line
+        line = re.sub(r"_{5,}", "____", line)
+        line = re.sub(r"(?<=[a-z]) -(?=[a-z])", "-", line) # "inter -relationship"
+        line = "".join(c for c in line if unicodedata.category(c) != "Co") # Icon-font glyphs
+        line = " ".join(line.split())
+        if kept and _joins_next(kept[-1], line):
+            kept[-1] += line if kept[-1].endswith("-") else " " + line
+        else:
+            kept.append(line)
+    text = "\n".join(kept)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip() + "\n"
+
+def read_manifest():
+    """Reads the compiled corpus manifest, or an empty one if none exists."""
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(manifest):
+    """Atomically writes the compiled corpus manifest."""
+    write_atomic(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+
+def page_cache_path(page_hash):
+    """Returns where the raw extracted text of a page with this hash is cached."""
+    return os.path.join(PAGE_CACHE_DIR, f"{page_hash}.txt")
+
+def artifact_path(subject, source_sha256):
+    """Returns the artifact path for a subject compiled from a given source hash."""
+    return os.path.join(COMPILED_DIR, f"{subject}.{source_sha256[:16]}.n{NORMALIZER_VERSION}.txt")
+
+def compressed_artifact_path(subject, source_sha256):
+    """Returns the compressed artifact path for a subject compiled from a given source hash."""
+    return os.path.join(COMPILED_DIR, f"{subject}.{source_sha256[:16]}.n{NORMALIZER_VERSION}.c{COMPRESSOR_VERSION}.txt")
+
+
+# --- Worker functions (run inside the process pool) ---
+
+def _quiet_pypdf():
+    """Silences pypdf's per-font warnings, which would otherwise flood the compile log."""
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+def _hash_object(obj, hasher, seen):
+    """Feeds a PDF object, with everything it references, into hasher (each indirect object once)."""
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+    if isinstance(obj, IndirectObject):
+        if (obj.idnum, obj.generation) in seen:
+            hasher.update(f"ref {obj.idnum} {obj.generation};".encode())
+            return
+        seen.add((obj.idnum, obj.generation))
+        obj = obj.get_object()
+    if isinstance(obj, DictionaryObject):
+        hasher.update(b"<<")
+        for key in sorted(obj):
+            if key == "/Parent":
+                continue # Points back up the page tree, which holds every other page
+            hasher.update(key.encode())
+            _hash_object(obj.raw_get(key), hasher, seen)
+        hasher.update(b">>")
+        if isinstance(obj, StreamObject):
+            try:
+                hasher.update(obj.get_data())
+            except Exception: # A filter pypdf can't decode; its encoded bytes identify the stream just as well
+                hasher.update(getattr(obj, "_data", b"") or b"")
+    elif isinstance(obj, ArrayObject):
+        hasher.update(b"[")
+        for item in obj:
+            _hash_object(item, hasher, seen)
+        hasher.update(b"]")
+    else:
+        hasher.update(repr(obj).encode("utf-8"))
+    hasher.update(b";")
+
+def _hash_pages(pdf_path):
+    """Returns a content hash for every page of a PDF, without extracting text.
+
+    A page's text depends on its resources as well as its content stream: the
+    fonts' character maps, and form XObjects that draw text of their own. The
+    hash covers both, so a page whose content stream is unchanged but whose
+    fonts or forms changed is extracted again.
+    """
+    from pypdf import PdfReader
+
+    _quiet_pypdf()
+    reader = PdfReader(pdf_path)
+    page_hashes = []
+    for page in reader.pages:
+        hasher = hashlib.sha256()
+        contents = page.get_contents()
+        hasher.update(contents.get_data() if contents is not None else b"")
+        # PdfReader copies resources inherited from the page tree onto each page
+        _hash_object(page.raw_get("/Resources") if "/Resources" in page else None, hasher, set())
+        page_hashes.append(hasher.hexdigest())
+    return page_hashes
+
+def _extract_pages(pdf_path, page_indices):
+    """Extracts raw text for the given page indices of a PDF."""
+    from pypdf import PdfReader
+
+    _quiet_pypdf()
+    reader = PdfReader(pdf_path)
+    return [(index, reader.pages[index].extract_text() or "") for index in page_indices]
+
+
+# --- Compilation ---
+
+def compress_entry(subject, entry):
+    """Writes the compressed artifact for a manifest entry from its normalized artifact and records it in the entry."""
+    with open(entry["artifact"], "r", encoding="utf-8") as f:
+        text = f.read()
+    compressed = compress_text(text, entry["pages"])
+    path = compressed_artifact_path(subject, entry["sha256"])
+    write_atomic(path, compressed.encode("utf-8"))
+    entry.update({
+        "compressor": COMPRESSOR_VERSION,
+        "compressed_artifact": path,
+        "tokenizer": token_counter.tokenizer_name(),
+        "tokens": token_counter.count_text(text),
+        "compressed_chars": len(compressed),
+        "compressed_tokens": token_counter.count_text(compressed),
+    })
+    return entry
+
+def _is_compressed(entry):
+    """Checks that a manifest entry's compressed artifact exists and is current."""
+    return entry.get("compressor") == COMPRESSOR_VERSION and os.path.exists(entry.get("compressed_artifact", ""))
+
+def compile_corpus(subjects=None, force=False, max_workers=None):
+    """Compiles syllabus PDFs into normalized text artifacts and their compressed copies.
+
+    Only subjects whose source hash changed are reopened, and only pages whose
+    content hash is missing from the page cache are re-extracted. Returns the
+    list of subjects that were rebuilt.
+    """
+    subjects = subjects or discover_subjects()
+    manifest = read_manifest()
+
+    stale = {}
+    recompressed = []
+    for subject in subjects:
+        pdf_path = syllabus_pdf_path(subject)
+        source_sha256 = file_sha256(pdf_path)
+        entry = manifest.get(subject)
+        if (not force and entry and entry["sha256"] == source_sha256
+                and entry["normalizer"] == NORMALIZER_VERSION
+                and os.path.exists(entry["artifact"])):
+            if not _is_compressed(entry) or entry.get("tokenizer") != token_counter.tokenizer_name():
+                compress_entry(subject, entry) # Only the compressor (or the token counts) changed; no need to reopen the PDF
+                recompressed.append(subject)
+            logger.info("%s is up to date (%s)", subject, source_sha256[:12])
+            continue
+        stale[subject] = source_sha256
+
+    if not stale:
+        if recompressed:
+            write_manifest(manifest)
+        return recompressed
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        hash_futures = {subject: pool.submit(_hash_pages, syllabus_pdf_path(subject)) for subject in stale}
+        page_hashes = {subject: future.result() for subject, future in hash_futures.items()}
+
+        extract_futures = []
+        for subject, hashes in page_hashes.items():
+            missing = [i for i, h in enumerate(hashes) if force or not os.path.exists(page_cache_path(h))]
+            logger.info("%s: %d pages, %d to extract", subject, len(hashes), len(missing))
+            if len(hashes) > PAGE_PARALLEL_THRESHOLD:
+                chunks = [missing[i:i + PAGES_PER_TASK] for i in range(0, len(missing), PAGES_PER_TASK)]
+            else:
+                chunks = [missing] if missing else []
+            for chunk in chunks:
+                extract_futures.append((subject, pool.submit(_extract_pages, syllabus_pdf_path(subject), chunk)))
+
+        for subject, future in extract_futures:
+            for index, text in future.result():
+                write_atomic(page_cache_path(page_hashes[subject][index]), text.encode("utf-8"))
+
+    for subject, source_sha256 in stale.items():
+        pages = []
+        for page_hash in page_hashes[subject]:
+            with open(page_cache_path(page_hash), "r", encoding="utf-8") as f:
+                pages.append(f.read())
+        text = normalize_text("\n".join(pages))
+        path = artifact_path(subject, source_sha256)
+        write_atomic(path, text.encode("utf-8"))
+
+        pdf_stat = os.stat(syllabus_pdf_path(subject))
+        manifest[subject] = {
+            "sha256": source_sha256,
+            "size": pdf_stat.st_size,
+            "mtime_ns": pdf_stat.st_mtime_ns,
+            "normalizer": NORMALIZER_VERSION,
+            "artifact": path,
+            "pages": len(page_hashes[subject]),
+            "chars": len(text),
+        }
+        compress_entry(subject, manifest[subject])
+        logger.info("Compiled %s -> %s (%d chars, %d compressed)", subject, path, len(text), manifest[subject]["compressed_chars"])
+
+    write_manifest(manifest)
+    return recompressed + list(stale)
+
+
+# --- Loading ---
+
+def _is_fresh(entry, subject):
+    """Checks a manifest entry against the source PDF without hashing it."""
+    if entry is None or entry["normalizer"] != NORMALIZER_VERSION or not os.path.exists(entry["artifact"]):
+        return False
+    try:
+        pdf_stat = os.stat(syllabus_pdf_path(subject))
+    except FileNotFoundError:
+        # Deploys may ship the compiled corpus without the PDFs
+        return True
+    return pdf_stat.st_size == entry["size"] and pdf_stat.st_mtime_ns == entry["mtime_ns"]
+
+def _read_artifact(file_path):
+    """Returns an artifact's text, reading and decoding it at most once per process."""
+    with _artifact_texts_lock:
+        text = _artifact_texts.get(file_path)
+    if text is None:
+        with open(file_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with _artifact_texts_lock:
+            text = _artifact_texts.setdefault(file_path, text) # A racing reader's copy wins, so there is only one
+    return text
+
+def syllabus_version(subject):
+    """Returns the source hash the current artifact for a subject was built from."""
+    entry = read_manifest().get(subject)
+    return entry["sha256"] if entry else None
+
+def load_syllabus(subject):
+    """Returns the compiled, compressed syllabus text for a subject.
+
+    The artifact is read and decoded once per process, and every session gets
+    that same string. If the artifact is missing or older than its PDF it is compiled
+    in-process once, and if only its compressed copy is missing or stale that
+    is rebuilt from the normalized text; raises FileNotFoundError if the
+    subject has no syllabus.
+    """
+    with telemetry.span("syllabus.load", subject=subject, compiled=False) as span:
+        manifest = read_manifest()
+        entry = manifest.get(subject)
+        if not _is_fresh(entry, subject):
+            if not os.path.exists(syllabus_pdf_path(subject)):
+                raise FileNotFoundError(f"No syllabus found for {subject}")
+            logger.warning("Compiled syllabus for %s is missing or stale; compiling now.", subject)
+            with telemetry.span("syllabus.compile_pdf"):
+                compile_corpus([subject])
+            entry = read_manifest()[subject]
+            span.set(compiled=True)
+        elif not _is_compressed(entry):
+            logger.warning("Compressed syllabus for %s is missing or stale; compressing now.", subject)
+            with telemetry.span("syllabus.compress"):
+                compress_entry(subject, entry)
+                write_manifest(manifest)
+            span.set(compiled=True)
+        text = _read_artifact(entry["compressed_artifact"])
+        span.set(chars=len(text))
+    return text
+
+
+def compression_report(manifest, subjects=None):
+    """Returns report lines comparing each subject's characters and tokens before and after compression."""
+    lines = [f"{'Subject':<28}{'chars before':>14}{'chars after':>13}{'tokens before':>15}{'tokens after':>14}{'saved':>8}"]
+    for subject in subjects or sorted(manifest):
+        entry = manifest.get(subject)
+        if not entry or "compressed_chars" not in entry:
+            lines.append(f"{subject:<28}  not compiled")
+            continue
+        saved = 1 - entry["compressed_tokens"] / entry["tokens"] if entry["tokens"] else 0.0
+        lines.append(f"{subject:<28}{entry['chars']:>14,}{entry['compressed_chars']:>13,}"
+                     f"{entry['tokens']:>15,}{entry['compressed_tokens']:>14,}{saved:>8.1%}")
+    tokenizers = sorted({entry.get("tokenizer", "estimate") for entry in manifest.values() if "compressed_chars" in entry})
+    if tokenizers:
+        lines.append(f"Tokens counted with: {', '.join(tokenizers)}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompile syllabus PDFs into text artifacts.")
+    parser.add_argument("subjects", nargs="*", help="Subjects to compile (default: every syl_*.pdf)")
+    parser.add_argument("--force", action="store_true", help="Re-extract every page even if unchanged")
+    parser.add_argument("--workers", type=int, default=None, help="Process pool size (default: CPU count)")
+    parser.add_argument("--report", action="store_true", help="Only print the compression report of the compiled corpus")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not args.report:
+        rebuilt = compile_corpus(args.subjects or None, force=args.force, max_workers=args.workers)
+        print(f"Rebuilt {len(rebuilt)} subject(s): {', '.join(rebuilt) if rebuilt else 'none'}")
+    print("\n".join(compression_report(read_manifest(), args.subjects or None)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Local BM25 retrieval over syllabus sections.
+
+Instead of sending a whole syllabus with every question, the tutor splits it
+into sections at its headings, indexes them with BM25 and only injects the
+top-k sections relevant to the current question.
+"""
+import math
+import re
+from collections import Counter
+
+import telemetry
+import token_counter
+
+# BM25 parameters (standard Okapi defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+DEFAULT_TOP_K = 4
+
+# Heading-like lines seen this many times are table column headers or running
+# page titles rather than real headings
+REPEATED_HEADING_THRESHOLD = 3
+
+# Sections are merged or split so every chunk stays roughly within these bounds
+MIN_SECTION_CHARS = 400
+MAX_SECTION_CHARS = 2500
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i in is it its me of on or
+please should so that the their them this to was what when where which who
+why will with you your explain tell about give
+""".split())
+
+# Built indexes keyed by (subject, syllabus version)
+_indexes = {}
+
+
+# --- Helpers ---
+
+def tokenize(text):
+    """Splits text into lowercase search terms with stopwords removed and plurals folded."""
+    terms = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def is_heading(line):
+    """Checks whether a syllabus line looks like a section heading."""
+    stripped = line.strip()
+    if not 4 <= len(stripped) <= 90 or "...." in stripped:
+        return False
+    letters = [c for c in stripped if c.isalpha()]
+    if len(letters) < 4:
+        return False
+    # All-caps lines ("SECTION B - LIFE PROCESSES AND DISEASE", "GENERAL OBJECTIVES")
+    return sum(1 for c in letters if c.isupper()) / len(letters) > 0.9
+
+def _heading_key(line):
+    """Normalizes a heading so repeats like "SECTION A (cont'd)" count as the same line."""
+    key = re.sub(r"\(cont.?d\)", "", line, flags=re.IGNORECASE)
+    return " ".join(key.split()).upper()
+
+def split_sections(text):
+    """Splits syllabus text into (heading, body) sections at heading lines."""
+    lines = text.split("\n")
+    heading_counts = Counter(_heading_key(line) for line in lines if is_heading(line))
+
+    sections = []
+    heading = "Introduction"
+    body = []
+    for line in lines:
+        if is_heading(line):
+            if heading_counts[_heading_key(line)] >= REPEATED_HEADING_THRESHOLD:
+                continue # Column headers and running titles repeat on every page
+            if body:
+                sections.append((heading, "\n".join(body).strip()))
+                body = []
+            heading = re.sub(r"^[^\w(]+", "", line.strip()) # Drop leading bullet glyphs
+        else:
+            body.append(line)
+    if body:
+        sections.append((heading, "\n".join(body).strip()))
+
+    # Merge tiny sections into the one before them so headings don't become chunks on their own
+    merged = []
+    for heading, body in sections:
+        if merged and len(merged[-1][1]) < MIN_SECTION_CHARS:
+            prev_heading, prev_body = merged[-1]
+            merged[-1] = (prev_heading, f"{prev_body}\n{heading}\n{body}".strip())
+        elif body:
+            merged.append((heading, body))
+
+    # Split oversized sections at paragraph breaks, keeping the heading on each part
+    chunks = []
+    for heading, body in merged:
+        part = ""
+        for paragraph in body.split("\n\n"):
+            if part and len(part) + len(paragraph) > MAX_SECTION_CHARS:
+                chunks.append((heading, part.strip()))
+                part = ""
+            part += paragraph + "\n\n"
+        if part.strip():
+            chunks.append((heading, part.strip()))
+    return chunks
+
+
+# --- Index ---
+
+class SyllabusIndex:
+    """A BM25 index over the sections of one syllabus."""
+
+    def __init__(self, text):
+        self.sections = split_sections(text)
+        self.doc_terms = [Counter(tokenize(f"{heading}\n{body}")) for heading, body in self.sections]
+        self.doc_lengths = [sum(terms.values()) for terms in self.doc_terms]
+        self.avg_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0.0
+
+        document_frequency = Counter()
+        for terms in self.doc_terms:
+            document_frequency.update(terms.keys())
+        n = len(self.sections)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def score(self, query_terms, i):
+        """Returns the BM25 score of section i for the given query terms."""
+        terms = self.doc_terms[i]
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[i] / (self.avg_length or 1))
+        total = 0.0
+        for term in query_terms:
+            tf = terms.get(term)
+            if tf:
+                total += self.idf[term] * tf * (BM25_K1 + 1) / (tf + length_norm)
+        return total
+
+    def search(self, query, top_k=DEFAULT_TOP_K):
+        """Returns the top-k (heading, body) sections for a query, in syllabus order."""
+        query_terms = set(tokenize(query)) & self.idf.keys()
+        if not query_terms:
+            return []
+        scored = [(self.score(query_terms, i), i) for i in range(len(self.sections))]
+        best = sorted((s for s in scored if s[0] > 0), reverse=True)[:top_k]
+        return [self.sections[i] for _, i in sorted(best, key=lambda s: s[1])]
+
+
+def get_index(subject, version, text):
+    """Returns the BM25 index for a subject's syllabus, building it once per version."""
+    key = (subject, version)
+    index = _indexes.get(key)
+    if index is None:
+        with telemetry.span("retrieval.build_index", subject=subject) as span:
+            index = SyllabusIndex(text)
+            span.set(sections=len(index.sections))
+        _indexes[key] = index
+    return index
+
+def format_sections(sections):
+    """Formats retrieved sections for injection into the prompt."""
+    return "\n---\n".join(f"[{heading}]\n{body}" for heading, body in sections)
+
+def retrieve_context(index, query, full_syllabus, top_k=DEFAULT_TOP_K):
+    """Retrieves syllabus sections for a question and reports the prompt tokens saved.
+
+    Returns (context_text, report) where report holds the number of sections,
+    the tokens injected and the tokens saved compared with sending the full
+    syllabus.
+    """
+    sections = index.search(query, top_k=top_k)
+    context_text = format_sections(sections)
+    injected_tokens = token_counter.count_text(context_text)
+    full_tokens = token_counter.count_text(full_syllabus)
+    report = {
+        "sections": len(sections),
+        "injected_tokens": injected_tokens,
+        "full_syllabus_tokens": full_tokens,
+        "tokens_saved": full_tokens - injected_tokens,
+    }
+    return context_text, report
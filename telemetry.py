@@ -0,0 +1,291 @@
+"""Timing spans for the hot path.
+
+Each stage of a run (syllabus and context loads, Firestore reads and writes,
+OpenAI calls, TTS and the whole rerun) is wrapped in a named span:
+
+    with telemetry.span("firestore.append_messages", subject=subject) as s:
+        ...
+        s.set(documents=len(messages), bytes=size)
+
+A finished span carries its name, duration, attributes (subject, tokens,
+bytes, ...), status, and the IDs of its trace and parent span, so the spans of
+one rerun can be put back together. Spans opened inside another span inherit
+its page and subject attributes. Finished spans are handed to every
+registered sink:
+
+- ``MetricsSink`` (always on) keeps recent durations per span name and
+  reports count/p50/p95/max, plus the mean of the numeric attributes in
+  ``MEAN_ATTRIBUTES`` for spans that carry them. Set TELEMETRY_METRICS_PORT to serve that report
+  as JSON from ``http://127.0.0.1:<port>/metrics``. Counters that aren't spans
+  (such as cache hit rates) are added to it under ``stats`` by the modules
+  that keep them, through ``register_stats``.
+- ``JsonLogSink`` writes one JSON line per span. Set TELEMETRY_LOG to a file
+  path, or to ``-`` for stderr.
+
+Other sinks only need an ``emit(record)`` method; register them with
+``add_sink``.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_METRICS_WINDOW = 500 # Recent durations kept per span name
+
+# Attributes a span takes from its parent unless it sets them itself
+INHERITED_ATTRIBUTES = ("page", "subject")
+# Attributes whose mean over the recent window the metrics report includes (booleans average to a rate)
+MEAN_ATTRIBUTES = ("tokens", "prompt_tokens", "cached_tokens", "completion_tokens", "truncated", "payload_bytes", "payload_messages", "retries")
+
+# Span that is currently open in this thread (or task)
+_current_span = contextvars.ContextVar("telemetry_current_span", default=None)
+
+_sinks = []
+_sinks_lock = threading.Lock()
+_stats = {} # Name -> function returning the counters reported under that name
+_stats_lock = threading.Lock()
+_default_metrics = None
+_metrics_server = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def percentile(ordered, fraction):
+    """Returns the value at fraction of an already sorted list (0.0 if it is empty)."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+def text_bytes(*texts):
+    """Returns the UTF-8 size of some text, for the 'bytes' attribute of a span."""
+    return sum(len(text.encode("utf-8")) for text in texts if text)
+
+def usage_attributes(usage):
+    """Returns span attributes for an OpenAI usage object (empty if the API reported none)."""
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0,
+        "tokens": usage.total_tokens,
+    }
+
+
+class Span:
+    """One timed stage. Attributes can be added while it runs with set()."""
+
+    def __init__(self, name, attributes, started_at=None):
+        parent = _current_span.get()
+        self.name = name
+        self.attributes = {key: parent.attributes[key] for key in INHERITED_ATTRIBUTES if parent and key in parent.attributes}
+        self.attributes.update(attributes)
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.start_time = time.time() - (time.perf_counter() - self.started_at)
+        self.status = "ok"
+        self.error = None
+        self._token = None
+
+    def set(self, **attributes):
+        """Adds (or overwrites) attributes of the span."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if isinstance(exc, Exception): # Control flow such as Streamlit's rerun derives from BaseException
+            self.status = "error"
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.finish()
+        return False
+
+    def finish(self):
+        """Ends the span and hands its record to every sink."""
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": round(self.start_time, 6),
+            "duration_ms": round((time.perf_counter() - self.started_at) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+        if self.error:
+            record["error"] = self.error
+        emit(record)
+
+
+def span(name, started_at=None, **attributes):
+    """Returns a span to use as a context manager; started_at (a perf_counter value) backdates its start."""
+    configure()
+    return Span(name, attributes, started_at)
+
+def current_span():
+    """Returns the innermost open span, or None."""
+    return _current_span.get()
+
+
+# --- Sinks ---
+
+class MetricsSink:
+    """Keeps the most recent durations per span name for percentile reports."""
+
+    def __init__(self, window=DEFAULT_METRICS_WINDOW):
+        self.window = window
+        self._durations = {}
+        self._errors = {}
+        self._values = {} # (span name, attribute) -> recent values of a MEAN_ATTRIBUTES attribute
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self._durations.setdefault(record["name"], deque(maxlen=self.window)).append(record["duration_ms"])
+            if record["status"] != "ok":
+                self._errors[record["name"]] = self._errors.get(record["name"], 0) + 1
+            for key in MEAN_ATTRIBUTES:
+                value = record["attributes"].get(key)
+                if isinstance(value, (int, float)):
+                    self._values.setdefault((record["name"], key), deque(maxlen=self.window)).append(float(value))
+
+    def report(self):
+        """Returns {span name: {count, errors, p50_ms, p95_ms, max_ms, <attribute>_mean...}} over the recent window, slowest p95 first."""
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+            errors = dict(self._errors)
+            means = {key: sum(values) / len(values) for key, values in self._values.items()}
+        report = {
+            name: {
+                "count": len(ordered),
+                "errors": errors.get(name, 0),
+                "p50_ms": percentile(ordered, 0.5),
+                "p95_ms": percentile(ordered, 0.95),
+                "max_ms": ordered[-1] if ordered else 0.0,
+            }
+            for name, ordered in durations.items()
+        }
+        for (name, key), mean in means.items():
+            report[name][f"{key}_mean"] = round(mean, 3)
+        return dict(sorted(report.items(), key=lambda item: -item[1]["p95_ms"]))
+
+
+class JsonLogSink:
+    """Writes every span as one JSON line to a file (appending) or a stream."""
+
+    def __init__(self, target):
+        if target == "-":
+            self._stream = sys.stderr
+        else:
+            self._stream = open(target, "a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._stream.write(line + "\n")
+
+
+def add_sink(sink):
+    """Registers a sink; its emit(record) is called with every finished span."""
+    with _sinks_lock:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    with _sinks_lock:
+        _sinks.remove(sink)
+
+def emit(record):
+    """Passes a finished span record to every sink. A failing sink never breaks the traced code."""
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink.emit(record)
+        except Exception as e:
+            print(f"WARNING: Telemetry sink {type(sink).__name__} failed: {e}", file=sys.stderr)
+
+def get_metrics():
+    """Returns the process-wide metrics sink."""
+    configure()
+    return _default_metrics
+
+def register_stats(name, report):
+    """Adds report()'s result to the metrics report as stats[name]; report must be cheap and thread-safe."""
+    with _stats_lock:
+        _stats[name] = report
+
+def stats_report():
+    """Returns {name: counters} from every registered stats function. A failing one never breaks the report."""
+    with _stats_lock:
+        reports = dict(_stats)
+    stats = {}
+    for name, report in sorted(reports.items()):
+        try:
+            stats[name] = report()
+        except Exception as e:
+            stats[name] = {"error": str(e)}
+    return stats
+
+def metrics_report():
+    """Returns the span report plus the registered stats, as served on /metrics."""
+    return {**get_metrics().report(), "stats": stats_report()}
+
+
+# --- Metrics endpoint ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(metrics_report(), indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would otherwise flood the app log
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serves the metrics report as JSON on http://host:port/metrics from a background thread."""
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=_metrics_server.serve_forever, name="telemetry-metrics", daemon=True).start()
+    return _metrics_server
+
+
+def configure():
+    """Sets up the default sinks from the environment, once per process."""
+    global _configured, _default_metrics
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        _default_metrics = MetricsSink()
+        add_sink(_default_metrics)
+        log_target = os.environ.get("TELEMETRY_LOG")
+        if log_target:
+            add_sink(JsonLogSink(log_target))
+        port = os.environ.get("TELEMETRY_METRICS_PORT")
+        if port:
+            try:
+                serve_metrics(int(port))
+            except OSError as e:
+                # Another process (e.g. a second Streamlit worker) already holds the port
+                print(f"WARNING: Telemetry metrics endpoint not started on port {port}: {e}", file=sys.stderr)
+        _configured = True
@@ -0,0 +1,74 @@
+"""Preflight trims retrieved syllabus sections before it rejects a question."""
+import pytest
+
+import token_counter
+import tutor_turn
+from context_window import new_summary_state
+from syllabus_retrieval import SyllabusIndex
+
+SUBJECT = "Geography"
+QUESTION = "How does river erosion shape a valley?"
+NEW_STUDENT_BALANCE = 1000
+
+
+def filler(words, size=300):
+    """Returns about size words of body text, cycling through words."""
+    return " ".join(words[i % len(words)] for i in range(size))
+
+# Ranked for QUESTION: RIVERS (river and erosion throughout), then COASTS (erosion), then WEATHER (one river)
+SYLLABUS = "\n".join([
+    "RIVERS AND DRAINAGE",
+    filler(["river", "erosion", "valley", "landform", "channel", "meander"]),
+    "COASTS AND SHORELINES",
+    filler(["erosion", "headland", "landform", "beach", "cliff", "spit", "stack", "arch"]),
+    "WEATHER AND CLIMATE",
+    "river " + filler(["rainfall", "pressure", "humidity", "temperature", "cloud", "front"]),
+    "POPULATION AND SETTLEMENT",
+    filler(["census", "migration", "density", "urban", "rural", "growth"]),
+])
+RANKING = ["RIVERS AND DRAINAGE", "COASTS AND SHORELINES", "WEATHER AND CLIMATE"]
+SYSTEM_PROMPT = filler(["You", "are", "a", "patient", "Geography", "tutor."], size=150)
+
+
+def turn(top_k=3):
+    """Returns (messages, trimmer) for QUESTION with top_k retrieved sections."""
+    index = SyllabusIndex(SYLLABUS)
+    message, report = tutor_turn.retrieval_message(SUBJECT, index, QUESTION, SYLLABUS, top_k=top_k)
+    trimmer = tutor_turn.SectionTrimmer(SUBJECT, index, QUESTION, SYLLABUS, message, report)
+    history = [{"role": "user", "content": QUESTION}]
+    return tutor_turn.build_turn_messages(SYSTEM_PROMPT, history, new_summary_state(), None, message), trimmer
+
+def kept_headings(trimmer):
+    return [heading for heading in RANKING if trimmer.message and f"[{heading}]" in trimmer.message["content"]]
+
+
+def test_full_prompt_does_not_fit_a_new_balance():
+    messages, trimmer = turn()
+    assert trimmer.report["sections"] == 3
+    assert token_counter.count_messages(messages) > NEW_STUDENT_BALANCE
+    with pytest.raises(token_counter.PreflightError):
+        token_counter.preflight(messages, tutor_turn.TUTOR_MODEL, tutor_turn.TUTOR_MAX_TOKENS, NEW_STUDENT_BALANCE)
+
+def test_sections_are_trimmed_until_the_prompt_fits():
+    messages, trimmer = turn()
+    fitted, prompt_tokens, max_tokens = token_counter.preflight(
+        messages, tutor_turn.TUTOR_MODEL, tutor_turn.TUTOR_MAX_TOKENS, NEW_STUDENT_BALANCE, trim=trimmer)
+    assert trimmer.dropped >= 1
+    assert prompt_tokens == token_counter.count_messages(fitted)
+    assert prompt_tokens + max_tokens <= NEW_STUDENT_BALANCE
+    assert max_tokens >= token_counter.MIN_REPLY_TOKENS
+    assert fitted[-1]["content"] == QUESTION
+    # The best sections stay: what is left is a prefix of the ranking
+    assert kept_headings(trimmer) == RANKING[:trimmer.report["sections"]]
+
+def test_lowest_ranked_section_is_dropped_first():
+    messages, trimmer = turn()
+    trimmed = trimmer(messages)
+    assert kept_headings(trimmer) == RANKING[:2]
+    assert trimmer.message in trimmed and len(trimmed) == len(messages)
+
+def test_rejects_once_there_is_nothing_left_to_drop():
+    messages, trimmer = turn(top_k=1)
+    with pytest.raises(token_counter.PreflightError):
+        token_counter.preflight(messages, tutor_turn.TUTOR_MODEL, tutor_turn.TUTOR_MAX_TOKENS, 100, trim=trimmer)
+    assert trimmer.message is None and trimmer.report["sections"] == 0
@@ -0,0 +1,75 @@
+"""Near-duplicate questions share cached answers only when they ask the same thing."""
+import pytest
+
+from response_cache import ResponseCache, SPELLING_SIMILARITY, question_key, question_shape, term_similarity
+
+SUBJECT = "Biology"
+VERSION = "v1"
+GRADE = 9
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(invalidation_path=str(tmp_path / "invalidations.json"))
+
+def cached(cache, stored, asked):
+    """Stores an answer to stored, then returns what asked gets from the cache."""
+    cache.store(SUBJECT, VERSION, GRADE, stored, f"answer to {stored}")
+    return cache.lookup(SUBJECT, VERSION, GRADE, asked)
+
+
+def test_exact_hit(cache):
+    assert cached(cache, "What is photosynthesis?", "what is  PHOTOSYNTHESIS") == "answer to What is photosynthesis?"
+    assert cache.stats()["near_hits"] == 0
+
+@pytest.mark.parametrize("asked", [
+    "What are the stages of photosynthesis",     # same words
+    "Please explain what the stage of photosynthesis are",  # filler and plural
+    "what are the stages of photosynthsis?",     # typo
+])
+def test_near_duplicate_hit(cache, asked):
+    assert cached(cache, "What are the stages of photosynthesis?", asked) is not None
+
+def test_near_hits_are_counted(cache):
+    cached(cache, "What are the stages of photosynthesis?", "what are the stages of photosynthsis")
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["near_hits"] == 1 and stats["hit_rate"] == 1.0
+
+def test_numbers_gate(cache):
+    assert cached(cache, "Solve x + 3 = 7", "Solve x + 5 = 9") is None
+    assert cached(cache, "How many chromosomes do 2 cells have", "How many chromosomes do 4 cells have") is None
+
+def test_operators_gate(cache):
+    assert cached(cache, "Simplify a + b", "Simplify a - b") is None
+    assert cached(cache, "Simplify a + b", "Simplify a × b") is None
+
+def test_question_words_gate(cache):
+    assert cached(cache, "Why do leaves change colour?", "How do leaves change colour?") is None
+    assert cached(cache, "Why do leaves change colour?", "Do leaves change colour?") is None
+
+def test_negations_gate(cache):
+    assert cached(cache, "Why can plants make food?", "Why can't plants make food?") is None
+    assert cached(cache, "Is a virus alive?", "Is a virus not alive?") is None
+
+def test_similarity_threshold(cache):
+    # One letter off in a long word clears the threshold; a different term doesn't
+    assert term_similarity(("photosynthesis",), ("photosynthsis",)) >= SPELLING_SIMILARITY
+    assert term_similarity(("mitosis",), ("meiosis",)) < SPELLING_SIMILARITY
+    assert cached(cache, "What happens in mitosis?", "What happens in meiosis?") is None
+    # Short words must match exactly
+    assert cached(cache, "What is DNA?", "What is RNA?") is None
+
+def test_gates_keep_their_order():
+    assert question_shape(question_key("x - 3 = 7"))[0] == ("-", "3", "=", "7")
+    assert question_shape(question_key("x = 7 - 3"))[0] == ("=", "7", "-", "3")
+
+def test_near_duplicates_stay_within_subject_and_grade(cache):
+    cache.store(SUBJECT, VERSION, GRADE, "What are the stages of photosynthesis?", "answer")
+    assert cache.lookup("Chemistry", VERSION, GRADE, "what are the stages of photosynthsis") is None
+    assert cache.lookup(SUBJECT, VERSION, GRADE + 1, "what are the stages of photosynthsis") is None
+
+def test_evicted_answers_are_not_near_hits(tmp_path):
+    cache = ResponseCache(max_entries=1, invalidation_path=str(tmp_path / "invalidations.json"))
+    cache.store(SUBJECT, VERSION, GRADE, "What are the stages of photosynthesis?", "answer")
+    cache.store(SUBJECT, VERSION, GRADE, "What is respiration?", "other")
+    assert cache.lookup(SUBJECT, VERSION, GRADE, "what are the stages of photosynthsis") is None
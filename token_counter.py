@@ -0,0 +1,136 @@
+"""Local token counts for preflight checks.
+
+Requests are counted with the model's own tokenizer (tiktoken's o200k_base,
+used by the gpt-4.1 and gpt-4o families) before they are sent, so a request
+that can't fit the model's context or the student's balance is stopped here
+instead of failing, or overdrawing, at the provider.
+
+Counting is cheap but not free, so it is done once per message. Every stored
+chat message carries its count in a ``tokens`` field (``{tokenizer: count}``),
+which is written with the message to Firestore and read back with it. Other
+text, such as the system prompt, is counted through an in-process cache.
+Without tiktoken installed, counts fall back to ~4 characters per token and
+are labelled ``estimate``, so they are never mistaken for exact ones.
+"""
+import math
+import threading
+from functools import lru_cache
+
+import telemetry
+
+ENCODING = "o200k_base"
+ESTIMATE = "estimate" # Tokenizer name of the characters/4 fallback
+
+# Tokens the provider adds per message (role and separators) and once to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+
+# Context windows (prompt plus reply) of the models the app calls
+CONTEXT_LIMITS = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+}
+DEFAULT_CONTEXT_LIMIT = 128_000
+
+# A reply capped below this isn't worth paying the prompt for
+MIN_REPLY_TOKENS = 50
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+class PreflightError(Exception):
+    """Raised when a request can't be sent: its prompt leaves no room for a reply in the context or balance."""
+
+    def __init__(self, message, prompt_tokens, available):
+        super().__init__(message)
+        self.prompt_tokens = prompt_tokens
+        self.available = available
+
+
+def get_encoding():
+    """Returns the tiktoken encoding, or None if tiktoken isn't installed (loaded once per process)."""
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(ENCODING)
+            except Exception as e: # Not installed, or its encoding file can't be fetched
+                print(f"WARNING: tiktoken unavailable ({e}); token counts are estimates.")
+            _encoding_loaded = True
+        return _encoding
+
+def tokenizer_name():
+    """Returns the name counts are currently made with (the encoding, or 'estimate')."""
+    return ENCODING if get_encoding() is not None else ESTIMATE
+
+@lru_cache(maxsize=8192)
+def count_text(text):
+    """Returns the number of tokens in a piece of text."""
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def message_tokens(message):
+    """Returns a message's content tokens, from its stored count if it has one for the current tokenizer."""
+    stored = message.get("tokens")
+    if isinstance(stored, dict) and tokenizer_name() in stored:
+        return stored[tokenizer_name()]
+    return count_text(message.get("content") or "")
+
+def annotate(message):
+    """Stores a message's token count on it (as {tokenizer: count}) and returns the count."""
+    count = message_tokens(message)
+    message["tokens"] = {tokenizer_name(): count}
+    return count
+
+def count_messages(messages):
+    """Returns the prompt tokens a list of chat messages costs, including per-message overhead."""
+    if not messages:
+        return 0
+    return sum(message_tokens(m) + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_PRIMING_TOKENS
+
+def context_limit(model):
+    return CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+
+def preflight(messages, model, max_tokens, balance=None, trim=None):
+    """Counts a request and fits it within the model's context and the balance.
+
+    While the prompt leaves fewer than MIN_REPLY_TOKENS for the reply, it is
+    passed to trim(messages) (if given), which returns a smaller list of
+    messages, or None once there is nothing left it can drop. Returns
+    (messages, prompt_tokens, max_tokens): the messages that fit, and a reply
+    cap lowered so prompt plus reply can't exceed either limit. Raises
+    PreflightError if even the trimmed prompt doesn't fit.
+    """
+    with telemetry.span("tokens.preflight", model=model, tokenizer=tokenizer_name()) as span:
+        trims = 0
+        while True:
+            prompt_tokens = count_messages(messages)
+            room = context_limit(model) - prompt_tokens
+            if balance is not None:
+                room = min(room, balance - prompt_tokens)
+            if room >= MIN_REPLY_TOKENS:
+                break
+            trimmed = trim(messages) if trim else None
+            if trimmed is None:
+                span.set(prompt_tokens=prompt_tokens, trims=trims)
+                if context_limit(model) - prompt_tokens < MIN_REPLY_TOKENS:
+                    span.set(rejected="context")
+                    raise PreflightError(f"The request is {prompt_tokens} tokens, too long for {model}.", prompt_tokens, context_limit(model))
+                span.set(balance=balance, rejected="balance")
+                raise PreflightError(f"This needs about {prompt_tokens + MIN_REPLY_TOKENS} tokens, but the balance is {balance}.", prompt_tokens, balance)
+            messages = trimmed
+            trims += 1
+        max_tokens = min(max_tokens, room)
+        span.set(prompt_tokens=prompt_tokens, max_tokens=max_tokens, trims=trims)
+    return messages, prompt_tokens, max_tokens
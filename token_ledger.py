@@ -0,0 +1,146 @@
+"""Token ledger backed by Firestore.
+
+The balance on ``users/{username}.tokens`` is only ever changed with a
+server-side ``Increment``, so two tabs spending at once can't overwrite each
+other. Every charge also appends a usage entry to ``users/{username}/usage``
+recording the feature, model and prompt/completion tokens (and how many of the
+prompt tokens the provider served from its prompt cache), and bumps running
+per-feature totals in ``users/{username}/usage_totals`` that
+``spend_by_feature`` reports on.
+
+The real token count is only known once the model has answered, so a call is
+paid for in two steps. ``reserve`` checks the balance and holds back the
+call's estimated cost in one transaction, so two tabs can't both spend the
+same last tokens. ``charge(..., reserved=...)`` then records the actual usage
+and hands back whatever the estimate overshot, and ``release`` returns a hold
+whose call was never made. Charges made without a reservation (such as
+rolling summaries) are recorded after the fact, and can leave the balance
+slightly below zero.
+"""
+from firebase_admin import firestore
+
+import telemetry
+
+# Features tokens are spent on
+TUTOR_CHAT = 'tutor_chat'
+SESSION_SUMMARY = 'session_summary'
+IMAGE_PROMPT = 'image_prompt'
+IMAGE_GENERATION = 'image_generation'
+
+
+class InsufficientTokensError(Exception):
+    """Raised when a user's balance can't cover a request."""
+
+    def __init__(self, balance, required):
+        super().__init__(f"Balance of {balance} tokens is below the {required} required.")
+        self.balance = balance
+        self.required = required
+
+
+def _user_ref(db, username):
+    return db.collection('users').document(username)
+
+def get_balance(db, username):
+    """Reads a user's current token balance (only the tokens field is fetched)."""
+    with telemetry.span("firestore.get_balance"):
+        doc = _user_ref(db, username).get(field_paths=['tokens'])
+    return (doc.get('tokens') or 0) if doc.exists else 0
+
+def check_balance(db, username, required=1):
+    """Transactionally reads the balance and raises InsufficientTokensError if it is below required.
+
+    Returns the balance, so callers can refresh what they display.
+    """
+    ref = _user_ref(db, username)
+
+    @firestore.transactional
+    def read_balance(transaction):
+        doc = ref.get(field_paths=['tokens'], transaction=transaction)
+        return (doc.get('tokens') or 0) if doc.exists else 0
+
+    with telemetry.span("firestore.check_balance", tokens=required) as span:
+        balance = read_balance(db.transaction())
+        span.set(balance=balance)
+    if balance < required:
+        raise InsufficientTokensError(balance, required)
+    return balance
+
+def reserve(db, username, amount):
+    """Transactionally checks that the balance covers amount and holds amount back from it.
+
+    Returns the balance left after the hold. Raises InsufficientTokensError,
+    holding nothing, if the balance is below amount.
+    """
+    ref = _user_ref(db, username)
+
+    @firestore.transactional
+    def hold(transaction):
+        doc = ref.get(field_paths=['tokens'], transaction=transaction)
+        balance = (doc.get('tokens') or 0) if doc.exists else 0
+        if balance < amount:
+            raise InsufficientTokensError(balance, amount)
+        transaction.update(ref, {'tokens': balance - amount})
+        return balance - amount
+
+    with telemetry.span("firestore.reserve", tokens=amount) as span:
+        remaining = hold(db.transaction())
+        span.set(balance=remaining)
+    return remaining
+
+def release(db, username, amount, batch=None):
+    """Hands a reservation whose call was never made back to the balance."""
+    ref = _user_ref(db, username)
+    if batch is not None:
+        batch.update(ref, {'tokens': firestore.Increment(amount)})
+        return
+    with telemetry.span("firestore.release", tokens=amount):
+        ref.update({'tokens': firestore.Increment(amount)})
+
+def charge(db, username, amount, feature, model=None, prompt_tokens=0, completion_tokens=0, cached_tokens=0, batch=None, reserved=0):
+    """Deducts tokens with a server-side increment and appends a usage entry, atomically.
+
+    reserved is what reserve() already held back for this call; only the
+    difference moves the balance (it goes up if the estimate was too high).
+    With a batch (such as a write_buffer.WriteBuffer) the writes are only added
+    to it, and the caller commits them.
+    """
+    ref = _user_ref(db, username)
+    buffered = batch is not None
+    if not buffered:
+        batch = db.batch()
+    batch.update(ref, {'tokens': firestore.Increment(reserved - amount)})
+    batch.set(ref.collection('usage').document(), {
+        'feature': feature,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': cached_tokens,
+        'tokens': amount,
+        'created_at': firestore.SERVER_TIMESTAMP,
+    })
+    # Running per-feature totals, so reporting reads one small document per feature
+    batch.set(ref.collection('usage_totals').document(feature), {
+        'requests': firestore.Increment(1),
+        'tokens': firestore.Increment(amount),
+        'prompt_tokens': firestore.Increment(prompt_tokens),
+        'completion_tokens': firestore.Increment(completion_tokens),
+        'cached_tokens': firestore.Increment(cached_tokens),
+    }, merge=True)
+    if buffered:
+        return
+    with telemetry.span("firestore.charge", feature=feature, model=model, tokens=amount, documents=3):
+        batch.commit()
+
+def spend_by_feature(db, username):
+    """Returns a user's spend per feature.
+
+    Returns {feature: {'requests', 'tokens', 'prompt_tokens', 'completion_tokens', 'cached_tokens'}},
+    read from the running totals rather than by scanning every usage entry.
+    """
+    totals = {}
+    with telemetry.span("firestore.spend_by_feature") as span:
+        for doc in _user_ref(db, username).collection('usage_totals').stream():
+            entry = doc.to_dict()
+            totals[doc.id] = {key: entry.get(key) or 0 for key in ('requests', 'tokens', 'prompt_tokens', 'completion_tokens', 'cached_tokens')}
+        span.set(documents=len(totals))
+    return totals
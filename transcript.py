@@ -0,0 +1,37 @@
+"""Windowed rendering of the session transcript.
+
+The transcript only renders the newest ``TRANSCRIPT_WINDOW`` messages; older
+ones are shown a page at a time when the student asks for them. A finished
+message never changes, so its markdown is built once per process and reused
+on every rerun rather than being re-processed each time.
+"""
+import re
+from functools import lru_cache
+
+TRANSCRIPT_WINDOW = 20 # Messages rendered when a transcript is first shown
+TRANSCRIPT_PAGE = 20 # Messages added by each "Load earlier messages"
+
+SPEAKERS = {"user": "You", "assistant": "Tutor"}
+
+# LaTeX delimiters models use that Streamlit's markdown doesn't render
+_DISPLAY_MATH = re.compile(r"\\\[(.+?)\\\]", re.DOTALL)
+_INLINE_MATH = re.compile(r"\\\((.+?)\\\)", re.DOTALL)
+
+
+def normalize_math(text):
+    r"""Rewrites \[...\] and \(...\) math as $$...$$ and $...$, which Streamlit renders."""
+    text = _DISPLAY_MATH.sub(lambda m: f"$${m.group(1).strip()}$$", text)
+    return _INLINE_MATH.sub(lambda m: f"${m.group(1).strip()}$", text)
+
+@lru_cache(maxsize=4096)
+def message_markdown(role, content):
+    """Returns the markdown a finished text message is displayed as (cached, since it never changes)."""
+    return f"**{SPEAKERS[role]}:** {normalize_math(content)}"
+
+def visible_messages(messages, window):
+    """Returns the newest window messages, the ones the transcript renders."""
+    return messages[-window:] if window < len(messages) else messages
+
+def has_hidden_messages(messages, window, unloaded_count):
+    """Checks whether any message is hidden, either beyond the window or not loaded from storage yet."""
+    return unloaded_count > 0 or len(messages) > window
@@ -0,0 +1,171 @@
+"""Content-addressed cache for text-to-speech audio.
+
+Audio is keyed by a hash of (text, lang, slow) and kept in two tiers: a small
+in-memory LRU in front of an on-disk LRU with a size cap. A cache hit returns
+the MP3 bytes without calling gTTS. Fixed strings such as session welcome
+messages can be synthesized ahead of time with ``warm``.
+
+Hit, miss and eviction counters live in the app process. They are reported as
+``stats.tts_cache`` on the telemetry /metrics endpoint; the CLI runs in a
+process of its own, so it only reports the disk tier.
+
+    python tts_cache.py warm    # pre-synthesize every subject's welcome message
+    python tts_cache.py stats   # disk usage
+"""
+import argparse
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import telemetry
+from atomic_files import write_atomic
+from singletons import ProcessSingleton
+
+DEFAULT_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(".cache", "tts"))
+DEFAULT_MAX_DISK_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+DEFAULT_MEMORY_ENTRIES = 32
+
+
+
+def cache_key(text, lang, slow):
+    """Returns the content hash that addresses a piece of synthesized speech."""
+    return hashlib.sha256(f"{lang}\0{int(slow)}\0{text}".encode("utf-8")).hexdigest()
+
+def synthesize(text, lang="en", slow=False):
+    """Synthesizes speech with gTTS and returns MP3 bytes (always a network call)."""
+    from gtts import gTTS
+
+    fp = io.BytesIO()
+    gTTS(text=text, lang=lang, slow=slow).write_to_fp(fp)
+    return fp.getvalue()
+
+
+class TTSCache:
+    """Two-tier (memory, then disk) LRU cache of synthesized speech."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_disk_bytes=DEFAULT_MAX_DISK_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES, synthesize_fn=synthesize):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_entries = memory_entries
+        self.synthesize_fn = synthesize_fn
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def _remember(self, key, audio):
+        """Puts audio in the memory tier, dropping the least recently used entry if full."""
+        self._memory[key] = audio
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, text, lang="en", slow=False):
+        """Returns MP3 bytes for text, synthesizing (and caching) them only on a miss."""
+        with telemetry.span("tts.get", chars=len(text)) as span:
+            audio, tier = self._get(text, lang, slow)
+            span.set(tier=tier, bytes=len(audio))
+        return audio
+
+    def _get(self, text, lang, slow):
+        """Looks text up tier by tier. Returns (audio, tier it came from: 'memory', 'disk' or 'synthesized')."""
+        key = cache_key(text, lang, slow)
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return audio, "memory"
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path) # Disk LRU order is by modification time
+            with self._lock:
+                self.counters["disk_hits"] += 1
+                self._remember(key, audio)
+            return audio, "disk"
+        except FileNotFoundError:
+            pass
+
+        with telemetry.span("tts.synthesize", chars=len(text)):
+            audio = self.synthesize_fn(text, lang=lang, slow=slow)
+        write_atomic(path, audio)
+        with self._lock:
+            self.counters["misses"] += 1
+            self._remember(key, audio)
+        self._evict()
+        return audio, "synthesized"
+
+    def _evict(self):
+        """Deletes the least recently used files until the disk tier is under its size cap."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_disk_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue # Another process evicted it first
+            total -= size
+            with self._lock:
+                self.counters["evictions"] += 1
+            if total <= self.max_disk_bytes:
+                break
+
+    def warm(self, texts, lang="en", slow=False):
+        """Synthesizes any of the given texts that aren't cached yet."""
+        for text in texts:
+            self.get(text, lang=lang, slow=slow)
+
+    def stats(self):
+        """Returns hit/miss/eviction counters and the hit rate since the process started."""
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+def _create_default_cache():
+    cache = TTSCache()
+    telemetry.register_stats("tts_cache", cache.stats)
+    return cache
+
+_default_cache = ProcessSingleton(_create_default_cache)
+
+def get_tts_cache():
+    """Returns the process-wide TTS cache."""
+    return _default_cache.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text-to-speech cache maintenance.")
+    parser.add_argument("command", choices=["warm", "stats"], help="warm: pre-synthesize welcome messages; stats: show disk usage (hit rates are on /metrics)")
+    args = parser.parse_args()
+
+    cache = get_tts_cache()
+    if args.command == "warm":
+        from prompt_store import welcome_message
+        from syllabus_corpus import discover_subjects
+
+        cache.warm(welcome_message(subject) for subject in discover_subjects())
+        print(f"Warmed: {cache.stats()}") # This run's counters; the app's own are on /metrics
+    files = [e for e in os.scandir(cache.cache_dir) if e.name.endswith(".mp3")]
+    print(f"{len(files)} cached clip(s), {sum(e.stat().st_size for e in files)} bytes")
+
+if __name__ == "__main__":
+    main()
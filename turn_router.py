@@ -0,0 +1,153 @@
+"""Routing of tutor turns by the kind of question asked.
+
+Not every question needs the same reply. "Thanks!" doesn't need syllabus
+sections or a 1000-token cap, and a worked exam answer may need more than a
+definition does. Each question is classified locally with a few patterns (no
+model call):
+
+- ``greeting``: thanks, hellos and acknowledgements
+- ``follow_up``: a short question about the previous answer that names no
+  topic of its own ("why?", "explain that again", "can you give another example?")
+- ``definition``: "what is ...", "define ..."
+- ``worked_problem``: calculations and step-by-step solutions
+- ``exercises``: practice questions and quizzes
+- ``explanation``: anything else
+
+Each route maps to a model, a max_tokens cap, a temperature, and whether
+syllabus sections are retrieved for it. The defaults are ``DEFAULT_POLICY``.
+To override any of them, point TUTOR_ROUTING_POLICY at a JSON file of the
+same shape, for example ``{"worked_problem": {"model": "gpt-4.1-mini"}}``.
+
+Every routed reply runs inside a ``tutor.route.<route>`` span. The telemetry
+metrics report then shows, per route, the reply latency, its mean tokens and
+completion tokens, and how often it hit its cap (``truncated_mean``). Those
+are the numbers to tune the policy with.
+"""
+import json
+import os
+import re
+import threading
+
+import telemetry
+from tutor_turn import TUTOR_MAX_TOKENS, TUTOR_MODEL, TUTOR_TEMPERATURE
+
+GREETING = "greeting"
+FOLLOW_UP = "follow_up"
+DEFINITION = "definition"
+WORKED_PROBLEM = "worked_problem"
+EXERCISES = "exercises"
+EXPLANATION = "explanation"
+
+DEFAULT_POLICY = {
+    GREETING: {"model": TUTOR_MODEL, "max_tokens": 150, "temperature": TUTOR_TEMPERATURE, "syllabus_context": False},
+    FOLLOW_UP: {"model": TUTOR_MODEL, "max_tokens": 600, "temperature": TUTOR_TEMPERATURE, "syllabus_context": False},
+    DEFINITION: {"model": TUTOR_MODEL, "max_tokens": 400, "temperature": 0.3, "syllabus_context": True},
+    WORKED_PROBLEM: {"model": TUTOR_MODEL, "max_tokens": 1500, "temperature": 0.2, "syllabus_context": True},
+    EXERCISES: {"model": TUTOR_MODEL, "max_tokens": 1200, "temperature": 0.8, "syllabus_context": True},
+    EXPLANATION: {"model": TUTOR_MODEL, "max_tokens": TUTOR_MAX_TOKENS, "temperature": TUTOR_TEMPERATURE, "syllabus_context": True},
+}
+
+POLICY_PATH = os.environ.get("TUTOR_ROUTING_POLICY")
+
+# Words allowed after a greeting ("thanks so much"); more means a question follows it
+GREETING_MAX_EXTRA_WORDS = 2
+# Questions this short (in words) can be follow-ups or definitions
+FOLLOW_UP_MAX_WORDS = 10
+DEFINITION_MAX_WORDS = 12
+
+_GREETING = re.compile(r"^(hi|hello|hey|thank you|thanks?|thx|ok(ay)?|cool|great|nice|awesome|got it|i see|understood|bye|goodbye|good (morning|afternoon|evening|night)|yes|no|yep|nope)\b")
+_EXERCISES = re.compile(r"\b(quiz|test me|exercises?|practice (questions?|problems?)|(sample|exam|test|multiple choice|mcq) questions?|past paper|give me (some |a few |\d+ )?(questions|problems))\b")
+_WORKED_PROBLEM = re.compile(r"\b(calculate|solve|work out|find the value|show (the |your )?(working|steps)|step[- ]by[- ]step|simplify|evaluate|how many|how much)\b|\d\s*[-+*/x×÷=^]\s*\d")
+_DEFINITION = re.compile(r"^(what is|what are|what's|whats|define|definition of|meaning of|what does \S+( \S+)? mean)\b")
+# Words that point back at the previous answer
+_ANAPHORA = frozenset("it its that this these those them they again another".split())
+# Words a follow-up may be made of besides those; any other word names a topic, so the question gets syllabus context
+_FOLLOW_UP_WORDS = _ANAPHORA | frozenset("""
+a an the and or but so of to in on for with about by me i you we us my your please can could would will
+do does did don't dont is are was were be what why how which mean meant more simpler simply easier
+explain elaborate say repeat give show tell go over try other different way just example examples one
+part step understand get still not
+""".split())
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+class Route:
+    """How to answer one kind of question."""
+
+    def __init__(self, name, model, max_tokens, temperature, syllabus_context):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.syllabus_context = syllabus_context
+
+
+def get_policy():
+    """Returns the routing policy: DEFAULT_POLICY with any overrides from TUTOR_ROUTING_POLICY (read once per process)."""
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            policy = {route: dict(settings) for route, settings in DEFAULT_POLICY.items()}
+            if POLICY_PATH:
+                try:
+                    with open(POLICY_PATH, "r", encoding="utf-8") as f:
+                        overrides = json.load(f)
+                    for route, settings in overrides.items():
+                        if route in policy:
+                            policy[route].update(settings)
+                        else:
+                            print(f"WARNING: Ignoring unknown route '{route}' in {POLICY_PATH}.")
+                except (OSError, ValueError, AttributeError) as e:
+                    print(f"WARNING: Could not read routing policy {POLICY_PATH}; using the defaults: {e}")
+            _policy = policy
+        return _policy
+
+def classify(question, has_previous_answer=False):
+    """Returns the route name for a question; follow-ups are only recognised once there is an answer to follow."""
+    text = " ".join(question.lower().split())
+    words = len(text.split())
+    greeting = _GREETING.match(text)
+    if greeting and len(re.findall(r"\w+", text[greeting.end():])) <= GREETING_MAX_EXTRA_WORDS:
+        return GREETING
+    if _EXERCISES.search(text):
+        return EXERCISES
+    if _WORKED_PROBLEM.search(text):
+        return WORKED_PROBLEM
+    if words <= DEFINITION_MAX_WORDS and _DEFINITION.match(text):
+        return DEFINITION
+    if has_previous_answer and words <= FOLLOW_UP_MAX_WORDS and is_follow_up(text):
+        return FOLLOW_UP
+    return EXPLANATION
+
+def is_follow_up(text):
+    """Checks whether a question only refers back to the previous answer.
+
+    It must name no topic (every word is a follow-up word), and it must point
+    back (an anaphora such as "it" or "that") unless it is a bare cue like "why?".
+    """
+    words = re.findall(r"[\w']+", text.lower())
+    if not words or any(word not in _FOLLOW_UP_WORDS for word in words):
+        return False
+    return len(words) <= 2 or any(word in _ANAPHORA for word in words)
+
+def has_previous_answer(history):
+    """Checks whether the tutor has answered a question of the student's yet (the welcome message doesn't count)."""
+    asked = False
+    for message in history:
+        if message["role"] == "user":
+            asked = True
+        elif message["role"] == "assistant" and asked:
+            return True
+    return False
+
+def route_question(question, has_previous_answer=False):
+    """Classifies a question and returns its Route under the current policy."""
+    name = classify(question, has_previous_answer)
+    settings = get_policy()[name]
+    return Route(name, settings["model"], settings["max_tokens"], settings["temperature"], settings["syllabus_context"])
+
+def route_span(route, max_tokens):
+    """Returns the span a routed reply runs in; set its usage and truncated attributes when the reply ends."""
+    return telemetry.span(f"tutor.route.{route.name}", route=route.name, model=route.model, max_tokens=max_tokens)
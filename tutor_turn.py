@@ -0,0 +1,150 @@
+"""The model side of a tutor turn, independent of Streamlit.
+
+tutor_page and the offline benchmark (benchmarks/turn_benchmark.py) both build
+a turn's messages and talk to the model through these functions, so the
+benchmark measures the same code the app runs.
+"""
+import time
+
+from context_window import build_context
+from syllabus_retrieval import DEFAULT_TOP_K, retrieve_context
+import telemetry
+
+TUTOR_MODEL = "gpt-4.1-nano"
+TUTOR_MAX_TOKENS = 1000
+TUTOR_TEMPERATURE = 0.7
+SUMMARY_MODEL = "gpt-4.1-nano"
+
+STREAM_RENDER_INTERVAL = 0.05 # Seconds between transcript updates, so we don't send a delta per token
+
+
+def retrieval_message(subject, syllabus_index, question, full_syllabus, top_k=DEFAULT_TOP_K):
+    """Retrieves the syllabus sections relevant to a question. Returns (system message, retrieval report)."""
+    with telemetry.span("tutor.retrieval", subject=subject) as span:
+        syllabus_sections, report = retrieve_context(syllabus_index, question, full_syllabus, top_k=top_k)
+        span.set(sections=report["sections"], tokens=report["injected_tokens"], tokens_saved=report["tokens_saved"])
+    message = {
+        "role": "system",
+        "content": f"Relevant syllabus sections for {subject}:\n{syllabus_sections or 'No matching sections found.'}"
+    }
+    return message, report
+
+class SectionTrimmer:
+    """A preflight trim function that drops the turn's retrieved syllabus sections, lowest-ranked first.
+
+    Pass it as token_counter.preflight's trim. message and report always
+    describe the sections still in the prompt (message is None once they are
+    all gone), and dropped counts the sections taken out.
+    """
+
+    def __init__(self, subject, syllabus_index, question, full_syllabus, message, report):
+        self.subject = subject
+        self.syllabus_index = syllabus_index
+        self.question = question
+        self.full_syllabus = full_syllabus
+        self.message = message
+        self.report = report
+        self.dropped = 0
+
+    def __call__(self, messages):
+        if self.message is None:
+            return None
+        position = next(i for i, m in enumerate(messages) if m is self.message)
+        keep = self.report["sections"] - 1
+        if keep > 0:
+            # The best keep sections are exactly the first keep of the ranking, so this drops the lowest-ranked one
+            self.message, self.report = retrieval_message(self.subject, self.syllabus_index, self.question, self.full_syllabus, top_k=keep)
+            replacement = [self.message]
+        else:
+            self.message = None
+            self.report = dict(self.report, sections=0, injected_tokens=0, tokens_saved=self.report["full_syllabus_tokens"])
+            replacement = []
+        self.dropped += 1
+        return messages[:position] + replacement + messages[position + 1:]
+
+def build_turn_messages(system_prompt, chat_history, summary_state, summarize, retrieved_message):
+    """Builds the messages sent for a turn.
+
+    That is the system prompt, rolling summary and recent turns, with the
+    retrieved sections (if any; retrieved_message may be None) just before
+    the question (the last message of chat_history). With summarize=None the
+    messages are a draft that calls no model (see context_window.build_context).
+    """
+    with telemetry.span("tutor.build_context") as span:
+        messages = build_context([{"role": "system", "content": system_prompt}] + chat_history, summary_state, summarize)
+        if retrieved_message is not None:
+            messages = messages[:-1] + [retrieved_message] + messages[-1:]
+        span.set(messages=len(messages), bytes=telemetry.text_bytes(*(m["content"] for m in messages)))
+    return messages
+
+def request_summary(client, previous_summary, messages, token_budget, requester=None):
+    """Asks the model to fold messages into the rolling session summary. Returns (summary, usage)."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = client.chat(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": f"You maintain a running summary of a tutoring session. Merge the new conversation into the current summary. Keep the topics covered, what the student struggled with, and any open questions. Stay under {token_budget} tokens."},
+            {"role": "user", "content": f"Current summary:\n{previous_summary or '(none yet)'}\n\nNew conversation to fold in:\n{transcript}"}
+        ],
+        max_tokens=token_budget,
+        temperature=0.3,
+        requester=requester,
+    )
+    return response.choices[0].message.content, response.usage
+
+def stream_tutor_response(client, messages, on_text=None, requester=None, on_queue=None,
+                          model=TUTOR_MODEL, max_tokens=TUTOR_MAX_TOKENS, temperature=TUTOR_TEMPERATURE):
+    """Streams a tutor reply, calling on_text(text_so_far, done) at most every STREAM_RENDER_INTERVAL.
+
+    model, max_tokens and temperature come from the question's route (see
+    turn_router.py); max_tokens should be what token_counter.preflight left
+    room for.
+
+    requester and on_queue go to the client's rate limit scheduler, so a
+    student waiting for quota sees their place in line.
+
+    Returns (response_text, usage, timings). usage comes from the final stream
+    chunk and may be None if the API did not report it; timings holds
+    'first_token_s', 'total_s' and 'truncated' (the reply hit max_tokens).
+    """
+    started_at = time.perf_counter()
+    with telemetry.span("openai.chat_stream", model=model) as span:
+        stream = client.chat_stream(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream_options={"include_usage": True}, # Final chunk carries token usage for deduction
+            requester=requester,
+            on_queue=on_queue,
+        )
+
+        response_text = ""
+        usage = None
+        first_token_at = None
+        finish_reason = None
+        last_render = 0.0
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                response_text += chunk.choices[0].delta.content
+                if on_text and time.perf_counter() - last_render >= STREAM_RENDER_INTERVAL:
+                    on_text(response_text, False)
+                    last_render = time.perf_counter()
+
+        if on_text:
+            on_text(response_text, True)
+        finished_at = time.perf_counter()
+        timings = {
+            'first_token_s': (first_token_at or finished_at) - started_at,
+            'total_s': finished_at - started_at,
+            'truncated': finish_reason == "length",
+        }
+        span.set(first_token_ms=round(timings['first_token_s'] * 1000, 3), bytes=telemetry.text_bytes(response_text),
+                 **telemetry.usage_attributes(usage))
+    return response_text, usage, timings
@@ -0,0 +1,185 @@
+"""Field-projected access to user documents.
+
+Login only needs the password hash and the sidebar only needs profile fields,
+so neither downloads the whole user document. Chat history is not part of the
+profile at all; it is paged in from the session subcollection (chat_store.py).
+
+Documents written before schema version 2 may still carry a chat_history array
+or an inline avatar. They are migrated the first time their profile is loaded,
+or for every user at once with ``python user_profiles.py migrate``.
+"""
+import argparse
+import base64
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from firebase_admin import firestore
+
+from avatar_store import get_avatar_store, migrate_legacy_avatar
+from chat_store import migrate_legacy_chat_history
+from singletons import ProcessSingleton
+import telemetry
+
+# Version 2: chat history in session subcollections, avatars in the avatar store
+SCHEMA_VERSION = 2
+
+AUTH_FIELDS = ['password_hash']
+PROFILE_FIELDS = [
+    'username', 'first_name', 'last_name', 'email', 'tokens',
+    'learning_preferences', 'subjects', 'current_session_id',
+    'avatar_hash', 'avatar_url', 'avatar_thumb_url', 'schema_version',
+]
+LEGACY_FIELDS = ['chat_history', 'avatar_b64']
+# Profile fields other code changes (the token ledger, chat_store.start_session), possibly in another process
+VOLATILE_FIELDS = ['tokens', 'current_session_id']
+
+# Profile summaries kept for resumed logins
+PROFILE_CACHE_ENTRIES = 1000
+PROFILE_CACHE_TTL = 15 * 60 # Seconds
+
+
+
+def user_ref(db, username):
+    """Returns the Firestore document reference for a user."""
+    return db.collection('users').document(username)
+
+def get_password_hash(db, username):
+    """Fetches only a user's password hash; returns None if the user doesn't exist."""
+    with telemetry.span("firestore.get_password_hash"):
+        doc = user_ref(db, username).get(field_paths=AUTH_FIELDS)
+    return doc.get('password_hash') if doc.exists else None
+
+def load_profile(db, username, avatar_store):
+    """Loads the profile fields of a user (no password hash, avatar bytes or chat history).
+
+    Pre-version-2 documents are migrated first. Returns None if the user doesn't exist.
+    """
+    with telemetry.span("firestore.load_profile"):
+        doc = user_ref(db, username).get(field_paths=PROFILE_FIELDS)
+    if not doc.exists:
+        return None
+    profile = doc.to_dict()
+    if profile.get('schema_version', 1) < SCHEMA_VERSION:
+        profile.update(migrate_user_document(db, username, avatar_store))
+    return profile
+
+def load_volatile_fields(db, username):
+    """Reads only a user's VOLATILE_FIELDS; returns None if the user doesn't exist."""
+    with telemetry.span("firestore.load_volatile_fields"):
+        doc = user_ref(db, username).get(field_paths=VOLATILE_FIELDS)
+    if not doc.exists:
+        return None
+    fields = doc.to_dict() or {}
+    return {'tokens': fields.get('tokens') or 0, 'current_session_id': fields.get('current_session_id')}
+
+class ProfileCache:
+    """Small LRU of recently loaded profiles, so a resumed login doesn't re-read the whole user document.
+
+    VOLATILE_FIELDS can change without this cache hearing of it (another tab,
+    another app process), so a resume re-reads them with load_volatile_fields.
+    The other fields only change through profile forms, which put the new
+    profile here too; edits made in another process show up once the entry
+    expires.
+    """
+
+    def __init__(self, max_entries=PROFILE_CACHE_ENTRIES, ttl=PROFILE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # username -> (stored_at, profile)
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """Returns a copy of a cached profile, or None if it isn't cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(username, None)
+                return None
+            self._entries.move_to_end(username)
+            return copy.deepcopy(entry[1])
+
+    def put(self, username, profile):
+        with self._lock:
+            self._entries[username] = (time.monotonic(), copy.deepcopy(profile))
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def drop(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+
+_profile_cache = ProcessSingleton(ProfileCache)
+
+def get_profile_cache():
+    """Returns the process-wide profile cache."""
+    return _profile_cache.get()
+
+def migrate_user_document(db, username, avatar_store):
+    """Moves legacy fields out of a user document and returns the profile fields that changed.
+
+    This runs on the login path, so a field that fails to migrate is logged
+    and skipped rather than raised. The schema version is then left as it
+    was, so the next login (or migrate_all_users) retries the migration.
+    """
+    ref = user_ref(db, username)
+    with telemetry.span("firestore.migrate_user", schema_version=SCHEMA_VERSION) as span:
+        try:
+            legacy = ref.get(field_paths=LEGACY_FIELDS).to_dict() or {}
+        except Exception as e:
+            print(f"WARNING: Could not read the legacy fields of {username}; migration retries at the next login: {e}")
+            span.set(failed="read")
+            return {}
+        failed = []
+        for field, migrate in (('chat_history', lambda: migrate_legacy_chat_history(db, username, legacy)),
+                               ('avatar', lambda: migrate_legacy_avatar(avatar_store, ref, legacy))):
+            try:
+                migrate()
+            except Exception as e:
+                print(f"WARNING: Could not migrate the legacy {field} of {username}; migration retries at the next login: {e}")
+                failed.append(field)
+        if not failed:
+            try:
+                ref.update({'schema_version': SCHEMA_VERSION})
+            except Exception as e:
+                print(f"WARNING: Could not record the schema version of {username}; migration retries at the next login: {e}")
+                failed.append('schema_version')
+        if failed:
+            span.set(failed=",".join(failed))
+    changed = {key: value for key, value in legacy.items() if key in PROFILE_FIELDS}
+    if not failed:
+        changed['schema_version'] = SCHEMA_VERSION
+    return changed
+
+def migrate_all_users(db, avatar_store):
+    """Migrates every user document still below SCHEMA_VERSION. Returns how many were migrated."""
+    migrated = 0
+    for doc in db.collection('users').select(['schema_version']).stream():
+        if (doc.to_dict() or {}).get('schema_version', 1) < SCHEMA_VERSION:
+            if 'schema_version' in migrate_user_document(db, doc.id, avatar_store):
+                migrated += 1 # Documents whose migration failed stay below SCHEMA_VERSION and aren't counted
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User document maintenance.")
+    parser.add_argument("command", choices=["migrate"], help="migrate: move legacy chat histories and avatars out of user documents")
+    parser.parse_args()
+
+    import firebase_admin
+    from firebase_admin import credentials
+
+    # Same credentials the app uses
+    key_json = base64.b64decode(os.environ["FIREBASE_SERVICE_ACCOUNT_KEY_B64"]).decode('utf-8')
+    firebase_admin.initialize_app(credentials.Certificate(json.loads(key_json)))
+    db = firestore.client()
+    migrated = migrate_all_users(db, get_avatar_store(db))
+    print(f"Migrated {migrated} user(s).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Write-behind buffer for a session's Firestore writes.
+
+One tutor turn used to commit three times, one after another: the question,
+the token charge and the reply. Those writes now go into the session's
+``WriteBuffer``, which takes the same ``set``/``update`` calls as a Firestore
+write batch, and the app flushes it once at the end of each run (see
+``flush_writes`` in app.py), so a turn costs a single batched commit.
+
+Writes to the same document are coalesced as they arrive. Later fields
+overwrite earlier ones, and two ``Increment`` values of one field are added
+together. Two saves in a turn therefore bump the session's message counter
+once by two, and a turn's charges become one balance update.
+"""
+from firebase_admin import firestore
+
+from chat_store import MAX_BATCH_WRITES
+import telemetry
+
+
+def _combine(previous, value):
+    """Returns what a field ends up as when value is written over previous in the same commit."""
+    if isinstance(value, firestore.Increment):
+        if isinstance(previous, firestore.Increment):
+            return firestore.Increment(previous.value + value.value)
+        if isinstance(previous, (int, float)) and not isinstance(previous, bool):
+            return previous + value.value
+    return value
+
+
+class WriteBuffer:
+    """Collects Firestore writes, coalesced per document, until flush() commits them."""
+
+    def __init__(self, db):
+        self.db = db
+        self._pending = {} # document path -> [ref, data, merge]; insertion order is commit order
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set(self, ref, data, merge=False):
+        entry = self._pending.get(ref.path)
+        if entry is None:
+            self._pending[ref.path] = [ref, dict(data), merge]
+        elif not merge:
+            entry[1:] = [dict(data), False] # A full overwrite replaces whatever was written before
+        else:
+            for key, value in data.items():
+                entry[1][key] = _combine(entry[1].get(key), value)
+
+    def update(self, ref, data):
+        """Buffers an update. It is committed as a merge, which (unlike update) also creates a missing document."""
+        self.set(ref, data, merge=True)
+
+    def flush(self):
+        """Commits every pending write, MAX_BATCH_WRITES documents per batch. Returns the number of documents written.
+
+        If a commit fails, its writes and every later one stay pending for the
+        next flush, and the error is raised.
+        """
+        entries = list(self._pending.values())
+        if not entries:
+            return 0
+        self._pending = {}
+        with telemetry.span("firestore.flush_writes", documents=len(entries)):
+            for start in range(0, len(entries), MAX_BATCH_WRITES):
+                batch = self.db.batch()
+                for ref, data, merge in entries[start:start + MAX_BATCH_WRITES]:
+                    batch.set(ref, data, merge=merge)
+                try:
+                    batch.commit()
+                except Exception:
+                    newer = list(self._pending.values())
+                    self._pending = {}
+                    for ref, data, merge in entries[start:] + newer:
+                        self.set(ref, data, merge)
+                    raise
+        return len(entries)